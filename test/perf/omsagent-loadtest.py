@@ -3,31 +3,66 @@
 import sys
 import os
 import re
+import glob
 import json
+import ssl
+import math
 import time
+import zlib
+import mmap
 import socket
+import signal
+import struct
+import threading
+import ctypes
+import ctypes.util
 import logging
 import string
 import random
 import argparse
+import array
+import bisect
+import itertools
 import datetime
+import shutil
+import tempfile
 import subprocess
 import multiprocessing
 import logging.handlers
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
 from datetime import datetime
 from logging.handlers import SysLogHandler
+from perf_stats import percentile
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
 
 try:
     import psutil
     import numpy as np
 except:
     print("[optional] missing python libraries: psutil numpy [You can't use profiling without these packages]")
+try:
+    import yaml
+except ImportError:
+    yaml = None  # only needed for YAML scenario files
+try:
+    import tcp_fanin
+except (ImportError, SyntaxError):
+    tcp_fanin = None  # python 3 only, needed by the syslog_tcp_fanin writer
 PY3 = sys.version_info[0] == 3
 
 
 def average(lst): 
     return sum(lst) / len(lst)
 
+
 def gethostname():
     try:
         return socket.gethostname()
@@ -35,39 +70,195 @@ def gethostname():
         return '-'
 
 
+def get_random_ip(rnd):
+    return '%d.%d.%d.%d' % (rnd.randint(1, 223), rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(1, 254))
+
+
 def build_random_msg_string(size):
     return 'msg_' + ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(size))
 
 
+def get_cumulative_weights(weights):
+    cumulative = []
+    total = 0.0
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    return cumulative
+
+
+def weighted_choice(rnd, values, cumulative):
+    return values[min(len(values) - 1, bisect.bisect_right(cumulative, rnd.random() * cumulative[-1]))]
+
+
+def parse_size_distribution(spec, default_size):
+    """Return a function drawing an event size from fixed[:SIZE], uniform:MIN:MAX, lognormal:MEDIAN:SIGMA
+    or histogram:SIZE=WEIGHT,SIZE=WEIGHT..."""
+    kind, _, args = spec.partition(':')
+    if kind == 'fixed':
+        size = int(args or default_size)
+        return lambda rnd: size
+    if kind == 'uniform':
+        low, high = map(int, args.split(':'))
+        return lambda rnd: rnd.randint(low, high)
+    if kind == 'lognormal':
+        median, sigma = map(float, args.split(':'))
+        return lambda rnd: int(rnd.lognormvariate(math.log(median), sigma))
+    if kind == 'histogram':
+        pairs = [pair.split('=') for pair in args.split(',')]
+        sizes = [int(size) for size, weight in pairs]
+        cumulative = get_cumulative_weights([float(weight) for size, weight in pairs])
+        return lambda rnd: weighted_choice(rnd, sizes, cumulative)
+    raise ValueError("Unknown event size distribution '%s', use fixed, uniform, lognormal or histogram" % spec)
+
+
+# embedded in the generated events to follow them up to the ODS stand-in: oms_lt=<writer id>:<sequence>:<send time ms>
+STAMP_RE = re.compile(r'oms_lt=([\w.]+):(\d+):(\d+)')
+
+
+def format_stamp(writer_id, seq, send_time_ms):
+    return 'oms_lt=%s:%d:%d' % (writer_id, seq, send_time_ms)
+
+
 def get_all_plugins_name():
-    return ['syslog', 'syslog_cef', 'file', 'msgpack']
+    return ['syslog', 'syslog_cef', 'syslog_tcp_fanin', 'security_events', 'statsd', 'file', 'msgpack', 'syslog_replay',
+            'file_replay']
+
+
+def get_ruby_path():
+    for path in (RUBY_PATH_OMS, RUBY_PATH_LOCAL, RUBY_PATH_DEFAULT):
+        if os.path.isfile(path):
+            return path
+    return None
 
 
 def get_ruby_version(path):
     if not os.path.isfile(path):
         return ''
     cmd = '%s --version' % path
-    lines = subprocess.Popen(cmd.split(' '), stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout.readlines()
+    lines = subprocess.Popen(cmd.split(' '), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             universal_newlines=True).stdout.readlines()
     return lines[0].split(' ')[1]
 
 
+def find_executable(path):
+    """path when it exists, otherwise its name looked up in PATH."""
+    if os.path.isfile(path):
+        return path
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        candidate = os.path.join(directory, os.path.basename(path))
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+
+# the innermost frame matching a category gets the sample: Yajl and Zlib called by out_oms are not counted in out_oms
+STACK_CATEGORIES = [
+    ('Yajl', ('yajl', 'Yajl')),
+    ('Zlib', ('zlib', 'Zlib', 'gzip')),
+    ('in_syslog', ('in_syslog.rb', 'parser_syslog.rb', 'socket_util.rb')),
+    ('filter_syslog', ('filter_syslog',)),
+    ('out_oms', ('out_oms', 'oms_common.rb', 'oms_configuration.rb')),
+]
+
+
+def read_folded(path):
+    """Sample count of every stack of a folded file: 'root frame;...;leaf frame count' lines."""
+    stacks = {}
+    if not os.path.isfile(path):
+        return stacks
+    with open(path) as f:
+        for line in f:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            if stack and count.isdigit():
+                stacks[stack] = stacks.get(stack, 0) + int(count)
+    return stacks
+
+
+def get_stack_category(stack):
+    for frame in reversed(stack.split(';')):
+        for category, patterns in STACK_CATEGORIES:
+            if any(pattern in frame for pattern in patterns):
+                return category
+    return 'other'
+
+
+def get_category_breakdown(stacks):
+    """Percentage of the samples spent in every category of STACK_CATEGORIES."""
+    total = sum(stacks.values())
+    breakdown = dict((category, 0.0) for category, _ in STACK_CATEGORIES + [('other', ())])
+    for stack, count in stacks.items():
+        breakdown[get_stack_category(stack)] += 100.0 * count / total
+    return breakdown if total > 0 else {}
+
+
+class RubyStackProfiler:
+    """rbspy attached to every ruby process for the measured window, writing one folded file per process.
+
+    ruby-prof only profiles the process it runs in and cannot attach to a running omsagent, rbspy is required.
+    """
+
+    def __init__(self, path, rate=100):
+        self.path = path
+        self.rate = rate
+        self.recorders = []
+
+    @staticmethod
+    def find():
+        return find_executable(RBSPY_PATH)
+
+    def start(self, pids, folded_prefix):
+        self.recorders = []
+        for pid in pids:
+            folded_path = '%s.%d.folded' % (folded_prefix, pid)
+            cmd = [self.path, 'record', '--pid', str(pid), '--rate', str(self.rate), '--format', 'collapsed',
+                   '--file', folded_path, '--silent']
+            if os.geteuid() != 0:
+                cmd.insert(0, 'sudo')  # reading the memory of another process
+            with open(os.devnull, 'w') as devnull:
+                self.recorders.append((pid, folded_path, subprocess.Popen(cmd, stdout=devnull, stderr=devnull)))
+
+    def stop(self, timeout=30):
+        """Interrupt the recorders, they write their folded file on SIGINT, and return the breakdown by pid."""
+        for pid, folded_path, recorder in self.recorders:
+            if recorder.poll() is None:
+                recorder.send_signal(signal.SIGINT)
+        deadline = time.time() + timeout
+        profiles = {}
+        for pid, folded_path, recorder in self.recorders:
+            while recorder.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if recorder.poll() is None:
+                recorder.kill()
+            stacks = read_folded(folded_path)
+            profiles[pid] = {'folded': folded_path, 'samples': sum(stacks.values()),
+                             'breakdown_pct': get_category_breakdown(stacks)}
+        self.recorders = []
+        return profiles
+
+
 def net_connections(protocol='udp'):
     """Parse /proc/net/tcp* and /proc/net/udp* files."""
     BIGFILE_BUFFERING = -1 if PY3 else 8192
     filename = "/proc/net/%s" % protocol
+    family = socket.AF_INET6 if protocol.endswith('6') else socket.AF_INET
     results = []
     try:
         from psutil import _pslinux as _psplatform
+        # renamed in psutil 6
+        connections = getattr(_psplatform, 'NetConnections', None) or _psplatform.Connections
         with open(filename, "rt", buffering=BIGFILE_BUFFERING) as f:
             f.readline()  # skip the first line
             for lineno, line in enumerate(f, 1):
                 # try:
                 items = line.split()
-                sl, laddr, raddr, status, tx_q, rx_q, tr, _, timeout, inode, ref, ptr = items[:12]
-                drops = int(items[-1]) if items[-1].isdigit() else 0
-                addr = _psplatform.Connections.decode_address(laddr, socket.AF_INET)
+                sl, laddr, raddr, status, tx_rx_q, tr, retrnsmt, uid, timeout, inode = items[:10]
+                # only the udp tables end with the drop counter
+                drops = int(items[-1]) if protocol.startswith('udp') else 0
+                addr = connections.decode_address(laddr, family)
                 results.append({
-                    'sl': sl, 'laddr': addr, 'drops': drops
+                    'sl': sl, 'laddr': addr, 'drops': drops, 'status': status,
+                    'rx_queue': int(tx_rx_q.split(':')[1], 16), 'inode': int(inode)
                 })
                 # except ValueError:
                 #     raise RuntimeError("error while parsing %s; malformed line %s %r" % (filename, lineno, line))
@@ -76,14 +267,133 @@ def net_connections(protocol='udp'):
     return results
 
 
+def get_socket_inodes(pids):
+    inodes = set()
+    for pid in pids:
+        fd_dir = '/proc/%d/fd' % pid
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            continue  # exited, or owned by another user
+        for fd in fds:
+            try:
+                target = os.readlink(os.path.join(fd_dir, fd))
+            except OSError:
+                continue
+            if target.startswith('socket:['):
+                inodes.add(int(target[8:-1]))
+    return inodes
+
+
+def unix_socket_queues(paths):
+    """Receive queues of the unix sockets bound to these paths, /proc/net/unix does not expose them."""
+    queues = {}
+    try:
+        lines = subprocess.Popen(['ss', '-xan'], stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT).stdout.read().decode('ASCII', 'replace').splitlines()
+    except OSError:
+        return queues  # no iproute2
+    for line in lines[1:]:
+        items = line.split()
+        # Netid State Recv-Q Send-Q Local-Address Port Peer-Address Port
+        if len(items) >= 6 and items[4] in paths:
+            queues[items[4]] = queues.get(items[4], 0) + int(items[2])
+    return queues
+
+
+class ListenerMonitor:
+    """Sample the receive queue depth and the drop counter of the omsagent listeners.
+
+    Sockets are matched by inode to the file descriptors of the monitored processes, then grouped by local port,
+    so a tcp listener also accounts for the queues of its accepted connections. The drop counter only exists
+    for udp; unix socket queues come from ss.
+    """
+    PROTOCOLS = ['udp', 'udp6', 'tcp', 'tcp6']
+
+    def __init__(self, ports, unix_paths):
+        self.ports = set(ports)
+        self.unix_paths = set(unix_paths)
+
+    def read_unix_inodes(self):
+        inodes = {}
+        with open('/proc/net/unix') as f:
+            f.readline()
+            for line in f:
+                # Num RefCount Protocol Flags Type St Inode Path
+                items = line.split()
+                if len(items) >= 8 and items[7] in self.unix_paths:
+                    inodes[int(items[6])] = items[7]
+        return inodes
+
+    def sample(self, pids):
+        inodes = get_socket_inodes(pids)
+        listeners = {}
+        for protocol in self.PROTOCOLS:
+            for conn in net_connections(protocol):
+                if conn['inode'] not in inodes or conn['laddr'].port not in self.ports:
+                    continue
+                name = '%s:%d' % (protocol.rstrip('6'), conn['laddr'].port)
+                listener = listeners.setdefault(name, {'rx_queue': 0, 'drops': 0})
+                listener['rx_queue'] += conn['rx_queue']
+                listener['drops'] += conn['drops']
+        unix_inodes = dict((inode, path) for inode, path in self.read_unix_inodes().items() if inode in inodes)
+        if any(unix_inodes):
+            queues = unix_socket_queues(set(unix_inodes.values()))
+            for path in set(unix_inodes.values()):
+                listeners['unix:%s' % path] = {'rx_queue': queues.get(path, 0), 'drops': 0}
+        return listeners
+
+
+def get_io_per_event(profiling, nb_events, sent_bytes):
+    """Disk, syscall, fault and scheduling cost of every ingested event, per profiled process.
+
+    sent_bytes is what the writers sent, the events of a size distribution or a pool differ from event_size."""
+    io = {}
+    for procname, sampling in profiling.items():
+        if nb_events == 0:
+            continue
+        duration = max(sampling.get('duration', 0), 1e-3)
+        io[procname] = {
+            'write_bytes_per_event': sampling['write_bytes'] / nb_events,
+            # bytes reaching the disk for every byte of event received
+            'write_amplification': sampling['write_bytes'] / float(sent_bytes) if sent_bytes > 0 else 0.0,
+            'wchar_per_event': sampling['wchar'] / nb_events,
+            'read_syscalls_per_event': sampling['syscr'] / nb_events,
+            'write_syscalls_per_event': sampling['syscw'] / nb_events,
+            'minor_flt_per_event': sampling['minor_flt'] / nb_events,
+            'major_flt_per_event': sampling['major_flt'] / nb_events,
+            'voluntary_ctxt_per_s': sampling['voluntary_ctxt'] / duration,
+            'nonvoluntary_ctxt_per_s': sampling['nonvoluntary_ctxt'] / duration,
+        }
+    return io
+
+
+def get_drop_rate_curve(drops_series, nb_buckets=20):
+    """Reduce the cumulative counters of every listener to drops per second and the deepest receive queue
+    of at most nb_buckets intervals."""
+    if len(drops_series) < 2:
+        return {}
+    duration = float(drops_series[-1]['time'] - drops_series[0]['time'])
+    bucket_time = max(duration / nb_buckets, 1e-3)
+    curves = {}
+    for previous, entry in zip(drops_series, drops_series[1:]):
+        bucket = min(nb_buckets - 1, int((entry['time'] - drops_series[0]['time']) / bucket_time))
+        for name, drops in entry['drops'].items():
+            points = curves.setdefault(name, {})
+            point = points.setdefault(bucket, {'time': round(bucket * bucket_time, 1), 'drops': 0, 'max_rx_queue': 0})
+            point['drops'] += max(0, drops - previous['drops'].get(name, drops))
+            point['max_rx_queue'] = max(point['max_rx_queue'], entry.get('rx_queue', {}).get(name, 0))
+    for name, points in curves.items():
+        curves[name] = [points[bucket] for bucket in sorted(points)]
+        for point in curves[name]:
+            point['drops_per_s'] = round(point.pop('drops') / bucket_time, 2)
+    return curves
+
+
 def measure_page_faults(pid):
-    flts = [0, 0]
-    cmd = 'ps -o min_flt=,maj_flt= -p %s' % pid
-    lines = subprocess.Popen(cmd.split(' '), stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout.readlines()
-    if any(lines):
-        output = lines[0].strip('\n').strip().split(' ')
-        flts = map(int, filter(None, output))
-    return {'minor_flt': flts[0], 'major_flt': flts[1]}
+    with open('/proc/%d/stat' % pid) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return {'minor_flt': int(fields[7]), 'major_flt': int(fields[9])}
 
 
 def get_resources():
@@ -111,12 +421,18 @@ def get_threads_cpu_percent(p, total_percent):
 def measure(process, cpu_interval=0):
     result = dict()
     result['cpu'] = process.cpu_percent(cpu_interval)
-    mem = vars(process.memory_full_info())
-    result.update(mem)
-    # faults = measure_page_faults(process.pid)
-    # result.update(faults)
-    # io = vars(process.io_counters())
-    # result.update(io)
+    mem = process.memory_full_info()
+    result.update(mem._asdict())
+    result.update(measure_page_faults(process.pid))
+    try:
+        io = process.io_counters()
+        result.update({'syscr': io.read_count, 'syscw': io.write_count, 'read_bytes': io.read_bytes,
+                       'write_bytes': io.write_bytes, 'rchar': getattr(io, 'read_chars', None),
+                       'wchar': getattr(io, 'write_chars', None)})
+    except psutil.AccessDenied:
+        pass  # needs the same user or root
+    ctx = process.num_ctx_switches()
+    result.update({'voluntary_ctxt': ctx.voluntary, 'nonvoluntary_ctxt': ctx.involuntary})
     return result
 
 
@@ -135,7 +451,7 @@ def find_children_processes(processes):
     return list(set(processes))
 
 
-def profile(processes, profiler, cpu_interval=0):
+def profile(processes, store, cpu_interval=0):
     terminated_processes = []
     for process in processes:
         try:
@@ -143,26 +459,677 @@ def profile(processes, profiler, cpu_interval=0):
                 raise psutil.NoSuchProcess(process.pid, '')
 
             key = '%s-%d' % (process.name(), process.pid)
-            if key not in profiler:
-                profiler[key] = {'cpu': [], 'mem': [], 'minor_flt': [], 'major_flt': [], 'threads': {}}
+            now = time.time()
             result = measure(process, cpu_interval)
-            profiler[key]['cpu'].append(result['cpu'])
-            profiler[key]['mem'].append(result['rss'] / 10 ** 6)
-            # profiler[key]['mem'].append(result['pss'] / 10 ** 6)
-            # profiler[key]['minor_flt'].append(result['minor_flt'])
-            # profiler[key]['major_flt'].append(result['major_flt'])
-
-            for tid, value in get_threads_cpu_percent(process, result['cpu']).iteritems():
-                if tid not in profiler[key]['threads']:
-                    profiler[key]['threads'][tid] = []
-
-                profiler[key]['threads'][tid].append(value)
+            store.append(key, process.pid, 0, now, cpu=result['cpu'], rss=result['rss'], pss=result.get('pss'),
+                         minor_flt=result['minor_flt'], major_flt=result['major_flt'], read_bytes=result.get('read_bytes'),
+                         write_bytes=result.get('write_bytes'), rchar=result.get('rchar'), wchar=result.get('wchar'),
+                         syscr=result.get('syscr'), syscw=result.get('syscw'), voluntary_ctxt=result['voluntary_ctxt'],
+                         nonvoluntary_ctxt=result['nonvoluntary_ctxt'])
+
+            for name, value in get_threads_cpu_percent(process, result['cpu']).items():
+                store.append(name, process.pid, int(name.rsplit('-', 1)[1]), now, cpu=value)
         except psutil.NoSuchProcess:
             terminated_processes.append(process)
 
     for p in terminated_processes:
         processes.remove(p)
-    return processes, profiler
+    return processes, store
+
+
+class ProcSampler:
+    """Sample processes and their threads from /proc, keeping the files open between two samples.
+
+    Only raw counters are read: clock ticks from stat, resident pages from statm, Pss from smaps_rollup
+    and the io accounting. CPU percentages are computed from the tick deltas between two samples.
+    """
+    CLK_TCK = float(os.sysconf('SC_CLK_TCK'))
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+    def __init__(self, read_pss=True):
+        self.read_pss = read_pss
+        self.files = {}
+        self.previous = {}
+
+    def read(self, path):
+        fd = self.files.get(path)
+        if fd is None:
+            fd = os.open(path, os.O_RDONLY)
+            self.files[path] = fd
+        else:
+            os.lseek(fd, 0, os.SEEK_SET)
+        return os.read(fd, 4096).decode('ASCII', 'replace')
+
+    def close(self, prefix):
+        for path in [p for p in self.files if p.startswith(prefix)]:
+            os.close(self.files.pop(path))
+        for key in [k for k in self.previous if k.startswith(prefix)]:
+            del self.previous[key]
+
+    def close_all(self):
+        self.close('/proc/')
+
+    def read_stat(self, path):
+        data = self.read(path)
+        # the command name may contain spaces, the fields are after the last parenthesis
+        name = data[data.index('(') + 1:data.rindex(')')]
+        fields = data[data.rindex(')') + 2:].split()
+        return {
+            'name': name,
+            'minor_flt': int(fields[7]),
+            'major_flt': int(fields[9]),
+            'utime': int(fields[11]),
+            'stime': int(fields[12]),
+        }
+
+    def get_cpu_percent(self, path, utime, stime, now):
+        """CPU % since the previous sample of path, with the utime and stime ticks it is computed from."""
+        previous = self.previous.get(path)
+        self.previous[path] = (utime, stime, now)
+        if previous is None or now <= previous[2]:
+            return 0.0, 0, 0
+        delta_utime, delta_stime = utime - previous[0], stime - previous[1]
+        return (round(100.0 * (delta_utime + delta_stime) / self.CLK_TCK / (now - previous[2]), 2), delta_utime,
+                delta_stime)
+
+    def read_pss_kb(self, pid):
+        try:
+            for line in self.read('/proc/%d/smaps_rollup' % pid).splitlines():
+                if line.startswith('Pss:'):
+                    return int(line.split()[1])
+        except (IOError, OSError):
+            self.read_pss = False  # kernel older than 4.14
+        return None
+
+    def read_ctxt_switches(self, pid):
+        switches = {}
+        for line in self.read('/proc/%d/status' % pid).splitlines():
+            if line.startswith('voluntary_ctxt_switches:'):
+                switches['voluntary_ctxt'] = int(line.split()[1])
+            elif line.startswith('nonvoluntary_ctxt_switches:'):
+                switches['nonvoluntary_ctxt'] = int(line.split()[1])
+        return switches
+
+    def read_io(self, pid):
+        try:
+            return dict((k, int(v)) for k, v in (line.split(': ') for line in self.read('/proc/%d/io' % pid).splitlines()))
+        except (IOError, OSError):
+            return {}  # needs the same user or root
+
+    def sample_threads(self, pid, now):
+        threads = {}
+        task_dir = '/proc/%d/task' % pid
+        tids = set(int(tid) for tid in os.listdir(task_dir))
+        for path in [p for p in self.files if p.startswith(task_dir + '/')]:
+            if int(path.split('/')[4]) not in tids:
+                self.close('%s/%s/' % (task_dir, path.split('/')[4]))
+        for tid in tids:
+            path = '%s/%d/stat' % (task_dir, tid)
+            try:
+                stat = self.read_stat(path)
+            except (IOError, OSError):
+                continue  # thread exited meanwhile
+            threads['%s-%d' % (stat['name'], tid)] = self.get_cpu_percent(path, stat['utime'], stat['stime'], now)
+        return threads
+
+    def sample(self, pid):
+        now = time.time()
+        path = '/proc/%d/stat' % pid
+        stat = self.read_stat(path)
+        result = dict(stat)
+        result['cpu'], result['utime_ticks'], result['stime_ticks'] = self.get_cpu_percent(path, stat['utime'],
+                                                                                            stat['stime'], now)
+        result['rss'] = int(self.read('/proc/%d/statm' % pid).split()[1]) * self.PAGE_SIZE
+        pss_kb = self.read_pss_kb(pid) if self.read_pss else None
+        result['pss'] = pss_kb * 1024 if pss_kb is not None else None
+        result['io'] = self.read_io(pid)
+        result.update(self.read_ctxt_switches(pid))
+        result['threads'] = self.sample_threads(pid, now)
+        return result
+
+    def profile(self, processes, store):
+        terminated_processes = []
+        for process in processes:
+            try:
+                now = time.time()
+                result = self.sample(process.pid)
+            except (IOError, OSError):
+                self.close('/proc/%d/' % process.pid)
+                terminated_processes.append(process)
+                continue
+
+            key = '%s-%d' % (result['name'], process.pid)
+            io = result['io']
+            store.append(key, process.pid, 0, now, cpu=result['cpu'], utime_ticks=result['utime_ticks'],
+                         stime_ticks=result['stime_ticks'], rss=result['rss'], pss=result['pss'],
+                         minor_flt=result['minor_flt'], major_flt=result['major_flt'],
+                         read_bytes=io.get('read_bytes'), write_bytes=io.get('write_bytes'), rchar=io.get('rchar'),
+                         wchar=io.get('wchar'), syscr=io.get('syscr'), syscw=io.get('syscw'),
+                         voluntary_ctxt=result.get('voluntary_ctxt'), nonvoluntary_ctxt=result.get('nonvoluntary_ctxt'))
+            for name, (cpu, utime_ticks, stime_ticks) in result['threads'].items():
+                store.append(name, process.pid, int(name.rsplit('-', 1)[1]), now, cpu=cpu, utime_ticks=utime_ticks,
+                             stime_ticks=stime_ticks)
+
+        for p in terminated_processes:
+            processes.remove(p)
+        return processes, store
+
+
+def describe(values):
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return {'mean': 0, 'std': 0, 'p50': 0, 'p95': 0, 'p99': 0, 'max': 0}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'mean': float(np.mean(values)), 'std': float(np.std(values)), 'p50': float(p50), 'p95': float(p95),
+            'p99': float(p99), 'max': float(np.max(values))}
+
+
+def get_increase(values):
+    values = values[~np.isnan(values)]
+    return float(np.max(values) - np.min(values)) if len(values) > 0 else 0
+
+
+def get_bucket_medians(timestamps, values, nb_buckets=200):
+    """Median time and value of consecutive buckets, to smooth the spikes and bound the pairs of Theil-Sen."""
+    valid = ~np.isnan(values)
+    timestamps, values = timestamps[valid], values[valid]
+    buckets = [b for b in zip(np.array_split(timestamps, min(nb_buckets, len(timestamps))),
+                              np.array_split(values, min(nb_buckets, len(values)))) if len(b[0]) > 0]
+    return np.array([np.median(t) for t, v in buckets]), np.array([np.median(v) for t, v in buckets])
+
+
+def theil_sen(x, y):
+    """Median of the pairwise slopes, with its 95% confidence interval from the variance of Kendall's tau (Sen 1968).
+
+    The samples of a run are autocorrelated, the interval is only meaningful on bucket medians spread over hours.
+    """
+    n = len(x)
+    i, j = np.triu_indices(n, 1)
+    dx = x[j] - x[i]
+    valid = dx != 0
+    slopes = np.sort((y[j] - y[i])[valid] / dx[valid])
+    if len(slopes) == 0:
+        return 0.0, 0.0, 0.0
+    c = 1.96 * math.sqrt(n * (n - 1) * (2 * n + 5) / 18.0)
+    low = int(max(0, math.floor((len(slopes) - c) / 2.0)))
+    high = int(min(len(slopes) - 1, math.ceil((len(slopes) + c) / 2.0)))
+    return float(np.median(slopes)), float(slopes[low]), float(slopes[high])
+
+
+def get_memory_trend(timestamps, values, leak_threshold):
+    """Growth of a memory column in MB/hour over the whole soak and over its second half.
+
+    A warm cache grows then flattens, a leak keeps growing: the growth is a leak only when the lower bound of
+    the interval and the second half are both above leak_threshold MB/hour.
+    """
+    hours, mb = get_bucket_medians((timestamps - timestamps[0]) / 3600.0, values / 10 ** 6)
+    if len(hours) < 4:
+        return {}
+    slope, ci_low, ci_high = theil_sen(hours, mb)
+    second_half = hours >= hours[-1] / 2.0
+    second_half_slope = theil_sen(hours[second_half], mb[second_half])[0]
+    if ci_low > leak_threshold:
+        verdict = 'leak' if second_half_slope > leak_threshold else 'warming'
+    else:
+        verdict = 'stable'
+    return {'mb_per_hour': slope, 'ci_low': ci_low, 'ci_high': ci_high, 'second_half_mb_per_hour': second_half_slope,
+            'start_mb': float(mb[0]), 'end_mb': float(mb[-1]), 'verdict': verdict}
+
+
+def find_cpu_spikes(timestamps, cpu, min_delta=5.0, nb_mads=5.0):
+    """Start time and peak of every run of samples above the median by nb_mads robust deviations and min_delta %."""
+    valid = ~np.isnan(cpu)
+    timestamps, cpu = timestamps[valid], cpu[valid]
+    if len(cpu) == 0:
+        return []
+    median = np.median(cpu)
+    mad = np.median(np.abs(cpu - median)) * 1.4826
+    above = cpu > median + max(nb_mads * mad, min_delta)
+    spikes = []
+    for i in np.flatnonzero(above):
+        if i > 0 and above[i - 1]:
+            spikes[-1]['peak'] = max(spikes[-1]['peak'], float(cpu[i]))
+        else:
+            spikes.append({'time': float(timestamps[i]), 'peak': float(cpu[i])})
+    return spikes
+
+
+def get_period(times, max_deviation=0.25):
+    """Median interval of events recurring at a regular interval, None when they are not periodic.
+
+    The median absolute deviation tolerates a few missed or extra events.
+    """
+    if len(times) < 4:
+        return None
+    intervals = np.diff(times)
+    median = float(np.median(intervals))
+    return median if median > 0 and np.median(np.abs(intervals - median)) / median < max_deviation else None
+
+
+class SampleStore:
+    """Columnar store of the profiling samples.
+
+    Each sample is a row of float64 COLUMNS written into a preallocated block. Full blocks are appended to a
+    binary file of raw rows, so long runs keep a bounded memory; the column and name index are saved next to
+    it as JSON. Process rows have tid=0; thread rows only fill the cpu columns and share the pid of their process.
+    utime_ticks and stime_ticks are the ticks since the previous sample the cpu % is derived from, clk_tck in the
+    index converts them to seconds.
+    """
+    COLUMNS = ['timestamp', 'name', 'pid', 'tid', 'cpu', 'utime_ticks', 'stime_ticks', 'rss', 'pss', 'minor_flt',
+               'major_flt', 'read_bytes', 'write_bytes', 'rchar', 'wchar', 'syscr', 'syscw', 'voluntary_ctxt',
+               'nonvoluntary_ctxt']
+    COLUMN_IDS = dict((name, i) for i, name in enumerate(COLUMNS))
+    # cumulative counters, summarized by their increase over the run
+    COUNTERS = COLUMNS[COLUMNS.index('minor_flt'):]
+    BLOCK_ROWS = 4096
+
+    def __init__(self, path=None):
+        self.path = path
+        self.names = []  # the name column holds an index in this list
+        self.name_ids = {}
+        self.blocks = []  # full blocks kept in memory when there is no file
+        self.block = np.empty((self.BLOCK_ROWS, len(self.COLUMNS)))
+        self.nb_rows = 0
+        self.nb_saved_rows = 0
+        if self.path is not None:
+            open(self.path, 'wb').close()
+
+    def get_name_id(self, name):
+        if name not in self.name_ids:
+            self.name_ids[name] = len(self.names)
+            self.names.append(name)
+        return self.name_ids[name]
+
+    def append(self, name, pid, tid, timestamp, cpu, **values):
+        row = self.block[self.nb_rows]
+        row[:] = np.nan
+        row[:5] = (timestamp, self.get_name_id(name), pid, tid, cpu)
+        for column, value in values.items():
+            if value is not None:
+                row[self.COLUMN_IDS[column]] = value
+        self.nb_rows += 1
+        if self.nb_rows == self.BLOCK_ROWS:
+            self.flush()
+
+    def extend(self, names, rows):
+        rows = rows.copy()
+        if len(rows) > 0:
+            name_ids = np.array([self.get_name_id(name) for name in names])
+            rows[:, 1] = name_ids[rows[:, 1].astype(int)]
+        for row in rows:
+            self.block[self.nb_rows] = row
+            self.nb_rows += 1
+            if self.nb_rows == self.BLOCK_ROWS:
+                self.flush()
+
+    def take(self):
+        rows = np.concatenate(self.blocks + [self.block[:self.nb_rows]])
+        self.blocks = []
+        self.nb_rows = 0
+        return list(self.names), rows
+
+    def flush(self):
+        if self.nb_rows == 0:
+            return
+        if self.path is None:
+            self.blocks.append(self.block[:self.nb_rows].copy())
+        else:
+            with open(self.path, 'ab') as f:
+                self.block[:self.nb_rows].astype('<f8').tofile(f)
+            self.nb_saved_rows += self.nb_rows
+        self.nb_rows = 0
+
+    def close(self):
+        self.flush()
+        if self.path is not None:
+            with open(self.path + '.json', 'w') as f:
+                json.dump(self.get_index(), f)
+
+    def get_index(self):
+        return {'path': self.path, 'columns': self.COLUMNS, 'names': self.names, 'rows': self.nb_saved_rows,
+                'clk_tck': os.sysconf('SC_CLK_TCK')}
+
+    def get_rows(self):
+        blocks = list(self.blocks) + [self.block[:self.nb_rows]]
+        if self.path is not None and self.nb_saved_rows > 0:
+            saved = np.memmap(self.path, dtype='<f8', mode='r', shape=(self.nb_saved_rows, len(self.COLUMNS)))
+            blocks.insert(0, saved)
+        return np.concatenate(blocks)
+
+    def summarize(self):
+        rows = self.get_rows()
+        column = self.COLUMN_IDS
+        summary = {}
+        process_rows = rows[rows[:, column['tid']] == 0]
+        for name_id in np.unique(process_rows[:, column['name']]):
+            samples = process_rows[process_rows[:, column['name']] == name_id]
+            pid = samples[0, column['pid']]
+            thread_rows = rows[(rows[:, column['pid']] == pid) & (rows[:, column['tid']] != 0)]
+            threads = {}
+            for tid in np.unique(thread_rows[:, column['tid']]):
+                thread_samples = thread_rows[thread_rows[:, column['tid']] == tid]
+                threads[self.names[int(thread_samples[-1, column['name']])]] = describe(thread_samples[:, column['cpu']])
+            summary[self.names[int(name_id)]] = {
+                'samples': len(samples),
+                'duration': float(samples[-1, column['timestamp']] - samples[0, column['timestamp']]),
+                'cpu': describe(samples[:, column['cpu']]),
+                'mem': describe(samples[:, column['rss']] / 10 ** 6),
+                'pss': describe(samples[:, column['pss']] / 10 ** 6),
+                'last_mem': float(samples[-1, column['rss']] / 10 ** 6),
+                'threads': threads,
+            }
+            for counter in self.COUNTERS:
+                summary[self.names[int(name_id)]][counter] = get_increase(samples[:, column[counter]])
+        return summary
+
+    def analyze_soak(self, warmup, sampling_rate, leak_threshold):
+        """Memory trend and CPU spikes of every process after the warmup.
+
+        OMS::BackgroundJobs#run_garbage_collection forces a GC right before forking a job, so a spike of a process
+        at the time a new child process shows up is attributed to it. The other spikes recurring at a regular
+        interval are reported as periodic, the signature of the Ruby GC or of a timer.
+        """
+        rows = self.get_rows()
+        column = self.COLUMN_IDS
+        process_rows = rows[rows[:, column['tid']] == 0]
+        if len(process_rows) == 0:
+            return {}
+        begin_time = float(np.min(process_rows[:, column['timestamp']]))
+        first_seen = [float(np.min(process_rows[process_rows[:, column['name']] == name_id, column['timestamp']]))
+                      for name_id in np.unique(process_rows[:, column['name']])]
+        fork_times = np.array(sorted(t for t in first_seen if t > begin_time + 1.5 * sampling_rate))
+        report = {'warmup_s': warmup, 'leak_threshold_mb_per_hour': leak_threshold, 'forks': len(fork_times),
+                  'processes': {}}
+        for name_id in np.unique(process_rows[:, column['name']]):
+            samples = process_rows[process_rows[:, column['name']] == name_id]
+            samples = samples[samples[:, column['timestamp']] >= begin_time + warmup]
+            if len(samples) < 10:
+                continue  # a short lived job
+            timestamps = samples[:, column['timestamp']]
+            spikes = find_cpu_spikes(timestamps, samples[:, column['cpu']])
+            for spike in spikes:
+                spike['fork'] = bool(len(fork_times) > 0 and
+                                     np.min(np.abs(fork_times - spike['time'])) <= 1.5 * sampling_rate)
+            other_spikes = [spike['time'] for spike in spikes if not spike['fork']]
+            report['processes'][self.names[int(name_id)]] = {
+                'hours': float(timestamps[-1] - timestamps[0]) / 3600,
+                'rss': get_memory_trend(timestamps, samples[:, column['rss']], leak_threshold),
+                'pss': get_memory_trend(timestamps, samples[:, column['pss']], leak_threshold),
+                'cpu_spikes': len(spikes),
+                'fork_spikes': len(spikes) - len(other_spikes),
+                'spike_period_s': get_period(other_spikes),
+                'max_spike_cpu': max([spike['peak'] for spike in spikes] or [0]),
+                'spikes': spikes,
+            }
+        return report
+
+
+def run_background_sampler(loadbench, processes, writers, sampling_rate, stop_event, queue):
+    store = SampleStore()
+    monitor = loadbench.get_listener_monitor()
+    buffer_monitor = loadbench.get_buffer_monitor()
+    drops = []
+    buffers = []
+    begin_time = time.time()
+    next_time = begin_time
+    last_flush_time = begin_time
+    try:
+        while not stop_event.is_set():
+            processes = loadbench.clear_dead_process(processes)
+            processes = find_children_processes(processes)
+            processes, store = loadbench.profile(processes, store)
+            listeners = monitor.sample([p.pid for p in processes])
+            if any(listeners):
+                drops.append({'time': round(time.time() - begin_time, 3),
+                              'drops': dict((name, l['drops']) for name, l in listeners.items()),
+                              'rx_queue': dict((name, l['rx_queue']) for name, l in listeners.items())})
+            else:
+                # sockets not visible, e.g. not running as root: match the writers' destination by address
+                drops.append({'time': round(time.time() - begin_time, 3),
+                              'drops': dict((w.get_name(), w.get_number_dropped_event()) for w in writers)})
+            buffers.append({'time': round(time.time() - begin_time, 3), 'buffers': buffer_monitor.sample()})
+
+            # send the samples regularly so that nothing big accumulates in the sampler
+            if time.time() - last_flush_time >= BackgroundSampler.FLUSH_INTERVAL:
+                queue.put({'samples': store.take(), 'drops': drops, 'buffers': buffers})
+                drops, buffers = [], []
+                last_flush_time = time.time()
+
+            next_time += sampling_rate
+            stop_event.wait(max(0, next_time - time.time()))
+        queue.put({'samples': store.take(), 'drops': drops, 'buffers': buffers, 'pids': [p.pid for p in processes],
+                   'buffer_summary': buffer_monitor.get_summary()})
+    finally:
+        queue.put(None)
+
+
+class BackgroundSampler:
+    """Profile the processes and sample the socket drops from another process, with its own clock,
+    so that the observation never delays the load pacing."""
+    FLUSH_INTERVAL = 5
+
+    def __init__(self, loadbench, processes, writers, sampling_rate, samples_path=None):
+        self.loadbench = loadbench
+        self.processes = processes
+        self.writers = writers
+        self.sampling_rate = sampling_rate
+        self.queue = multiprocessing.Queue()
+        self.stop_event = multiprocessing.Event()
+        self.process = None
+        self.reader = None
+        self.store = SampleStore(samples_path)
+        self.drops = []
+        self.buffers = []
+        self.buffer_summary = {}
+        self.pids = [p.pid for p in processes]
+
+    def start(self):
+        self.process = multiprocessing.Process(target=run_background_sampler,
+                                               args=(self.loadbench, self.processes, self.writers, self.sampling_rate,
+                                                     self.stop_event, self.queue))
+        self.process.daemon = True
+        self.process.start()
+        self.reader = threading.Thread(target=self.read_samples)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def read_samples(self):
+        while True:
+            samples = self.queue.get()
+            if samples is None:
+                break
+            self.store.extend(*samples['samples'])
+            self.drops += samples['drops']
+            self.buffers += samples['buffers']
+            if 'buffer_summary' in samples:
+                self.buffer_summary = samples['buffer_summary']
+            if 'pids' in samples:
+                self.pids = samples['pids']
+
+    def stop(self):
+        self.stop_event.set()
+        while self.reader.is_alive():
+            self.reader.join(0.5)
+            if not self.process.is_alive() and self.reader.is_alive():
+                self.queue.put(None)  # the sampler died without saying goodbye
+        self.process.join()
+        self.store.close()
+        return self.store
+
+
+def split_eps(eps, nb_workers):
+    shares = [eps // nb_workers] * nb_workers
+    for i in range(eps % nb_workers):
+        shares[i] += 1
+    return shares
+
+
+class TokenBucketPacer:
+    """Spread the events evenly over each second instead of sending them in one burst."""
+    MAX_LAG_SAMPLES = 10000
+
+    def __init__(self, eps, burst_size=10, tick=0.0005):
+        self.eps = float(eps)
+        self.burst_size = max(1, int(burst_size))
+        self.tick = tick
+        self.begin_time = None
+        self.nb_events = 0
+        self.nb_batches = 0
+        self.max_lag = 0.0
+        self.lag_samples = []
+
+    def start(self):
+        self.begin_time = time.time()
+
+    def record_lag(self, lag):
+        # reservoir sampling keeps the percentiles meaningful for long runs without growing forever
+        self.nb_batches += 1
+        self.max_lag = max(self.max_lag, lag)
+        if len(self.lag_samples) < self.MAX_LAG_SAMPLES:
+            self.lag_samples.append(lag)
+        else:
+            i = random.randint(0, self.nb_batches - 1)
+            if i < self.MAX_LAG_SAMPLES:
+                self.lag_samples[i] = lag
+
+    def next_batch(self, remaining_events):
+        """Wait until enough tokens are available and return the number of events to send now."""
+        if self.begin_time is None:
+            self.start()
+        intended_time = self.begin_time + self.nb_events / self.eps
+        delay = intended_time - time.time()
+        if delay > self.tick:
+            time.sleep(delay - self.tick)
+        # busy wait the last tick, time.sleep() is not accurate enough below the millisecond
+        while time.time() < intended_time:
+            pass
+        self.record_lag(max(0.0, time.time() - intended_time))
+        # the bucket starts full, when behind schedule the batches are sent back to back until caught up
+        batch = min(self.burst_size, remaining_events)
+        self.nb_events += batch
+        return batch
+
+    def get_lag_stats(self):
+        return summarize_lags(self.lag_samples, self.max_lag, self.nb_batches)
+
+
+def summarize_lags(lag_samples, max_lag, nb_batches):
+    return {
+        'batches': nb_batches,
+        'p50_ms': percentile(lag_samples, 50) * 1000,
+        'p99_ms': percentile(lag_samples, 99) * 1000,
+        'max_ms': max_lag * 1000,
+    }
+
+
+def send_paced_load(writers, eps, run_time, burst_size, tick):
+    total_events = run_time * eps
+    nb_events = 0
+    pacer = TokenBucketPacer(eps, burst_size, tick)
+    pacer.start()
+    while nb_events < total_events:
+        batch = pacer.next_batch(total_events - nb_events)
+        for writer in writers:
+            writer.write(eps=batch)
+        nb_events += batch
+    return nb_events, pacer
+
+
+def run_load_worker(worker_id, constants, plugins, eps, run_time, pacing, queue):
+    # each worker builds its own writers so that sockets and counters are not shared between processes
+    config_mgr = ConfigManager(constants)
+    writers = config_mgr.get_writers_by_name(plugins)
+    nb_events = 0
+    result = {'worker': worker_id, 'eps': eps}
+    begin_time = time.time()
+    if pacing['mode'] == 'token':
+        nb_events, pacer = send_paced_load(writers, eps, run_time, pacing['burst_size'], pacing['tick'])
+        result.update({'lag_samples': pacer.lag_samples, 'max_lag': pacer.max_lag, 'nb_batches': pacer.nb_batches})
+    else:
+        for second in range(run_time):
+            second_begin = time.time()
+            for writer in writers:
+                writer.write(eps=eps)
+            nb_events += eps
+            sleep_time = 1 - (time.time() - second_begin)
+            if sleep_time > 0:
+                time.sleep(sleep_time)
+    # the asynchronous writers finish sending before their counters are read
+    for writer in writers:
+        writer.close()
+    result.update({'nb_events': nb_events, 'elapsed_time': time.time() - begin_time,
+                   'send_stats': dict((w.get_name(), w.get_send_stats()) for w in writers)})
+    queue.put(result)
+
+
+class EventPool:
+    """Events drawn once from the size distribution and the field cardinalities, then reused round-robin by the
+    writers so that no random draw or string building happens while sending.
+
+    The messages are slices of one random block, so that their content differs without generating every one.
+    Hostnames, idents, facilities and severities are picked with Zipf weights of exponent skew, 0 being uniform.
+    """
+    MAX_SIZE = 64 * 1024  # an udp datagram
+    FACILITIES = ['user', 'local0', 'local1', 'local2', 'local3', 'local4', 'local5', 'local6', 'local7', 'daemon',
+                  'auth', 'authpriv', 'syslog', 'cron', 'mail', 'kern']
+    SEVERITIES = ['info', 'notice', 'warning', 'err', 'debug', 'crit', 'alert', 'emerg']
+
+    def __init__(self, draw_size, cardinalities, skew=0.0, seed=0, pool_size=4096):
+        rnd = random.Random(seed)
+        block = ''.join(rnd.choice(string.ascii_uppercase + string.digits) for _ in range(self.MAX_SIZE))
+        hostname = gethostname()
+        values = {
+            'hostname': [hostname] if cardinalities['hostname'] == 1 else
+                        ['%s-%d' % (hostname, i) for i in range(cardinalities['hostname'])],
+            'ident': ['omstest'] if cardinalities['ident'] == 1 else
+                     ['omstest%d' % i for i in range(cardinalities['ident'])],
+            'facility': self.FACILITIES[:cardinalities['facility']],
+            'severity': self.SEVERITIES[:cardinalities['severity']],
+        }
+        cumulative = dict((field, get_cumulative_weights([1.0 / (i + 1) ** skew for i in range(len(choices))]))
+                          for field, choices in values.items())
+        self.messages = []
+        self.priorities = []
+        self.hostnames = []
+        self.idents = []
+        for i in range(pool_size):
+            size = max(1, min(self.MAX_SIZE, draw_size(rnd)))
+            offset = rnd.randint(0, self.MAX_SIZE - size)
+            self.messages.append('msg_' + block[offset:offset + size])
+            facility = weighted_choice(rnd, values['facility'], cumulative['facility'])
+            severity = weighted_choice(rnd, values['severity'], cumulative['severity'])
+            self.priorities.append('<%d>' % ((SysLogHandler.facility_names[facility] << 3) |
+                                             SysLogHandler.priority_names[severity]))
+            self.hostnames.append(weighted_choice(rnd, values['hostname'], cumulative['hostname']))
+            self.idents.append(weighted_choice(rnd, values['ident'], cumulative['ident']))
+        self.varies_headers = any(cardinality > 1 for cardinality in cardinalities.values())
+
+    def __len__(self):
+        return len(self.messages)
+
+    @staticmethod
+    def slice(values, start, count):
+        result = values[start:start + count]
+        while len(result) < count:
+            result += values[:count - len(result)]
+        return result
+
+    def describe(self):
+        sizes = [len(message) for message in self.messages]
+        return ("Event pool: %d events, size min=%d p50=%d p99=%d max=%d, %d hostnames, %d idents, %d priorities" %
+                (len(sizes), min(sizes), percentile(sizes, 50), percentile(sizes, 99), max(sizes),
+                 len(set(self.hostnames)), len(set(self.idents)), len(set(self.priorities))))
+
+
+def get_event_pool(constants):
+    """The pool of the configured distributions, None for a fixed size and single valued fields."""
+    cardinalities = dict((field, int(constants['%s_cardinality' % field]))
+                         for field in ('hostname', 'ident', 'facility', 'severity'))
+    if constants['event_size_distribution'] == 'fixed' and all(c == 1 for c in cardinalities.values()):
+        return None
+    draw_size = parse_size_distribution(constants['event_size_distribution'], int(constants['event_size']))
+    return EventPool(draw_size, cardinalities, float(constants['cardinality_skew']), int(constants['random_seed']),
+                     int(constants['pool_size']))
 
 
 class OutputWriter:
@@ -173,6 +1140,16 @@ class OutputWriter:
         self.msg_size = msg_size
         self.name = name
         self.msg = build_random_msg_string(self.msg_size)
+        self.stamp_events = False
+        self.pool = None
+        self.pool_position = 0
+
+    def get_messages(self, count):
+        if self.pool is None:
+            return [self.msg] * count
+        messages = EventPool.slice(self.pool.messages, self.pool_position, count)
+        self.pool_position = (self.pool_position + count) % len(self.pool)
+        return messages
 
     def __str__(self):
         self.name()
@@ -189,14 +1166,45 @@ class OutputWriter:
     def get_number_dropped_event(self):
         return 0
 
+    def get_send_stats(self):
+        return {}
+
+    def close(self):
+        pass
+
+    def get_writer_id(self):
+        # unique per process so that sharded workers do not share sequences
+        return '%s.%d' % (self.get_name(), os.getpid())
+
+    def get_stamp(self, index, send_time_ms):
+        return format_stamp(self.get_writer_id(), index, send_time_ms)
+
 
 class MsgPackWriter(OutputWriter):
-    def __init__(self, tag, path, msg_size):
+    """Send the events to in_forward, one per message or batched by entries per Forward message.
+
+    The paced writes hand over a few events at a time, the entries are collected across writes until a message is
+    full or its first entry has waited MAX_DELAY_S."""
+    # event modes of the fluentd forward protocol
+    MODES = ['message', 'forward', 'packed_forward', 'compressed_packed_forward']
+    MAX_DELAY_S = 0.1
+
+    def __init__(self, tag, path, msg_size, mode='message', entries=100):
         OutputWriter.__init__(self, 'msgpack', tag, path, msg_size)
         self.protocol = 'tcp'
         self.host, port = self.path.split(':')
         self.port = int(port)
         self.fluent_sender = None
+        if mode not in self.MODES:
+            raise ValueError("Unknown forward mode '%s', available modes: %s" % (mode, ', '.join(self.MODES)))
+        self.mode = mode
+        self.entries = max(1, entries)
+        self.forward_cache = {}
+        self.pending = []  # records of the next Forward message
+        self.pending_time = None
+        self.nb_events = 0
+        self.nb_messages = 0
+        self.nb_bytes = 0
 
     def get_protocol(self):
         return self.protocol
@@ -211,25 +1219,109 @@ class MsgPackWriter(OutputWriter):
                 break
         return dropped_events
 
+    def get_send_stats(self):
+        return {'events': self.nb_events, 'syscalls': self.nb_messages, 'bytes': self.nb_bytes, 'errors': 0}
+
+    def build_forward_message(self, event_time, records):
+        """Build a Forward, PackedForward or CompressedPackedForward message."""
+        import msgpack
+        if self.mode == 'forward':
+            return msgpack.packb([self.tag, [[event_time, record] for record in records]])
+
+        entries = b''.join(msgpack.packb([event_time, record]) for record in records)
+        option = {'size': len(records)}
+        if self.mode == 'compressed_packed_forward':
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            entries = compressor.compress(entries) + compressor.flush()
+            option['compressed'] = 'gzip'
+        return msgpack.packb([self.tag, entries, option])
+
+    def get_forward_message(self, event_time, nb_entries):
+        key = (event_time, nb_entries)
+        if key in self.forward_cache:
+            return self.forward_cache[key]
+
+        message = self.build_forward_message(event_time, [self.msg] * nb_entries)
+        # messages are only reused within the same second
+        if len(self.forward_cache) > 16:
+            self.forward_cache = {}
+        self.forward_cache[key] = message
+        return message
+
+    def get_stamped_records(self, nb_records, send_time_ms):
+        records = ['%s %s' % (self.get_stamp(self.index + i, send_time_ms), message)
+                   for i, message in enumerate(self.get_messages(nb_records))]
+        self.index += nb_records
+        return records
+
     def write(self, eps, override_buffer=None):
         import msgpack
         from fluent import sender
         if self.fluent_sender is None:
             self.fluent_sender = sender.FluentSender(self.tag, host=self.host, port=self.port)
-        self.msgpack_msg = msgpack.packb((self.tag, int(time.time()), self.msg), **{})
 
         if override_buffer is not None:
             self.msg = override_buffer
-            self.msgpack_msg = msgpack.packb((self.tag, int(time.time()), self.msg), **{})
+            self.forward_cache = {}
+
+        now = time.time()
+        event_time = int(now)
+        if self.mode == 'message':
+            if self.stamp_events:
+                messages = [msgpack.packb((self.tag, event_time, record), **{})
+                            for record in self.get_stamped_records(eps, int(now * 1000))]
+            elif self.pool is not None:
+                messages = [msgpack.packb((self.tag, event_time, record), **{}) for record in self.get_messages(eps)]
+            else:
+                self.msgpack_msg = msgpack.packb((self.tag, event_time, self.msg), **{})
+                messages = [self.msgpack_msg] * eps
+            for message in messages:
+                self.fluent_sender._send_internal(message)
+                self.nb_bytes += len(message)
+            self.nb_messages += eps
+            self.nb_events += eps
+            return
+
+        if len(self.pending) == 0:
+            self.pending_time = now
+        if self.stamp_events:
+            self.pending += self.get_stamped_records(eps, int(now * 1000))
+        elif self.pool is not None:
+            self.pending += self.get_messages(eps)
+        else:
+            self.pending += [self.msg] * eps
+        while len(self.pending) >= self.entries:
+            self.send_forward(event_time, self.pending[:self.entries])
+            self.pending = self.pending[self.entries:]
+            self.pending_time = now
+        if len(self.pending) > 0 and now - self.pending_time >= self.MAX_DELAY_S:
+            self.send_forward(event_time, self.pending)
+            self.pending = []
+
+    def send_forward(self, event_time, records):
+        if self.stamp_events or self.pool is not None:
+            message = self.build_forward_message(event_time, records)
+        else:
+            message = self.get_forward_message(event_time, len(records))
+        self.fluent_sender._send_internal(message)
+        self.nb_messages += 1
+        self.nb_bytes += len(message)
+        self.nb_events += len(records)
 
-        for i in range(eps):
-            self.fluent_sender._send_internal(self.msgpack_msg)
+    def close(self):
+        if len(self.pending) > 0:
+            self.send_forward(int(time.time()), self.pending)
+            self.pending = []
 
 
 class TailFileWriter(OutputWriter):
     def __init__(self, tag, path, msg_size):
         OutputWriter.__init__(self, 'file', tag, path, msg_size)
         self.max_file_size = 10 * 1024 * 1024 * 1024  # 10 GB
+        self.nb_bytes = 0
+
+    def get_send_stats(self):
+        return {'bytes': self.nb_bytes}
 
     def get_protocol(self):
         return 'file'
@@ -242,15 +1334,21 @@ class TailFileWriter(OutputWriter):
             if os.stat(self.path).st_size > self.max_file_size:
                 with open(self.path, "w"):
                     pass
-        self.write_in_tail(self.msg, self.path, eps)
+        self.write_in_tail(self.get_messages(eps), self.path)
 
-    def write_in_tail(self, line, path, num_lines=1):
+    def write_in_tail(self, messages, path):
         lines = []
-        for i in range(num_lines):
-            lines.append('%d-%s-%s\n' % (self.index, self.get_name(), line))
+        send_time_ms = int(time.time() * 1000)
+        for line in messages:
+            if self.stamp_events:
+                lines.append('%d-%s-%s %s\n' % (self.index, self.get_name(), self.get_stamp(self.index, send_time_ms),
+                                                line))
+            else:
+                lines.append('%d-%s-%s\n' % (self.index, self.get_name(), line))
             self.index += 1
         with open(path, "a") as myfile:
             myfile.writelines(lines)
+        self.nb_bytes += sum(len(line) for line in lines)
 
 
 class RFC5424Formatter(logging.Formatter, object):
@@ -305,13 +1403,16 @@ class MySysLogHandler(SysLogHandler):
                  facility=SysLogHandler.LOG_USER, socktype=None):
         SysLogHandler.__init__(self, address, facility, socktype)
         self.include_priority = True
+        self.nb_bytes = 0
 
     def emit(self, record):
         try:
             msg = self.format(record)
 
             if self.include_priority:
-                msg = '<%d>%s' % (self.encodePriority(self.facility, self.mapPriority(record.levelname)), msg)
+                # the formatters return bytes, a str prefix would embed their repr under python 3
+                priority = self.encodePriority(self.facility, self.mapPriority(record.levelname))
+                msg = ('<%d>' % priority).encode('ASCII') + msg
 
             if self.unixsocket:
                 try:
@@ -324,14 +1425,327 @@ class MySysLogHandler(SysLogHandler):
                 self.socket.sendto(msg, self.address)
             else:
                 self.socket.sendall(msg)
+            self.nb_bytes += len(msg)
         except (KeyboardInterrupt, SystemExit):
             raise
         except:
             self.handleError(record)
 
 
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+
+def get_sendmmsg():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError, TypeError):
+        return None
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return sendmmsg
+
+
+class BatchSender:
+    """Queue messages and flush them with as few syscalls as possible.
+
+    Datagram sockets use sendmmsg(2) when the libc provides it, one send per datagram otherwise.
+    Stream sockets send the whole batch with one sendall since the messages are newline terminated.
+    The paced writes hand over a few events at a time, so a batch is filled across writes and flushed when it is
+    full or when its first message has waited MAX_DELAY_S.
+    """
+    UIO_MAXIOV = 1024
+    MAX_DELAY_S = 0.1
+
+    def __init__(self, sock, batch_size):
+        self.socket = sock
+        self.batch_size = min(max(1, batch_size), self.UIO_MAXIOV)
+        self.is_datagram = sock.type == socket.SOCK_DGRAM
+        self.sendmmsg = get_sendmmsg() if self.is_datagram else None
+        self.messages = []
+        self.first_queue_time = None
+        self.nb_syscalls = 0
+        self.nb_errors = 0
+        self.capacity = 0
+        self.data = None
+        self.iovecs = (iovec * self.batch_size)()
+        self.mmsghdrs = (mmsghdr * self.batch_size)()
+        for i in range(self.batch_size):
+            hdr = self.mmsghdrs[i].msg_hdr
+            hdr.msg_iov = ctypes.cast(ctypes.addressof(self.iovecs) + i * ctypes.sizeof(iovec), ctypes.POINTER(iovec))
+            hdr.msg_iovlen = 1
+
+    def get_method(self):
+        if not self.is_datagram:
+            return 'sendall'
+        return 'sendmmsg' if self.sendmmsg is not None else 'send'
+
+    def queue(self, message):
+        if len(self.messages) == 0:
+            self.first_queue_time = time.time()
+        self.messages.append(message)
+        if len(self.messages) >= self.batch_size:
+            self.flush()
+
+    def flush_if_late(self):
+        if len(self.messages) > 0 and time.time() - self.first_queue_time >= self.MAX_DELAY_S:
+            self.flush()
+
+    def flush(self):
+        if len(self.messages) == 0:
+            return
+        try:
+            if not self.is_datagram:
+                self.nb_syscalls += 1
+                self.socket.sendall(b''.join(self.messages))
+            elif self.sendmmsg is not None:
+                self.flush_sendmmsg()
+            else:
+                for message in self.messages:
+                    self.nb_syscalls += 1
+                    self.socket.send(message)
+        except socket.error:
+            self.nb_errors += 1
+        self.messages = []
+
+    def flush_sendmmsg(self):
+        size = sum(len(m) for m in self.messages)
+        if size > self.capacity:
+            self.capacity = size * 2
+            self.data = ctypes.create_string_buffer(self.capacity)
+        base = ctypes.addressof(self.data)
+        offset = 0
+        for i, message in enumerate(self.messages):
+            ctypes.memmove(base + offset, message, len(message))
+            self.iovecs[i].iov_base = base + offset
+            self.iovecs[i].iov_len = len(message)
+            offset += len(message)
+
+        nb_messages = len(self.messages)
+        sent = 0
+        while sent < nb_messages:
+            self.nb_syscalls += 1
+            first = ctypes.cast(ctypes.addressof(self.mmsghdrs) + sent * ctypes.sizeof(mmsghdr),
+                                ctypes.POINTER(mmsghdr))
+            ret = self.sendmmsg(self.socket.fileno(), first, nb_messages - sent, 0)
+            if ret < 0:
+                # the remaining datagrams of the batch are lost, like a failed sendto would lose one
+                self.nb_errors += 1
+                break
+            sent += ret
+
+
+class RawSyslogSender:
+    """Send syslog messages rendered once, only the timestamp and the counter are patched in place.
+
+    The bytes on the wire are the same as MySysLogHandler with RFC3164Formatter or CEFFormatter:
+    <priority>timestamp header[counter]body
+    """
+    PRIORITY = '<%d>' % ((SysLogHandler.LOG_USER << 3) | SysLogHandler.LOG_INFO)
+    TIMESTAMP_FORMAT = "%b %d %H:%M:%S"
+
+    def __init__(self, address, protocol, batch_size=1):
+        self.address = address
+        self.protocol = protocol.lower()
+        self.batch_size = batch_size
+        self.batch_sender = None
+        self.socket = None
+        self.send_message = None
+        self.buffer = None
+        self.header = ''
+        self.body = ''
+        self.format_counter = None
+        self.templates = None
+        self.template_position = 0
+        self.counter_offset = 0
+        self.counter_len = 0
+        self.timestamp_offset = len(self.PRIORITY)
+        self.last_second = None
+        self.nb_errors = 0
+        self.nb_events = 0
+        self.nb_syscalls = 0
+        self.nb_bytes = 0
+
+    def connect(self):
+        if self.protocol == 'unix':
+            # same fallback as SysLogHandler._connect_unixsocket
+            try:
+                self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                self.socket.connect(self.address)
+            except socket.error:
+                self.socket.close()
+                self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.socket.connect(self.address)
+            self.send_message = self.socket.send
+        elif self.protocol == 'tcp':
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.connect(self.address)
+            self.send_message = self.socket.sendall
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            address = self.address
+            self.send_message = lambda msg: self.socket.sendto(msg, address)
+            if self.batch_size > 1:
+                # sendmmsg is given no destination address, the socket has to be connected
+                self.socket.connect(self.address)
+        if self.batch_size > 1:
+            self.batch_sender = BatchSender(self.socket, self.batch_size)
+            print("Batching %d messages per flush with %s" % (self.batch_sender.batch_size,
+                                                               self.batch_sender.get_method()))
+
+    def flush(self):
+        if self.batch_sender is not None:
+            self.batch_sender.flush()
+
+    def close(self):
+        if self.batch_sender is not None:
+            self.batch_sender.flush()
+            self.nb_syscalls += self.batch_sender.nb_syscalls
+            self.nb_errors += self.batch_sender.nb_errors
+            self.batch_sender = None
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def get_stats(self):
+        stats = {'events': self.nb_events, 'syscalls': self.nb_syscalls, 'bytes': self.nb_bytes,
+                 'errors': self.nb_errors}
+        if self.batch_sender is not None:
+            stats['syscalls'] += self.batch_sender.nb_syscalls
+            stats['errors'] += self.batch_sender.nb_errors
+        return stats
+
+    def set_template(self, header, body, format_counter=None):
+        """header is everything between the timestamp and the counter, body everything after the counter.
+
+        format_counter(index, send_time_ms) renders the counter, the decimal index by default.
+        """
+        self.header = header.encode('ASCII', 'ignore')
+        self.body = body.encode('ASCII', 'ignore')
+        self.format_counter = format_counter or (lambda index, send_time_ms: ('%d' % index).encode('ASCII'))
+        self.buffer = None
+
+    def set_templates(self, templates, format_counter=None):
+        """(priority, header, body) of every event of a pool, sent round-robin instead of the single template."""
+        self.templates = [tuple(part.encode('ASCII', 'ignore') for part in template) for template in templates]
+        self.format_counter = format_counter or (lambda index, send_time_ms: ('%d' % index).encode('ASCII'))
+        self.template_position = 0
+
+    def send_templates(self, first_index, count, include_counter, now):
+        timestamp = datetime.fromtimestamp(now).strftime(self.TIMESTAMP_FORMAT).encode('ASCII')
+        send_time_ms = int(now * 1000)
+        format_counter = self.format_counter
+        templates = self.templates
+        position = self.template_position
+        messages = []
+        for index in range(first_index, first_index + count):
+            priority, header, body = templates[position]
+            position = (position + 1) % len(templates)
+            counter = format_counter(index, send_time_ms) if include_counter else b''
+            messages.append(priority + timestamp + header + counter + body)
+        self.template_position = position
+        self.send_messages(messages)
+
+    def render(self, timestamp, counter):
+        self.buffer = bytearray(self.PRIORITY.encode('ASCII') + timestamp + self.header + counter + self.body)
+        self.counter_offset = self.timestamp_offset + len(timestamp) + len(self.header)
+        self.counter_len = len(counter)
+
+    def update_timestamp(self, now):
+        second = int(now)
+        if second == self.last_second and self.buffer is not None:
+            return
+        self.last_second = second
+        timestamp = datetime.fromtimestamp(now).strftime(self.TIMESTAMP_FORMAT).encode('ASCII')
+        if self.buffer is None:
+            self.render(timestamp, b'')
+        else:
+            self.buffer[self.timestamp_offset:self.timestamp_offset + len(timestamp)] = timestamp
+
+    def set_counter(self, counter):
+        # the bytearray is only resized when the number of digits changes
+        self.buffer[self.counter_offset:self.counter_offset + self.counter_len] = counter
+        self.counter_len = len(counter)
+
+    def send(self, first_index, count, include_counter=True):
+        if self.templates is not None:
+            self.send_templates(first_index, count, include_counter, time.time())
+            return
+        if self.socket is None:
+            self.connect()
+        now = time.time()
+        self.update_timestamp(now)
+        self.nb_events += count
+        if self.batch_sender is not None:
+            self.send_batch(first_index, count, include_counter, int(now * 1000))
+            return
+
+        buffer = self.buffer
+        send_message = self.send_message
+        format_counter = self.format_counter
+        send_time_ms = int(now * 1000)
+        for index in range(first_index, first_index + count):
+            if include_counter:
+                self.set_counter(format_counter(index, send_time_ms))
+            try:
+                self.nb_syscalls += 1
+                send_message(buffer)
+                self.nb_bytes += len(buffer)
+            except socket.error:
+                self.nb_errors += 1
+                if self.protocol == 'unix':
+                    self.close()
+                    self.connect()
+                    send_message = self.send_message
+
+    def send_messages(self, messages):
+        # already rendered messages, e.g. replayed from a corpus
+        if self.socket is None:
+            self.connect()
+        self.nb_events += len(messages)
+        if self.batch_sender is not None:
+            for message in messages:
+                self.batch_sender.queue(message)
+                self.nb_bytes += len(message)
+            self.batch_sender.flush_if_late()
+            return
+        for message in messages:
+            try:
+                self.nb_syscalls += 1
+                self.send_message(message)
+                self.nb_bytes += len(message)
+            except socket.error:
+                self.nb_errors += 1
+                if self.protocol == 'unix':
+                    self.close()
+                    self.connect()
+
+    def send_batch(self, first_index, count, include_counter, send_time_ms):
+        batch_sender = self.batch_sender
+        buffer = self.buffer
+        format_counter = self.format_counter
+        for index in range(first_index, first_index + count):
+            if include_counter:
+                self.set_counter(format_counter(index, send_time_ms))
+            batch_sender.queue(bytes(buffer))
+            self.nb_bytes += len(buffer)
+        batch_sender.flush_if_late()
+
+
 class SyslogWriter(OutputWriter):
-    def __init__(self, tag, path, msg_size, protocol="udp"):
+    def __init__(self, tag, path, msg_size, protocol="udp", writer_mode='logger', batch_size=1):
         OutputWriter.__init__(self, 'syslog', tag, path, msg_size)
         self.host = None
         self.port = None
@@ -341,7 +1755,14 @@ class SyslogWriter(OutputWriter):
             self.port = int(port)
         self.protocol = protocol
         self.logger = None
+        self.syslog_handler = None
         self.include_counter = True
+        self.writer_mode = writer_mode
+        self.batch_size = batch_size
+        self.raw_sender = None
+        if self.batch_size > 1 and self.writer_mode != 'raw':
+            print("Warning: batching requires the raw syslog writer, switching '%s' to raw" % self.get_name())
+            self.writer_mode = 'raw'
 
     def get_address(self):
         return self.path if self.is_unix_socket else (self.host, self.port)
@@ -368,9 +1789,56 @@ class SyslogWriter(OutputWriter):
             self.logger = logging.getLogger('omstest')
             self.logger.setLevel(logging.DEBUG)
             print(self.get_address())
-            self.logger.addHandler(self.get_syslog_handler(self.get_address(), socktype))
+            self.syslog_handler = self.get_syslog_handler(self.get_address(), socktype)
+            self.logger.addHandler(self.syslog_handler)
         return self.logger
 
+    def get_raw_header(self, hostname=None, ident='omstest'):
+        # RFC3164Formatter: '{isotime} {hostname} {name}[{process}]: ' + message
+        return ' %s %s[%d]: ' % (hostname or gethostname(), ident, os.getpid())
+
+    def get_raw_templates(self):
+        templates = []
+        for priority, hostname, ident, msg in zip(self.pool.priorities, self.pool.hostnames, self.pool.idents,
+                                                  self.pool.messages):
+            header, body, format_counter = self.get_raw_template(self.get_raw_header(hostname, ident), msg)
+            templates.append((priority, header, body))
+        return templates, format_counter
+
+    def get_raw_template(self, raw_header=None, msg=None):
+        raw_header = raw_header or self.get_raw_header()
+        msg = msg or self.msg
+        if self.include_counter and self.stamp_events:
+            # the name and the stamp are rendered with the counter
+            return raw_header + 'idx=', ' %s\n' % msg, self.format_stamped_counter
+        if self.include_counter:
+            return raw_header + 'idx=', ' %s %s\n' % (self.get_name(), msg), None
+        return raw_header, msg + '\n', None
+
+    def format_stamped_counter(self, index, send_time_ms):
+        return ('%d %s %s' % (index, self.get_name(), self.get_stamp(index, send_time_ms))).encode('ASCII')
+
+    def get_raw_sender(self):
+        if self.raw_sender is None:
+            self.raw_sender = RawSyslogSender(self.get_address(), self.protocol, self.batch_size)
+            if self.pool is not None:
+                self.raw_sender.set_templates(*self.get_raw_templates())
+            else:
+                self.raw_sender.set_template(*self.get_raw_template())
+        return self.raw_sender
+
+    def close(self):
+        # the batch still queued at the end of the run
+        if self.raw_sender is not None:
+            self.raw_sender.flush()
+
+    def get_send_stats(self):
+        if self.raw_sender is not None:
+            return self.raw_sender.get_stats()
+        # the logger path does one send per event
+        nb_bytes = self.syslog_handler.nb_bytes if self.syslog_handler is not None else 0
+        return {'events': self.index, 'syscalls': self.index, 'bytes': nb_bytes, 'errors': 0}
+
     def get_number_dropped_event(self):
         dropped_events = 0
         if self.is_unix_socket:
@@ -386,10 +1854,22 @@ class SyslogWriter(OutputWriter):
     def write(self, eps, override_buffer=None):
         if override_buffer is not None:
             self.msg = override_buffer
+            if self.raw_sender is not None:
+                self.raw_sender.set_template(*self.get_raw_template())
+
+        if self.writer_mode == 'raw':
+            self.get_raw_sender().send(self.index, eps, self.include_counter)
+            self.index += eps
+            return
 
         logger = self.get_logger()
-        for i in range(eps):
-            message = 'idx=%d %s %s' % (self.index, self.get_name(), self.msg) if self.include_counter else self.msg
+        send_time_ms = int(time.time() * 1000)
+        for msg in self.get_messages(eps):
+            if self.include_counter and self.stamp_events:
+                message = 'idx=%d %s %s %s' % (self.index, self.get_name(), self.get_stamp(self.index, send_time_ms),
+                                               msg)
+            else:
+                message = 'idx=%d %s %s' % (self.index, self.get_name(), msg) if self.include_counter else msg
             message += '\n'
             # print(message)
             logger.log(logging.INFO, message)
@@ -399,8 +1879,8 @@ class SyslogWriter(OutputWriter):
 class CEFWriter(SyslogWriter):
     CEF_SAMPLE = '0|omsagent-loadtest|PAN-OS|8.0.0|general|SYSTEM|3|rt=Nov 04 2018 07:15:46 GMT deviceExternalId=unknown cs3Label=Virtual System cs3= fname= flexString2Label=Module flexString2=general msg= Failed password for root from 116.31.116.38 port 63605 ssh2 externalId=5705651 cat=general PanOSDGl1=0 PanOSDGl2=0 PanOSDGl3=0 PanOSDGl4=0 PanOSVsysName= dvchost=palovmfw PanOSActionFlags=0x0'
 
-    def __init__(self, tag, path, msg_size, protocol):
-        SyslogWriter.__init__(self, tag, path, msg_size, protocol)
+    def __init__(self, tag, path, msg_size, protocol, writer_mode='logger', batch_size=1):
+        SyslogWriter.__init__(self, tag, path, msg_size, protocol, writer_mode, batch_size)
         self.include_counter = True
         self.name = 'syslog_cef'
         self.msg = self.CEF_SAMPLE
@@ -410,11 +1890,467 @@ class CEFWriter(SyslogWriter):
         syslog_handler.setFormatter(CEFFormatter())
         return syslog_handler
 
+    def get_raw_header(self, hostname=None, ident=None):
+        # CEFFormatter: '%s %s CEF: %s' % (isotime, hostname, message)
+        return ' %s CEF: ' % (hostname or gethostname())
+
+    def get_raw_template(self, raw_header=None, msg=None):
+        # only the header varies with a pool, the body stays the CEF sample
+        return SyslogWriter.get_raw_template(self, raw_header)
+
+    def get_messages(self, count):
+        return [self.msg] * count
+
+class SecurityEventsWriter(SyslogWriter):
+    """CEF and Cisco ASA messages framed by a new line on the TCP listener of security_events.conf.
+
+    The mix gives the weight of every 'vendor|product', Cisco ASA uses its own '%ASA-level-id:' format. Every CEF
+    event has extension_fields key=value pairs before the counter, which ends the event as externalId.
+    """
+    FACILITY = SysLogHandler.LOG_LOCAL4
+    EXTENSIONS = [
+        ('src', lambda rnd: get_random_ip(rnd)),
+        ('dst', lambda rnd: get_random_ip(rnd)),
+        ('spt', lambda rnd: '%d' % rnd.randint(1024, 65535)),
+        ('dpt', lambda rnd: rnd.choice(['22', '53', '80', '443', '445', '3389'])),
+        ('proto', lambda rnd: rnd.choice(['TCP', 'UDP'])),
+        ('act', lambda rnd: rnd.choice(['allow', 'deny', 'drop', 'reset-both'])),
+        ('suser', lambda rnd: 'user%d' % rnd.randint(0, 999)),
+        ('duser', lambda rnd: 'user%d' % rnd.randint(0, 999)),
+        ('cat', lambda rnd: rnd.choice(['traffic', 'threat', 'system', 'authentication'])),
+        ('deviceExternalId', lambda rnd: '%012x' % rnd.getrandbits(48)),
+        ('deviceInboundInterface', lambda rnd: 'ethernet1/%d' % rnd.randint(1, 8)),
+        ('deviceOutboundInterface', lambda rnd: 'ethernet1/%d' % rnd.randint(1, 8)),
+        ('in', lambda rnd: '%d' % rnd.randint(40, 10 ** 6)),
+        ('out', lambda rnd: '%d' % rnd.randint(40, 10 ** 6)),
+        ('requestMethod', lambda rnd: rnd.choice(['GET', 'POST'])),
+        ('request', lambda rnd: 'http://example%d.com/index.html' % rnd.randint(0, 99)),
+        ('cs1Label', lambda rnd: 'Rule'),
+        ('cs1', lambda rnd: 'rule%d' % rnd.randint(0, 99)),
+        ('msg', lambda rnd: 'Failed password for root from %s port %d ssh2' % (get_random_ip(rnd),
+                                                                            rnd.randint(1024, 65535))),
+        ('dvchost', lambda rnd: 'fw%02d' % rnd.randint(0, 9)),
+    ]
+    ASA_MESSAGES = [
+        (6, 302013, 'Built outbound TCP connection %(conn)d for outside:%(dst)s/%(dpt)d (%(dst)s/%(dpt)d) to '
+                    'inside:%(src)s/%(spt)d (%(src)s/%(spt)d)'),
+        (6, 302014, 'Teardown TCP connection %(conn)d for outside:%(dst)s/%(dpt)d to inside:%(src)s/%(spt)d '
+                    'duration 0:00:%(seconds)02d bytes %(bytes)d TCP FINs'),
+        (4, 106023, 'Deny tcp src outside:%(src)s/%(spt)d dst inside:%(dst)s/%(dpt)d by access-group '
+                    '"outside_access_in" [0x0, 0x0]'),
+        (6, 305011, 'Built dynamic TCP translation from inside:%(src)s/%(spt)d to outside:%(dst)s/%(dpt)d'),
+        (3, 710003, 'TCP access denied by ACL from %(src)s/%(spt)d to outside:%(dst)s/%(dpt)d'),
+        (6, 113004, 'AAA user authentication Successful : server = %(dst)s : user = user%(user)d'),
+    ]
+
+    def __init__(self, tag, path, msg_size, mix, extension_fields=20, batch_size=1, pool_size=4096, seed=0):
+        SyslogWriter.__init__(self, tag, path, msg_size, 'tcp', 'raw', batch_size)
+        self.name = 'security_events'
+        self.mix = self.parse_mix(mix)
+        self.extension_fields = extension_fields
+        self.pool_size = pool_size
+        self.seed = seed
+        self.templates = None
+
+    @staticmethod
+    def parse_mix(spec):
+        mix = []
+        for entry in filter(None, spec.split(',')):
+            product, _, weight = entry.rpartition('=')
+            vendor, _, product = product.partition('|')
+            mix.append((vendor, product, float(weight or 1)))
+        return mix
+
+    @staticmethod
+    def get_kind(vendor, product):
+        return 'asa' if (vendor, product) == ('Cisco', 'ASA') else 'cef'
+
+    def get_extension(self, rnd):
+        fields = []
+        for i in range(self.extension_fields):
+            if i < len(self.EXTENSIONS):
+                key, draw_value = self.EXTENSIONS[i]
+                fields.append('%s=%s' % (key, draw_value(rnd)))
+            else:
+                fields.append('ext%d=%08x' % (i, rnd.getrandbits(32)))
+        return ' '.join(fields)
+
+    def build_template(self, rnd, vendor, product):
+        hostname = gethostname()
+        if self.get_kind(vendor, product) == 'asa':
+            level, message_id, text = rnd.choice(self.ASA_MESSAGES)
+            text %= {'conn': rnd.randint(1, 10 ** 7), 'src': get_random_ip(rnd), 'dst': get_random_ip(rnd),
+                     'spt': rnd.randint(1024, 65535), 'dpt': rnd.randint(1, 1023), 'seconds': rnd.randint(0, 59),
+                     'bytes': rnd.randint(40, 10 ** 6), 'user': rnd.randint(0, 999)}
+            header = ' %s : %%ASA-%d-%d: %s idx=' % (hostname, level, message_id, text)
+        else:
+            level = rnd.choice([SysLogHandler.LOG_INFO, SysLogHandler.LOG_WARNING, SysLogHandler.LOG_ERR])
+            header = ' %s CEF: 0|%s|%s|1.0|%d|%s|%d|%s externalId=' % (
+                hostname, vendor, product, rnd.randint(100, 999), rnd.choice(['TRAFFIC', 'THREAT', 'SYSTEM']),
+                rnd.randint(1, 10), self.get_extension(rnd))
+        return '<%d>' % ((self.FACILITY << 3) | level), header, '\n'
+
+    def get_raw_templates(self):
+        if self.templates is None:
+            rnd = random.Random(self.seed)
+            cumulative = get_cumulative_weights([weight for vendor, product, weight in self.mix])
+            self.templates = [self.build_template(rnd, *weighted_choice(rnd, self.mix, cumulative)[:2])
+                              for _ in range(self.pool_size)]
+        format_counter = self.format_stamped_counter if self.stamp_events else None
+        return self.templates, format_counter
+
+    def get_raw_sender(self):
+        if self.raw_sender is None:
+            self.raw_sender = RawSyslogSender(self.get_address(), self.protocol, self.batch_size)
+            self.raw_sender.set_templates(*self.get_raw_templates())
+        return self.raw_sender
+
+    def get_sample_lines(self):
+        """The text of every template as in_syslog parses it, without the priority, by kind of message."""
+        templates, format_counter = self.get_raw_templates()
+        timestamp = datetime.now().strftime(RawSyslogSender.TIMESTAMP_FORMAT)
+        lines = {}
+        for index, (priority, header, body) in enumerate(templates):
+            kind = 'asa' if '%ASA-' in header else 'cef'
+            lines.setdefault(kind, []).append(timestamp + header + '%d' % index)
+        return lines
+
+
+class TcpFanInWriter(SyslogWriter):
+    """Spread the events over many persistent TCP connections of the asyncio engine of tcp_fanin.py, with newline
+    or octet counting framing. The connections are opened before the first events are sent.
+
+    The events are always rendered from raw templates, round-robin over the event pool when there is one."""
+
+    def __init__(self, tag, path, msg_size, nb_connections=1000, framing='newline', connect_concurrency=100):
+        SyslogWriter.__init__(self, tag, path, msg_size, 'tcp', 'fanin')
+        self.name = 'syslog_tcp_fanin'
+        self.nb_connections = nb_connections
+        self.framing = framing
+        self.connect_concurrency = connect_concurrency
+        self.engine = None
+        self.closed_stats = {}  # counters of the engines of the previous runs
+        self.summary = {}
+        self.templates = []  # (priority, header, body) without the end of line added by the framing
+        self.format_counter = None
+        self.timestamp = b''
+        self.last_second = None
+
+    def render(self, index):
+        # called by the event loop thread, the framing adds the end of the message
+        now = time.time()
+        if int(now) != self.last_second:
+            self.last_second = int(now)
+            self.timestamp = datetime.fromtimestamp(now).strftime(RawSyslogSender.TIMESTAMP_FORMAT).encode('ASCII')
+        if self.format_counter is not None:
+            counter = self.format_counter(index, int(now * 1000))
+        else:
+            counter = ('%d' % index).encode('ASCII')
+        priority, header, body = self.templates[index % len(self.templates)]
+        return priority + self.timestamp + header + counter + body
+
+    def get_engine(self):
+        if self.engine is None:
+            if self.pool is not None:
+                templates, self.format_counter = self.get_raw_templates()
+            else:
+                header, body, self.format_counter = self.get_raw_template()
+                templates = [(RawSyslogSender.PRIORITY, header, body)]
+            self.templates = [(priority.encode('ASCII', 'ignore'), header.encode('ASCII', 'ignore'),
+                               body.rstrip('\n').encode('ASCII', 'ignore')) for priority, header, body in templates]
+            self.engine = tcp_fanin.TcpFanIn(self.host, self.port, self.nb_connections, self.render, self.framing,
+                                             self.connect_concurrency)
+            self.engine.start()
+            summary = self.engine.get_summary()
+            print("%s: %d/%d connections to %s:%d, connect p50=%.2f ms p99=%.2f ms max=%.2f ms" %
+                  (self.get_name(), summary['connections'], summary['requested_connections'], self.host, self.port,
+                   summary['p50_connect_ms'], summary['p99_connect_ms'], summary['max_connect_ms']))
+        return self.engine
+
+    def write(self, eps, override_buffer=None):
+        self.get_engine().submit(eps)
+        self.index += eps
+
+    def close(self):
+        # the writers are reused from run to run, the next write starts a new engine
+        if self.engine is not None:
+            self.engine.stop()
+            self.summary = self.engine.get_summary()
+            for key, value in self.engine.get_stats().items():
+                self.closed_stats[key] = self.closed_stats.get(key, 0) + value
+            self.engine = None
+
+    def get_send_stats(self):
+        stats = dict(self.closed_stats)
+        if self.engine is not None:
+            for key, value in self.engine.get_stats().items():
+                stats[key] = stats.get(key, 0) + value
+        return stats
+
+    def get_fanin_summary(self):
+        return self.engine.get_summary() if self.engine is not None else self.summary
+
+
 class TcpWriter(SyslogWriter):
     def __init__(self, tag, path, msg_size):
         SyslogWriter.__init__(self, tag, path, msg_size, 'tcp')
         self.name = 'tcp'
 
+
+class StatsDWriter(OutputWriter):
+    """Counters, timers, gauges and sets on the udp listener of statsd.conf, several metrics per datagram when
+    packed. The metric lines are drawn once, keys of every type with Zipf weights of exponent skew."""
+    TYPES = {'counter': 'c', 'timer': 'ms', 'gauge': 'g', 'set': 's'}
+
+    def __init__(self, tag, path, msg_size, mix, nb_keys=100, metrics_per_datagram=1, batch_size=1, skew=0.0,
+                 pool_size=4096, seed=0):
+        OutputWriter.__init__(self, 'statsd', tag, path, msg_size)
+        self.protocol = 'udp'
+        self.host, port = self.path.split(':')
+        self.port = int(port)
+        self.mix = self.parse_mix(mix)
+        self.nb_keys = nb_keys
+        self.metrics_per_datagram = max(1, metrics_per_datagram)
+        self.batch_size = batch_size
+        self.skew = skew
+        self.pool_size = pool_size
+        self.seed = seed
+        self.datagrams = None
+        self.sender = None
+
+    @classmethod
+    def parse_mix(cls, spec):
+        mix = []
+        for entry in filter(None, spec.split(',')):
+            metric_type, _, weight = entry.partition('=')
+            if metric_type not in cls.TYPES:
+                raise ValueError("Unknown statsd metric type '%s', use %s" % (metric_type, ', '.join(sorted(cls.TYPES))))
+            mix.append((metric_type, float(weight or 1)))
+        return mix
+
+    def get_fraction(self, metric_type):
+        total = sum(weight for name, weight in self.mix)
+        return sum(weight for name, weight in self.mix if name == metric_type) / total
+
+    def get_datagrams(self):
+        if self.datagrams is None:
+            rnd = random.Random(self.seed)
+            types = [metric_type for metric_type, weight in self.mix]
+            type_weights = get_cumulative_weights([weight for metric_type, weight in self.mix])
+            keys = range(self.nb_keys)
+            key_weights = get_cumulative_weights([1.0 / (i + 1) ** self.skew for i in keys])
+            values = {
+                'counter': lambda: '1',
+                'timer': lambda: '%.3f' % rnd.lognormvariate(0, 1),
+                'gauge': lambda: '%d' % rnd.randint(0, 100),
+                'set': lambda: '%d' % rnd.randint(0, 1000),
+            }
+            self.datagrams = []
+            for _ in range(self.pool_size):
+                lines = []
+                for _ in range(self.metrics_per_datagram):
+                    metric_type = weighted_choice(rnd, types, type_weights)
+                    lines.append('omstest.%s.%d:%s|%s' % (metric_type, weighted_choice(rnd, keys, key_weights),
+                                                          values[metric_type](), self.TYPES[metric_type]))
+                self.datagrams.append('\n'.join(lines).encode('ASCII'))
+        return self.datagrams
+
+    def get_protocol(self):
+        return self.protocol
+
+    def write(self, eps):
+        if self.sender is None:
+            self.sender = RawSyslogSender((self.host, self.port), self.protocol, self.batch_size)
+        datagrams = self.get_datagrams()
+        # the index counts metrics, a datagram is sent once all of its metrics are due
+        count = (self.index + eps) // self.metrics_per_datagram - self.index // self.metrics_per_datagram
+        position = self.index // self.metrics_per_datagram % len(datagrams)
+        self.sender.send_messages(EventPool.slice(datagrams, position, count))
+        self.index += eps
+
+    def close(self):
+        if self.sender is not None:
+            self.sender.flush()
+
+    def get_send_stats(self):
+        if self.sender is None:
+            return {}
+        stats = self.sender.get_stats()
+        stats['datagrams'] = stats['events']
+        stats['events'] = self.index
+        return stats
+
+    def get_number_dropped_event(self):
+        for conn in net_connections(self.protocol):
+            addr = conn['laddr']
+            if addr.ip == self.host and addr.port == self.port:
+                return conn['drops']
+        return 0
+
+
+class CorpusReader:
+    """Loop over the lines of a corpus file mapped in memory, only the pages being read become resident."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(self.map, 'madvise'):
+            self.map.madvise(mmap.MADV_SEQUENTIAL)
+        if re.search(br'\S', self.map) is None:
+            raise ValueError("no line to replay in %s" % path)
+        self.position = 0
+        self.nb_loops = 0
+
+    def read_lines(self, count):
+        lines = []
+        size = len(self.map)
+        while len(lines) < count:
+            end = self.map.find(b'\n', self.position)
+            if end == -1:
+                end = size
+            line = self.map[self.position:end].rstrip(b'\r')
+            self.position = end + 1
+            if self.position >= size:
+                self.position = 0
+                self.nb_loops += 1
+            if line.strip():
+                lines.append(line)
+        return lines
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class CorpusRewriter:
+    """Make replayed lines look fresh: the timestamp and the hostname of RFC3164 and RFC5424 syslog headers,
+    and the timestamp of apache/nginx access logs, are replaced by the current ones."""
+    RFC3164_RE = re.compile(br'^(<\d{1,3}>)?[A-Z][a-z]{2} [ \d]\d \d{2}:\d{2}:\d{2} (\S+) ')
+    RFC5424_RE = re.compile(br'^(<\d{1,3}>1 )\S+ (\S+) ')
+    CLF_RE = re.compile(br'\[\d{2}/[A-Z][a-z]{2}/\d{4}:\d{2}:\d{2}:\d{2} [+-]\d{4}\]')
+
+    def __init__(self, timestamps=True, hostname=None):
+        self.timestamps = timestamps
+        self.hostname = hostname.encode('ASCII') if hostname else None
+        self.last_second = None
+        self.rfc3164_time = self.rfc5424_time = self.clf_time = None
+
+    def update_times(self, now):
+        second = int(now)
+        if second == self.last_second:
+            return
+        self.last_second = second
+        local_time = datetime.fromtimestamp(second)
+        self.rfc3164_time = local_time.strftime("%b %d %H:%M:%S").encode('ASCII')
+        self.rfc5424_time = (datetime.utcfromtimestamp(second).isoformat() + 'Z').encode('ASCII')
+        self.clf_time = ('[%s %s]' % (local_time.strftime("%d/%b/%Y:%H:%M:%S"), time.strftime('%z'))).encode('ASCII')
+
+    def rewrite(self, line, now):
+        self.update_times(now)
+        match = self.RFC3164_RE.match(line)
+        if match is not None:
+            timestamp = self.rfc3164_time if self.timestamps else line[len(match.group(1) or b''):match.start(2) - 1]
+            return (match.group(1) or b'') + timestamp + b' ' + (self.hostname or match.group(2)) + b' ' + \
+                line[match.end():]
+        match = self.RFC5424_RE.match(line)
+        if match is not None:
+            timestamp = self.rfc5424_time if self.timestamps else line[match.end(1):match.start(2) - 1]
+            return match.group(1) + timestamp + b' ' + (self.hostname or match.group(2)) + b' ' + line[match.end():]
+        if self.timestamps:
+            return self.CLF_RE.sub(self.clf_time, line, count=1)
+        return line
+
+
+def get_corpus_rewriter(rewrite):
+    options = rewrite.split(',')
+    if 'timestamp' not in options and 'hostname' not in options:
+        return None
+    return CorpusRewriter('timestamp' in options, gethostname() if 'hostname' in options else None)
+
+
+class CorpusReplay:
+    """Lines of a corpus, opened on the first read so that unused replay writers cost nothing."""
+
+    def __init__(self, corpus_path, rewriter=None):
+        self.corpus_path = corpus_path
+        self.rewriter = rewriter
+        self.corpus = None
+
+    def read_lines(self, count, now):
+        if self.corpus is None:
+            if not self.corpus_path:
+                raise ValueError("replaying needs a corpus file, see --corpus-path")
+            self.corpus = CorpusReader(self.corpus_path)
+        lines = self.corpus.read_lines(count)
+        if self.rewriter is not None:
+            lines = [self.rewriter.rewrite(line, now) for line in lines]
+        return lines
+
+
+class ReplaySyslogWriter(SyslogWriter):
+    """Replay the lines of a corpus file to the syslog listener.
+
+    Syslog lines without a priority get the default one, other lines get a whole RFC3164 header."""
+
+    def __init__(self, tag, path, msg_size, protocol, corpus_path, rewriter=None, batch_size=1):
+        SyslogWriter.__init__(self, tag, path, msg_size, protocol, 'raw', batch_size)
+        self.name = 'syslog_replay'
+        self.replay = CorpusReplay(corpus_path, rewriter)
+
+    def render_lines(self, count):
+        now = time.time()
+        send_time_ms = int(now * 1000)
+        priority = RawSyslogSender.PRIORITY.encode('ASCII')
+        # wraps the lines which are not syslog, e.g. access logs
+        header = ('%s%s %s ' % (RawSyslogSender.PRIORITY, datetime.fromtimestamp(now).strftime(
+            RawSyslogSender.TIMESTAMP_FORMAT), gethostname())).encode('ASCII')
+        messages = []
+        for line in self.replay.read_lines(count, now):
+            if CorpusRewriter.RFC3164_RE.match(line) is not None:
+                if not line.startswith(b'<'):
+                    line = priority + line
+            elif CorpusRewriter.RFC5424_RE.match(line) is None:
+                line = header + line
+            if self.stamp_events:
+                line += (' %s' % self.get_stamp(self.index, send_time_ms)).encode('ASCII')
+            messages.append(line + b'\n')
+            self.index += 1
+        return messages
+
+    def get_raw_sender(self):
+        if self.raw_sender is None:
+            self.raw_sender = RawSyslogSender(self.get_address(), self.protocol, self.batch_size)
+        return self.raw_sender
+
+    def write(self, eps, override_buffer=None):
+        self.get_raw_sender().send_messages(self.render_lines(eps))
+
+
+class ReplayTailFileWriter(TailFileWriter):
+    """Append the lines of a corpus file to the tailed file."""
+
+    def __init__(self, tag, path, msg_size, corpus_path, rewriter=None):
+        TailFileWriter.__init__(self, tag, path, msg_size)
+        self.name = 'file_replay'
+        self.replay = CorpusReplay(corpus_path, rewriter)
+
+    def write(self, eps, override_buffer=None):
+        if os.path.exists(self.path) and os.stat(self.path).st_size > self.max_file_size:
+            with open(self.path, "w"):
+                pass
+        now = time.time()
+        send_time_ms = int(now * 1000)
+        lines = []
+        for line in self.replay.read_lines(eps, now):
+            if self.stamp_events:
+                line += (' %s' % self.get_stamp(self.index, send_time_ms)).encode('ASCII')
+            lines.append(line + b'\n')
+            self.index += 1
+        with open(self.path, "ab") as tail_file:
+            tail_file.writelines(lines)
+        self.nb_bytes += sum(len(line) for line in lines)
+
 class ProcessWrapper:
     def __init__(self, cmd_fmt, cmd_args):
         self.cmd_fmt = cmd_fmt
@@ -425,7 +2361,7 @@ class ProcessWrapper:
 
     def start_process(self, envs=None, wait_for_steady_stat=1):
         envs_str = {}
-        for name, val in envs.iteritems():
+        for name, val in envs.items():
             envs_str[name] = str(val)
         popen = subprocess.Popen(self.get_cmd().split(' '), close_fds=True, env=envs_str)
         time.sleep(wait_for_steady_stat)
@@ -439,23 +2375,59 @@ class ConfigManager:
         self.constants = constants
         if constants['syslog_protocol'] == 'unix':
             self.SYSLOG_PATH = '%(syslog_path)s' % constants
-            self.SECURITY_PATH = '%(syslog_path)s' % constants
         else:
             self.SYSLOG_PATH = '%(syslog_host)s:%(syslog_port)s' % constants
-            self.SECURITY_PATH = '%(syslog_host)s:%(syslog_port)s' % constants
+        # security_events.conf only listens on tcp
+        self.SECURITY_PATH = '%(syslog_host)s:%(security_events_port)s' % constants
         self.FLUENT_PATH = '%(fluent_host)s:%(fluent_port)s' % constants
+        self.STATSD_PATH = '%(statsd_host)s:%(statsd_port)s' % constants
+        self.TCP_SYSLOG_PATH = '%(syslog_host)s:%(syslog_port)s' % constants
         self.TAIL_PATH = '%(tail_path)s' % constants
         self.TESTING_FOLDER_PATH = constants['test_dir']
         self.event_size = int(constants['event_size'])
         self.constants['dummy_event'] = build_random_msg_string(self.event_size)
 
         self.available_writers = [
-            SyslogWriter(self.tag, self.SYSLOG_PATH, self.event_size, constants['syslog_protocol']),
-            CEFWriter(self.tag, self.SYSLOG_PATH, self.event_size, constants['syslog_protocol']),
+            SyslogWriter(self.tag, self.SYSLOG_PATH, self.event_size, constants['syslog_protocol'],
+                         constants['syslog_writer'], int(constants['syslog_batch_size'])),
+            CEFWriter(self.tag, self.SYSLOG_PATH, self.event_size, constants['syslog_protocol'],
+                      constants['syslog_writer'], int(constants['syslog_batch_size'])),
+            SecurityEventsWriter(self.tag, self.SECURITY_PATH, self.event_size, constants['security_mix'],
+                                 int(constants['security_extension_fields']), int(constants['syslog_batch_size']),
+                                 int(constants['pool_size']), int(constants['random_seed'])),
+            StatsDWriter(self.tag, self.STATSD_PATH, self.event_size, constants['statsd_mix'],
+                         int(constants['statsd_keys']), int(constants['statsd_metrics_per_datagram']),
+                         int(constants['syslog_batch_size']), float(constants['cardinality_skew']),
+                         int(constants['pool_size']), int(constants['random_seed'])),
             TailFileWriter(self.tag, self.TAIL_PATH, self.event_size),
-            MsgPackWriter(self.tag, self.FLUENT_PATH, self.event_size),
+            MsgPackWriter(self.tag, self.FLUENT_PATH, self.event_size, constants['fluent_mode'],
+                          int(constants['fluent_entries'])),
             # TcpWriter(self.tag, self.SYSLOG_PATH, self.event_size)
         ]
+        if tcp_fanin is not None:
+            # in_syslog has to be in tcp mode, see syslog_protocol.sh
+            self.available_writers.append(
+                TcpFanInWriter(self.tag, self.TCP_SYSLOG_PATH, self.event_size, int(constants['tcp_connections']),
+                               constants['tcp_framing'], int(constants['tcp_connect_concurrency'])))
+        if constants['corpus_path']:
+            rewriter = get_corpus_rewriter(constants['corpus_rewrite'])
+            self.available_writers += [
+                ReplaySyslogWriter(self.tag, self.SYSLOG_PATH, self.event_size, constants['syslog_protocol'],
+                                   constants['corpus_path'], rewriter, int(constants['syslog_batch_size'])),
+                ReplayTailFileWriter(self.tag, self.TAIL_PATH, self.event_size, constants['corpus_path'], rewriter),
+            ]
+        self.event_pool = get_event_pool(constants)
+        for writer in self.available_writers:
+            writer.stamp_events = constants['event_stamps'] == 'true'
+            if self.event_pool is not None and not isinstance(writer, (ReplaySyslogWriter, ReplayTailFileWriter,
+                                                                       SecurityEventsWriter, StatsDWriter)):
+                writer.pool = self.event_pool
+
+    def get_monitored_listeners(self):
+        ports = [int(self.constants[name]) for name in ('syslog_port', 'security_events_port', 'fluent_port',
+                                                          'statsd_port')]
+        # /proc/net/unix shows the path as omsagent bound it
+        return ports, [self.constants['syslog_path'], os.path.abspath(self.constants['syslog_path'])]
 
     def get_writers_by_name(self, names):
         writers = []
@@ -463,12 +2435,851 @@ class ConfigManager:
         for writer in self.available_writers:
             if writer.get_name() in names:
                 writers.append(writer)
+                # the fan-in renders its own raw templates
+                if writer.pool is not None and writer.pool.varies_headers and \
+                        isinstance(writer, SyslogWriter) and writer.writer_mode not in ('raw', 'fanin'):
+                    print("Warning: varied syslog headers require the raw syslog writer, switching '%s' to raw" %
+                          writer.get_name())
+                    writer.writer_mode = 'raw'
 
         if len(writers) == 0:
             print("Warning: No writers was found for these plugins '%s'" % ", ".join(names))
         return writers
 
 
+class OdsSinkStats:
+    """Counters of what out_oms delivered to the ODS stand-in, shared by the request handler threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.nb_requests = 0
+        self.nb_records = 0
+        self.nb_errors = 0
+        self.wire_bytes = 0
+        self.body_bytes = 0
+        self.first_request_time = None
+        self.last_request_time = None
+        self.records_per_second = {}
+        self.data_types = {}
+        self.latencies = []
+        self.failures = {}
+        self.nb_failed_records = 0
+        self.nb_retries = 0
+        self.failed_bodies = set()
+        self.last_failure_time = None
+        self.last_retry_time = None
+
+    def record_request(self, data_type, ip_name, nb_records, wire_bytes, body_bytes, latency, checksum=None):
+        now = time.time()
+        with self.lock:
+            if checksum in self.failed_bodies:
+                # out_oms posts the same body again when it retries a chunk
+                self.failed_bodies.discard(checksum)
+                self.nb_retries += 1
+                self.last_retry_time = now
+            if self.first_request_time is None:
+                self.first_request_time = now
+            self.last_request_time = now
+            self.nb_requests += 1
+            self.nb_records += nb_records
+            self.wire_bytes += wire_bytes
+            self.body_bytes += body_bytes
+            second = int(now)
+            self.records_per_second[second] = self.records_per_second.get(second, 0) + nb_records
+            key = '%s.%s' % (data_type, ip_name)
+            self.data_types[key] = self.data_types.get(key, 0) + nb_records
+            self.latencies.append(latency)
+
+    def record_error(self):
+        with self.lock:
+            self.nb_errors += 1
+
+    def record_failure(self, kind, nb_records, checksum):
+        """A request failed by the fault profile, out_oms raises RetryRequestException and keeps the chunk."""
+        with self.lock:
+            if checksum in self.failed_bodies:
+                self.nb_retries += 1
+            self.failed_bodies.add(checksum)
+            self.failures[kind] = self.failures.get(kind, 0) + 1
+            self.nb_failed_records += nb_records
+            self.last_failure_time = time.time()
+
+    def get_summary(self, begin_time=None):
+        with self.lock:
+            begin_time = begin_time or self.first_request_time
+            duration = (self.last_request_time - begin_time) if self.last_request_time is not None else 0
+            eps = list(self.records_per_second.values())
+            return {
+                'requests': self.nb_requests,
+                'records': self.nb_records,
+                'errors': self.nb_errors,
+                'wire_bytes': self.wire_bytes,
+                'body_bytes': self.body_bytes,
+                'delivered_eps': self.nb_records / duration if duration > 0 else 0,
+                'max_eps': max(eps) if any(eps) else 0,
+                'data_types': dict(self.data_types),
+                'p50_latency_ms': percentile(self.latencies, 50) * 1000,
+                'p99_latency_ms': percentile(self.latencies, 99) * 1000,
+                'max_latency_ms': max(self.latencies) * 1000 if any(self.latencies) else 0,
+                'failures': dict(self.failures),
+                'failed_records': self.nb_failed_records,
+                'retries': self.nb_retries,
+                # failed chunks never delivered, dropped by out_oms or still in its buffer
+                'undelivered_chunks': len(self.failed_bodies),
+                # from the last failure to the last failed chunk delivered
+                'recovery_s': (self.last_retry_time - self.last_failure_time
+                               if self.last_failure_time is not None and self.last_retry_time is not None and
+                               self.last_retry_time > self.last_failure_time else None),
+            }
+
+
+class EventStampTracker:
+    """Decode the stamps of the delivered events to compute latency, gaps, duplicates and reordering per plugin."""
+    MAX_LATENCY_SAMPLES = 100000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.writers = {}
+        self.plugins = {}
+        self.nb_unique = 0
+
+    def get_plugin(self, name):
+        if name not in self.plugins:
+            self.plugins[name] = {'received': 0, 'duplicates': 0, 'reordered': 0, 'latencies': [], 'nb_latencies': 0,
+                                  'max_latency': 0.0}
+        return self.plugins[name]
+
+    def observe(self, text, receive_time):
+        with self.lock:
+            for match in STAMP_RE.finditer(text):
+                writer_id, seq, send_time_ms = match.group(1), int(match.group(2)), int(match.group(3))
+                plugin = self.get_plugin(writer_id.rsplit('.', 1)[0])
+                if writer_id not in self.writers:
+                    self.writers[writer_id] = {'seen': bytearray(), 'max_seq': -1, 'unique': 0}
+                writer = self.writers[writer_id]
+                plugin['received'] += 1
+
+                # one bit per sequence number
+                seen = writer['seen']
+                if seq // 8 >= len(seen):
+                    seen.extend(bytearray(max(seq // 8 + 1 - len(seen), len(seen))))
+                if seen[seq // 8] & (1 << (seq % 8)):
+                    plugin['duplicates'] += 1
+                    continue
+                seen[seq // 8] |= 1 << (seq % 8)
+                writer['unique'] += 1
+                self.nb_unique += 1
+                if seq < writer['max_seq']:
+                    plugin['reordered'] += 1
+                writer['max_seq'] = max(writer['max_seq'], seq)
+
+                latency = max(0.0, receive_time - send_time_ms / 1000.0)
+                plugin['max_latency'] = max(plugin['max_latency'], latency)
+                plugin['nb_latencies'] += 1
+                if len(plugin['latencies']) < self.MAX_LATENCY_SAMPLES:
+                    plugin['latencies'].append(latency)
+                else:
+                    i = random.randint(0, plugin['nb_latencies'] - 1)
+                    if i < self.MAX_LATENCY_SAMPLES:
+                        plugin['latencies'][i] = latency
+
+    def get_summary(self, send_stats=None):
+        """send_stats gives the number of events sent per plugin to count the events never delivered."""
+        send_stats = send_stats or {}
+        summary = {}
+        with self.lock:
+            for name, plugin in self.plugins.items():
+                writers = [w for writer_id, w in self.writers.items() if writer_id.rsplit('.', 1)[0] == name]
+                unique = sum(w['unique'] for w in writers)
+                # sequences missing below the highest one delivered
+                gaps = sum(w['max_seq'] + 1 - w['unique'] for w in writers)
+                sent = send_stats.get(name, {}).get('events', 0)
+                latencies = plugin['latencies']
+                summary[name] = {
+                    'received': plugin['received'],
+                    'unique': unique,
+                    'duplicates': plugin['duplicates'],
+                    'reordered': plugin['reordered'],
+                    'gaps': gaps,
+                    'lost': max(0, sent - unique) if sent > 0 else gaps,
+                    'p50_latency_ms': percentile(latencies, 50) * 1000,
+                    'p90_latency_ms': percentile(latencies, 90) * 1000,
+                    'p99_latency_ms': percentile(latencies, 99) * 1000,
+                    'max_latency_ms': plugin['max_latency'] * 1000,
+                }
+        return summary
+
+
+class AgentThreadClock:
+    """CPU time in ns of every thread of the agent processes, from /proc/<pid>/task/<tid>/schedstat."""
+
+    def __init__(self, pids):
+        self.pids = list(pids)
+
+    def read(self):
+        times = {}
+        for pid in self.pids:
+            task_dir = '/proc/%d/task' % pid
+            try:
+                tids = os.listdir(task_dir)
+            except OSError:
+                continue
+            for tid in tids:
+                try:
+                    with open('%s/%s/schedstat' % (task_dir, tid)) as f:
+                        times[(pid, int(tid))] = int(f.read().split()[0])
+                except (IOError, OSError, ValueError, IndexError):
+                    pass  # exited meanwhile
+        return times
+
+
+class OdsConnectionStats:
+    """TCP connections, TLS handshakes and requests per connection seen by the ODS stand-in.
+
+    The agent side cost of the handshakes is sampled from the threads of omsagent: their CPU time is read before and
+    after every handshake, the CPU a thread spent in these windows beyond its average rate is counted as handshake
+    CPU. Concurrent handshakes share their windows, the estimate is coarser with many flush threads.
+    """
+
+    def __init__(self, agent_clock=None):
+        self.lock = threading.Lock()
+        self.agent_clock = agent_clock
+        self.nb_connections = 0
+        self.nb_handshake_failures = 0
+        self.nb_reused_sessions = 0
+        self.handshake_times = []
+        self.requests_per_connection = []
+        self.window_cpu = {}
+        self.window_time = 0.0
+        self.begin_time = time.time()
+        self.begin_cpu = self.read_agent_cpu()
+
+    def read_agent_cpu(self):
+        return self.agent_clock.read() if self.agent_clock is not None else {}
+
+    def record_connection(self):
+        with self.lock:
+            self.nb_connections += 1
+
+    def record_handshake_failure(self):
+        with self.lock:
+            self.nb_handshake_failures += 1
+
+    def record_handshake(self, duration, cpu_before, cpu_after, reused):
+        with self.lock:
+            self.handshake_times.append(duration)
+            self.nb_reused_sessions += 1 if reused else 0
+            self.window_time += duration
+            for thread, cpu in cpu_after.items():
+                if thread in cpu_before:
+                    self.window_cpu[thread] = self.window_cpu.get(thread, 0) + cpu - cpu_before[thread]
+
+    def record_connection_closed(self, nb_requests):
+        with self.lock:
+            self.requests_per_connection.append(nb_requests)
+
+    def get_agent_handshake_cpu(self):
+        """CPU seconds of the agent threads attributed to the handshakes, and of the agent threads overall."""
+        end_cpu = self.read_agent_cpu()
+        elapsed = time.time() - self.begin_time
+        handshake_cpu = 0
+        total_cpu = 0
+        for thread, cpu in end_cpu.items():
+            thread_cpu = cpu - self.begin_cpu.get(thread, cpu)
+            total_cpu += thread_cpu
+            expected = thread_cpu * self.window_time / elapsed if elapsed > 0 else 0
+            handshake_cpu += max(0, self.window_cpu.get(thread, 0) - expected)
+        return handshake_cpu / 10 ** 9.0, total_cpu / 10 ** 9.0
+
+    def get_summary(self):
+        with self.lock:
+            handshakes = len(self.handshake_times)
+            requests = self.requests_per_connection
+            summary = {
+                'connections': self.nb_connections,
+                'handshakes': handshakes,
+                'handshake_failures': self.nb_handshake_failures,
+                'reused_sessions': self.nb_reused_sessions,
+                'requests': sum(requests),
+                'requests_per_connection': float(sum(requests)) / len(requests) if any(requests) else 0,
+                'max_requests_per_connection': max(requests) if any(requests) else 0,
+                'single_request_connections_pct': (100.0 * len([r for r in requests if r == 1]) / len(requests)
+                                                   if any(requests) else 0),
+                'p50_handshake_ms': percentile(self.handshake_times, 50) * 1000,
+                'p99_handshake_ms': percentile(self.handshake_times, 99) * 1000,
+            }
+            if self.agent_clock is not None:
+                handshake_cpu, total_cpu = self.get_agent_handshake_cpu()
+                summary.update({
+                    'agent_handshake_cpu_s': handshake_cpu,
+                    'agent_cpu_s': total_cpu,
+                    'agent_handshake_cpu_pct': 100.0 * handshake_cpu / total_cpu if total_cpu > 0 else 0,
+                    'agent_cpu_per_handshake_ms': 1000.0 * handshake_cpu / handshakes if handshakes > 0 else 0,
+                })
+            return summary
+
+
+class OdsFaultProfile:
+    """Failures of the ODS stand-in, e.g. 'name=flaky,latency=200,jitter=100,errors=503:5/429:2,reset=1,outage=30-60'.
+
+    latency and jitter delay every response by latency +/- jitter ms. errors fails a percentage of the requests
+    with every status code and reset closes a percentage of the connections with a RST. In the outage windows,
+    seconds since the start of the load, every request fails with outage_mode, a status code or reset.
+    """
+    FIELDS = ['name', 'latency', 'jitter', 'errors', 'reset', 'outage', 'outage_mode']
+
+    def __init__(self, name='none', latency_ms=0, jitter_ms=0, errors=None, reset_pct=0.0, outages=None,
+                 outage_mode='503'):
+        self.name = name
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.errors = errors or []
+        self.reset_pct = reset_pct
+        self.outages = outages or []
+        self.outage_mode = outage_mode
+        self.begin_time = time.time()
+        self.random = random.Random()
+
+    @classmethod
+    def parse(cls, spec):
+        fields = dict(field.split('=', 1) for field in filter(None, spec.split(',')))
+        unknown = set(fields) - set(cls.FIELDS)
+        if unknown:
+            raise ValueError("Unknown ODS fault '%s', use %s" % ("', '".join(sorted(unknown)), ', '.join(cls.FIELDS)))
+        errors = [(int(code), float(pct)) for code, pct in
+                  (error.split(':') for error in filter(None, fields.get('errors', '').split('/')))]
+        outages = [tuple(map(float, window.split('-'))) for window in filter(None, fields.get('outage', '').split('/'))]
+        return cls(fields.get('name', spec or 'none'), float(fields.get('latency', 0)), float(fields.get('jitter', 0)),
+                   errors, float(fields.get('reset', 0)), outages, fields.get('outage_mode', '503'))
+
+    def start(self):
+        self.begin_time = time.time()
+
+    def is_active(self):
+        return self.latency_ms > 0 or self.jitter_ms > 0 or any(self.errors) or self.reset_pct > 0 or any(self.outages)
+
+    def get_delay(self):
+        return max(0.0, self.latency_ms + self.random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000.0
+
+    def get_failure(self):
+        """None to answer 200, 'reset' or the status code of the failure."""
+        elapsed = time.time() - self.begin_time
+        if any(begin <= elapsed < end for begin, end in self.outages):
+            return 'reset' if self.outage_mode == 'reset' else int(self.outage_mode)
+        draw = self.random.uniform(0, 100)
+        if draw < self.reset_pct:
+            return 'reset'
+        draw -= self.reset_pct
+        for code, pct in self.errors:
+            if draw < pct:
+                return code
+            draw -= pct
+        return None
+
+
+class OdsRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.nb_requests = 0
+
+    def finish(self):
+        self.server.connections.record_connection_closed(self.nb_requests)
+        BaseHTTPRequestHandler.finish(self)
+
+    def send_empty_response(self, code):
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def reset_connection(self):
+        # no close_notify and a zero linger time, the client sees a connection reset
+        self.close_connection = True
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        self.connection.close()
+
+    def do_POST(self):
+        begin_time = time.time()
+        stats = self.server.stats
+        self.nb_requests += 1
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            wire_bytes = len(body)
+            if self.headers.get('Content-Encoding', '').lower() == 'deflate':
+                # out_oms uses Zlib::Deflate.deflate which produces a zlib stream
+                body = zlib.decompress(body)
+            record = json.loads(body)
+        except (ValueError, zlib.error):
+            record = None
+        if not isinstance(record, dict):
+            # undecodable, or a JSON list or scalar instead of the out_oms object
+            stats.record_error()
+            self.send_empty_response(400)
+            return
+
+        nb_records = len(record['DataItems']) if 'DataItems' in record else 1
+        faults = self.server.faults
+        checksum = None
+        if faults.is_active():
+            checksum = zlib.crc32(body)
+            time.sleep(faults.get_delay())
+            failure = faults.get_failure()
+            if failure is not None:
+                stats.record_failure(str(failure), nb_records, checksum)
+                if failure == 'reset':
+                    self.reset_connection()
+                else:
+                    self.send_empty_response(failure)
+                return
+        self.send_empty_response(200)
+        if self.server.tracker is not None:
+            self.server.tracker.observe(body.decode('utf-8', 'ignore'), begin_time)
+        stats.record_request(record.get('DataType', ''), record.get('IPName', ''), nb_records, wire_bytes, len(body),
+                             time.time() - begin_time, checksum)
+
+
+class OdsSinkServer(ThreadingMixIn, HTTPServer):
+    """Local HTTPS stand-in of the ODS endpoint that counts the records posted by out_oms."""
+    daemon_threads = True
+    ODS_PATH = '/OperationalData.svc/PostJsonDataItems'
+
+    def __init__(self, host, port, cert_path, key_path):
+        HTTPServer.__init__(self, (host, port), OdsRequestHandler)
+        self.stats = OdsSinkStats()
+        self.tracker = None
+        self.faults = OdsFaultProfile()
+        self.connections = OdsConnectionStats()
+        self.omsadmin_conf = None
+        self.thread = None
+        # the handshakes are done by the request threads to time and count them
+        # PROTOCOL_SSLv23 is deprecated since python 3.6, python 2 only has it
+        self.context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23))
+        self.context.load_cert_chain(cert_path, key_path)
+
+    def finish_request(self, request, client_address):
+        connections = self.connections
+        connections.record_connection()
+        cpu_before = connections.read_agent_cpu()
+        begin_time = time.time()
+        try:
+            tls_request = self.context.wrap_socket(request, server_side=True)
+        except (ssl.SSLError, socket.error):
+            connections.record_handshake_failure()
+            return
+        connections.record_handshake(time.time() - begin_time, cpu_before, connections.read_agent_cpu(),
+                                     getattr(tls_request, 'session_reused', False))
+        try:
+            HTTPServer.finish_request(self, tls_request, client_address)
+        finally:
+            tls_request.close()
+
+    def get_endpoint(self, hostname='localhost'):
+        return 'https://%s:%d%s' % (hostname, self.server_address[1], self.ODS_PATH)
+
+    def handle_error(self, request, client_address):
+        # clients closing without a TLS close_notify, e.g. after an injected failure, are not errors of the stand-in
+        if isinstance(sys.exc_info()[1], socket.error):
+            return
+        HTTPServer.handle_error(self, request, client_address)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+
+def create_self_signed_cert(cert_path, key_path, hostname='localhost'):
+    if os.path.isfile(cert_path) and os.path.isfile(key_path):
+        return
+    cmd = 'openssl req -x509 -newkey rsa:2048 -nodes -days 30 -subj /CN=%s -keyout %s -out %s' % (hostname, key_path,
+                                                                                               cert_path)
+    subprocess.check_call(cmd.split(' '), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    # out_oms verifies the server certificate, omsagent has to trust it
+    print("Generated %s, add it to the trusted certificates of omsagent (e.g. update-ca-certificates)" % cert_path)
+
+
+def redirect_ods_endpoint(omsadmin_conf_path, endpoint):
+    """Point OMS_ENDPOINT of omsadmin.conf to endpoint and return the original content to restore it later."""
+    with open(omsadmin_conf_path) as f:
+        original = f.read()
+    lines = [('OMS_ENDPOINT=%s\n' % endpoint) if line.startswith('OMS_ENDPOINT') else line
+             for line in original.splitlines(True)]
+    with open(omsadmin_conf_path, 'w') as f:
+        f.writelines(lines)
+    return original
+
+
+def restore_omsadmin_conf(omsadmin_conf_path, original):
+    with open(omsadmin_conf_path, 'w') as f:
+        f.write(original)
+
+
+def tune_out_oms(omsagent_config_path, flush_interval='', num_threads=''):
+    """Set flush_interval and num_threads of the out_oms outputs of omsagent.conf, empty values are left as they are.
+    Return the original content to restore it later."""
+    with open(omsagent_config_path) as f:
+        original = f.read()
+    settings = dict((name, value) for name, value in (('flush_interval', flush_interval),
+                                                      ('num_threads', num_threads)) if value)
+    lines = []
+    block = None
+    for line in original.splitlines(True):
+        items = line.split()
+        if block is None:
+            if items and items[0] == '<match':
+                block = []
+            lines.append(line)
+            continue
+        block.append(line)
+        if items and items[0] == '</match>':
+            if any(l.split()[:2] == ['type', 'out_oms'] for l in block):
+                pending = dict(settings)
+                for i, l in enumerate(block[:-1]):
+                    name = l.split()[0] if l.split() else ''
+                    if name in pending:
+                        block[i] = '%s%s %s\n' % (l[:len(l) - len(l.lstrip())], name, pending.pop(name))
+                block[-1:-1] = ['  %s %s\n' % item for item in sorted(pending.items())]
+            lines += block
+            block = None
+    with open(omsagent_config_path, 'w') as f:
+        f.writelines(lines)
+    return original
+
+
+def restore_omsagent_conf(omsagent_config_path, original):
+    with open(omsagent_config_path, 'w') as f:
+        f.write(original)
+
+
+def start_ods_sink(constants):
+    create_self_signed_cert(constants['ods_sink_cert_path'], constants['ods_sink_key_path'])
+    ods_sink = OdsSinkServer(constants['ods_sink_host'], int(constants['ods_sink_port']),
+                             constants['ods_sink_cert_path'], constants['ods_sink_key_path'])
+    if constants['event_stamps'] == 'true':
+        ods_sink.tracker = EventStampTracker()
+    ods_sink.faults = OdsFaultProfile.parse(constants['ods_faults'])
+    ods_sink.start()
+    ods_sink.omsadmin_conf = redirect_ods_endpoint(constants['omsadmin_conf_path'], ods_sink.get_endpoint())
+    run_cmds(restart_oms_cmds)
+    print("ODS stand-in listening on %s%s" % (ods_sink.get_endpoint(), ", faults '%s'" % constants['ods_faults']
+                                              if ods_sink.faults.is_active() else ''))
+    return ods_sink
+
+
+def stop_ods_sink(ods_sink, constants):
+    ods_sink.stop()
+    restore_omsadmin_conf(constants['omsadmin_conf_path'], ods_sink.omsadmin_conf)
+    run_cmds(restart_oms_cmds)
+
+
+def get_buffer_size(buffer_path):
+    size = 0
+    for path in glob.glob(buffer_path):
+        try:
+            size += os.path.getsize(path)
+        except OSError:
+            pass  # flushed meanwhile
+    return size
+
+
+def parse_time_value(value):
+    """Seconds of a fluentd time parameter: 20, 20s, 1m, 1h or 1d."""
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if value[-1:] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+
+def read_buffer_settings(omsagent_config_path):
+    """Queue limit, full action, flush interval and threads of every file buffered output of omsagent.conf, by file
+    prefix."""
+    settings = {}
+    try:
+        with open(omsagent_config_path) as f:
+            lines = f.readlines()
+    except IOError:
+        return settings
+    block = {}
+    for line in lines:
+        items = line.split()
+        if len(items) == 0 or items[0].startswith('#'):
+            continue
+        if items[0] == '</match>':
+            if 'buffer_path' in block:
+                settings[os.path.basename(block['buffer_path']).split('*')[0]] = {
+                    'queue_limit': int(block.get('buffer_queue_limit', 256)),
+                    'full_action': block.get('buffer_queue_full_action', 'exception'),
+                    'num_threads': int(block.get('num_threads', 1)),
+                    'flush_interval': parse_time_value(block.get('flush_interval', '60s')),
+                }
+            block = {}
+        elif len(items) > 1:
+            block[items[0]] = items[1]
+    return settings
+
+
+class BufferMonitor:
+    """Follow the chunk files of the fluentd file buffers from one listing to the next.
+
+    fluentd names a chunk <prefix>.b<id>.buffer while it is filled, renames it to .q<id> when it is enqueued
+    and deletes it once flushed, or when drop_oldest_chunk purges it to make room for a new chunk. Both
+    look the same on disk: a queued chunk vanishing is counted as a drop when the queue was full at that moment,
+    the queue on disk being queue_limit plus the chunks the flush threads are writing.
+    """
+    CHUNK_RE = re.compile(r'^(.+?)\.([bq])([0-9a-f]+)\.buffer$')
+
+    def __init__(self, buffer_path, settings):
+        self.buffer_path = buffer_path
+        self.settings = settings
+        self.previous = {}
+        self.totals = {}
+
+    def get_settings(self, name):
+        for prefix, settings in self.settings.items():
+            if name.startswith(prefix):
+                return settings
+        return {'queue_limit': 10, 'full_action': 'drop_oldest_chunk', 'num_threads': 1}
+
+    def list_chunks(self):
+        chunks = {}
+        for path in glob.glob(self.buffer_path):
+            match = self.CHUNK_RE.match(os.path.basename(path))
+            if match is None:
+                continue
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                continue  # flushed meanwhile
+            name, state, chunk_id = match.groups()
+            chunks[(os.path.dirname(path), name, chunk_id)] = (state, size)
+        return chunks
+
+    def sample(self):
+        now = time.time()
+        chunks = self.list_chunks()
+        buffers = {}
+        for (dirname, name, chunk_id), (state, size) in chunks.items():
+            buf = buffers.setdefault(name, {'staged': 0, 'queued': 0, 'bytes': 0, 'enqueued': 0, 'removed': 0,
+                                            'dropped': 0})
+            buf['staged' if state == 'b' else 'queued'] += 1
+            buf['bytes'] += size
+            if state == 'q' and self.previous.get((dirname, name, chunk_id), ('', 0))[0] != 'q':
+                buf['enqueued'] += 1
+
+        previous_queued = {}
+        for (dirname, name, chunk_id), (state, size) in self.previous.items():
+            if state != 'q':
+                continue
+            previous_queued[name] = previous_queued.get(name, 0) + 1
+            if (dirname, name, chunk_id) not in chunks:
+                buffers.setdefault(name, {'staged': 0, 'queued': 0, 'bytes': 0, 'enqueued': 0, 'removed': 0,
+                                          'dropped': 0})['removed'] += 1
+
+        for name, buf in buffers.items():
+            settings = self.get_settings(name)
+            limit = settings['queue_limit'] + settings['num_threads']
+            if settings['full_action'] == 'drop_oldest_chunk':
+                overflow = previous_queued.get(name, 0) + buf['enqueued'] - limit
+                buf['dropped'] = min(buf['removed'], max(0, overflow))
+            total = self.totals.setdefault(name, {'enqueued': 0, 'removed': 0, 'dropped': 0, 'max_queued': 0,
+                                                  'max_bytes': 0, 'full_samples': 0, 'first_full_time': None,
+                                                  'queue_limit': settings['queue_limit'], 'begin_time': now})
+            total['enqueued'] += buf['enqueued']
+            total['removed'] += buf['removed']
+            total['dropped'] += buf['dropped']
+            total['max_queued'] = max(total['max_queued'], buf['queued'])
+            total['max_bytes'] = max(total['max_bytes'], buf['bytes'])
+            if buf['queued'] >= settings['queue_limit']:
+                total['full_samples'] += 1
+                if total['first_full_time'] is None:
+                    total['first_full_time'] = now
+            total['end_time'] = now
+
+        self.previous = chunks
+        return buffers
+
+    def get_summary(self):
+        summary = {}
+        for name, total in self.totals.items():
+            duration = max(total['end_time'] - total['begin_time'], 1e-3)
+            summary[name] = {
+                'enqueue_rate': total['enqueued'] / duration,
+                'flush_rate': (total['removed'] - total['dropped']) / duration,
+                'enqueued_chunks': total['enqueued'],
+                'flushed_chunks': total['removed'] - total['dropped'],
+                'dropped_chunks': total['dropped'],
+                'max_queued': total['max_queued'],
+                'max_bytes': total['max_bytes'],
+                'queue_limit': total['queue_limit'],
+                'full_samples': total['full_samples'],
+                'queue_full_after_s': (total['first_full_time'] - total['begin_time']
+                                       if total['first_full_time'] is not None else None),
+            }
+        return summary
+
+
+# format of the in_syslog source of security_events.conf, used when the configuration cannot be read
+SECURITY_EVENTS_FORMAT = (r'(?<time>(?:\w+ +){2,3}(?:\d+:){2}\d+|\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}.[\w\-\:\+]{3,12}):?\s*'
+                          r'(?:(?<host>[^: ]+) ?:?)?\s*(?<ident>.*CEF.+?(?=0\|)|%ASA[0-9\-]{8,10})\s*:?'
+                          r'(?<message>0\|.*|.*)')
+RUBY_REGEX_BENCH = """
+regex = Regexp.new(File.read(ARGV[0]))
+lines = File.readlines(ARGV[1]).map(&:chomp)
+matched = 0
+start = Process.clock_gettime(Process::CLOCK_MONOTONIC)
+lines.each { |line| m = regex.match(line); matched += 1 if m && (m[:ident].include?('CEF') || m[:ident].include?('%ASA')) }
+puts "#{matched} #{Process.clock_gettime(Process::CLOCK_MONOTONIC) - start}"
+"""
+
+
+def read_security_events_format(config_path):
+    try:
+        with open(config_path) as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith('format /') and line.endswith('/'):
+                    return line[len('format /'):-1]
+    except IOError:
+        pass
+    return SECURITY_EVENTS_FORMAT
+
+
+def measure_regex_cost(pattern, lines, repeat=10):
+    """Parse time of the lines by the format regex of in_syslog, with the ruby of omsagent when it is installed,
+    otherwise with python re which only approximates the backtracking of Onigmo."""
+    lines = lines * repeat
+    ruby_path = get_ruby_path()
+    if ruby_path is not None:
+        workdir = tempfile.mkdtemp()
+        try:
+            paths = [os.path.join(workdir, name) for name in ('regex', 'lines', 'bench.rb')]
+            for path, content in zip(paths, (pattern, '\n'.join(lines) + '\n', RUBY_REGEX_BENCH)):
+                with open(path, 'w') as f:
+                    f.write(content)
+            output = subprocess.check_output([ruby_path, paths[2], paths[0], paths[1]]).decode('ASCII').split()
+            matched, elapsed = int(output[0]), float(output[1])
+            engine = 'ruby %s' % get_ruby_version(ruby_path)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    else:
+        regex = re.compile(pattern.replace('(?<', '(?P<'))
+        matched = 0
+        start = time.time()
+        for line in lines:
+            m = regex.match(line)
+            if m and ('CEF' in m.group('ident') or '%ASA' in m.group('ident')):
+                matched += 1
+        elapsed = time.time() - start
+        engine = 'python re'
+    return {'engine': engine, 'events': len(lines), 'matched': matched,
+            'avg_len': average([len(line) for line in lines]), 'us_per_event': elapsed * 10 ** 6 / len(lines)}
+
+
+RUBY_STATSD_BENCH = """
+require 'json'
+module OMS; module Common; def self.format_time(time) Time.at(time).utc.strftime('%Y-%m-%dT%H:%M:%S.%LZ') end; end; end
+class NullLog; def method_missing(*args) end; end
+# the requires of the plugin directory are not needed by the aggregation
+eval(File.read(ARGV[0]).gsub(/^\\s*require_relative.*$/, ''))
+threshold_percentile, nb_values = Integer(ARGV[1]), Integer(ARGV[2])
+results = ARGV[3].split(',').map(&:to_i).map do |nb_keys|
+  state = OMS::StatsDState.new(10, threshold_percentile, nil, NullLog.new)
+  lines = (0...nb_values).map { |i| "omstest.timer.#{i % nb_keys}:#{rand * 100}|ms" }
+  start = Process.clock_gettime(Process::CLOCK_MONOTONIC)
+  lines.each_slice(100) { |slice| state.receive(slice.join("\\n")) }
+  received = Process.clock_gettime(Process::CLOCK_MONOTONIC)
+  metrics = state.convert_to_oms_format(Time.now.to_f, 'localhost')
+  flushed = Process.clock_gettime(Process::CLOCK_MONOTONIC)
+  {'timer_keys' => nb_keys, 'values' => nb_values, 'records' => metrics.length,
+   'receive_us_per_value' => (received - start) * 1e6 / nb_values, 'flush_ms' => (flushed - received) * 1e3}
+end
+puts JSON.generate(results)
+"""
+
+
+def get_plugin_path(path):
+    """The installed plugin, or the one of this repository when omsagent is not installed."""
+    if os.path.isfile(path):
+        return path
+    return os.path.join(REPO_PLUGINS_DIR, os.path.basename(path))
+
+
+def measure_statsd_flush_cost(statsd_lib_path, threshold_percentile, nb_values, timer_keys):
+    """Receive then flush nb_values timer values spread over every number of distinct timer keys with the
+    StatsDState of statsd_lib.rb, which sorts the values of every key for the percentiles at each flush."""
+    ruby_path = get_ruby_path()
+    if ruby_path is None:
+        return []
+    workdir = tempfile.mkdtemp()
+    try:
+        bench_path = os.path.join(workdir, 'statsd_bench.rb')
+        with open(bench_path, 'w') as f:
+            f.write(RUBY_STATSD_BENCH)
+        output = subprocess.check_output([ruby_path, bench_path, get_plugin_path(statsd_lib_path),
+                                          '%d' % threshold_percentile, '%d' % max(1, nb_values),
+                                          ','.join('%d' % k for k in timer_keys)])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return json.loads(output.decode('ASCII'))
+
+
+class SecurityEpsLog:
+    """The 'Security Syslog EPS' lines logged every second by SyslogSecurityEventsFilter.check_eps, which is
+    commented out in filter_syslog_security.rb and has to be enabled in the installed plugin.
+
+    The counter is reset by a sleeping thread, intervals well above a second show that the thread is starved.
+    """
+    EPS_RE = re.compile(r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) .*Security Syslog EPS (\d+), for ([\d.]+) second')
+    LATE_INTERVAL_S = 1.5
+
+    def __init__(self, log_path):
+        self.log_path = log_path
+        self.offset = 0
+
+    def mark(self):
+        self.offset = os.path.getsize(self.log_path) if os.path.isfile(self.log_path) else 0
+
+    def read(self):
+        series = []
+        if os.path.isfile(self.log_path):
+            with open(self.log_path) as f:
+                f.seek(self.offset)
+                for line in f:
+                    m = self.EPS_RE.match(line)
+                    if m:
+                        series.append({'time': m.group(1), 'eps': int(m.group(2)), 'interval_s': float(m.group(3))})
+        return series
+
+    @classmethod
+    def get_summary(cls, series):
+        if not series:
+            return {}
+        eps = [s['eps'] for s in series]
+        intervals = [s['interval_s'] for s in series]
+        return {'ticks': len(series), 'mean_eps': average(eps), 'max_eps': max(eps),
+                'max_interval_s': max(intervals),
+                'late_ticks': len([i for i in intervals if i > cls.LATE_INTERVAL_S])}
+
+
+def add_stack_profiles(profiler, stack_profiles):
+    """Split the mean cpu of every profiled process between the categories of its ruby stacks."""
+    for name, sampling in profiler.items():
+        stacks = stack_profiles.get(int(name.rsplit('-', 1)[1]))
+        if stacks is None:
+            continue
+        sampling['stacks'] = stacks
+        sampling['cpu_by_category'] = dict((category, sampling['cpu']['mean'] * pct / 100)
+                                           for category, pct in stacks['breakdown_pct'].items())
+
 
 class LoadBench:
     def __init__(self, run_time, sampling_rate, config_mgr):
@@ -476,13 +3287,27 @@ class LoadBench:
         self.sampling_rate = sampling_rate
         self.config_mgr = config_mgr
         self.do_profiling = True
+        self.nb_workers = 1
+        self.writer_eps = {}
+        self.workers_results = []
+        self.pacing = {'mode': 'token', 'burst_size': 10, 'tick': 0.0005}
+        self.schedule_lag = {}
+        self.sampler = None
+        self.drops_series = []
+        self.samples_index = {}
+        self.buffer_series = []
+        self.buffer_summary = {}
+        self.security_eps_series = []
+        self.soak = None  # warmup and leak_threshold of a soak run
+        self.soak_report = {}
+        self.stack_profiler = None  # RubyStackProfiler of the runs sampling the ruby stacks
         self.test_status_path = os.path.join(os.path.dirname(self.config_mgr.constants['result_path']), 'status.txt')
 
         self.reset_workspace()
 
     @staticmethod
     def get_pids(name):
-        return map(int, subprocess.check_output(["pidof", name]).split())
+        return [int(pid) for pid in subprocess.check_output(["pidof", name]).split()]
 
     def save_test_status(self, context, elapsed_seconds, sampling):
         lines = []
@@ -491,12 +3316,12 @@ class LoadBench:
             lines.append('status_time   : %s\n' % datetime.now().time())
             lines.append('elapsed_time  : %d seconds\n' % elapsed_seconds)
             lines.append('--------------- Configuration ----------------\n')
-            for name, value in self.config_mgr.constants.iteritems():
+            for name, value in self.config_mgr.constants.items():
                 lines.append("%s\t\t\t: %s\n" % (name, value))
             lines.append('--------------- Test dir ----------------\n')
             listing_files = 'ls -la %s' % self.config_mgr.TESTING_FOLDER_PATH
             content = subprocess.Popen(listing_files.split(' '), stdout=subprocess.PIPE,
-                                       stderr=subprocess.STDOUT).stdout.readlines()
+                                       stderr=subprocess.STDOUT, universal_newlines=True).stdout.readlines()
             lines += content
             lines.append('--------------- Sampling ------------------\n')
             lines.append('sampling\t: %s\n' % json.dumps(sampling, ensure_ascii=True))
@@ -507,8 +3332,71 @@ class LoadBench:
         os.system("sudo chmod 777 -R  %s" % self.config_mgr.TESTING_FOLDER_PATH)
         os.system("sudo rm -rf %s/* " % self.config_mgr.TESTING_FOLDER_PATH)
 
+    def is_sharded(self):
+        return self.nb_workers > 1 or any(self.writer_eps)
+
     def run_load(self, eps, processes, writers):
-                return self.run_load_for_duration(eps, processes, writers, self.run_time, self.sampling_rate)
+        security_eps_log = None
+        if any(isinstance(w, SecurityEventsWriter) for w in writers):
+            security_eps_log = SecurityEpsLog(self.config_mgr.constants['omsagent_log_path'])
+            security_eps_log.mark()
+        if self.is_sharded():
+            result = self.run_sharded_load(eps, processes, writers, self.run_time, self.sampling_rate)
+        elif self.pacing['mode'] == 'token':
+            result = self.run_paced_load_for_duration(eps, processes, writers, self.run_time, self.sampling_rate)
+        else:
+            result = self.run_load_for_duration(eps, processes, writers, self.run_time, self.sampling_rate)
+        if security_eps_log is not None:
+            self.security_eps_series = security_eps_log.read()
+        for writer in writers:
+            writer.close()
+        return result
+
+    def profile(self, processes, store):
+        if self.sampler is not None:
+            return self.sampler.profile(processes, store)
+        return profile(processes, store)
+
+    def get_listener_monitor(self):
+        ports, unix_paths = self.config_mgr.get_monitored_listeners()
+        return ListenerMonitor(ports, unix_paths)
+
+    def get_buffer_monitor(self):
+        constants = self.config_mgr.constants
+        return BufferMonitor(constants['buffer_path'], read_buffer_settings(constants['omsagent_config_path']))
+
+    def start_sampling(self, processes, writers, sampling_rate):
+        if not self.do_profiling:
+            return None
+        samples_path = '%s.%s.samples' % (self.config_mgr.constants['result_path'],
+                                          datetime.now().strftime('%Y%m%d-%H%M%S'))
+        sampler = BackgroundSampler(self, processes, writers, sampling_rate, samples_path)
+        sampler.start()
+        if self.stack_profiler is not None:
+            self.stack_profiler.start([p.pid for p in processes], samples_path[:-len('.samples')])
+        return sampler
+
+    def stop_sampling(self, sampler, processes):
+        if sampler is None:
+            return {}, processes
+        store = sampler.stop()
+        profiler = store.summarize()
+        if self.stack_profiler is not None:
+            add_stack_profiles(profiler, self.stack_profiler.stop())
+        if self.soak is not None:
+            self.soak_report = store.analyze_soak(self.soak['warmup'], self.sampling_rate,
+                                                  self.soak['leak_threshold'])
+        self.samples_index = store.get_index()
+        self.drops_series = sampler.drops
+        self.buffer_series = sampler.buffers
+        self.buffer_summary = sampler.buffer_summary
+        processes = []
+        for pid in sampler.pids:
+            try:
+                processes.append(psutil.Process(pid))
+            except psutil.NoSuchProcess:
+                pass
+        return profiler, processes
 
     def clear_dead_process(self, processes):
         terminated_processes = []
@@ -524,14 +3412,9 @@ class LoadBench:
         total_events = run_time * eps
         response_times = [0]
         nb_events = 0
-        profile_diff_time = 0
-        profiler = {}
-
-        if self.do_profiling:
-            processes, profiler = profile(processes, profiler)
 
+        sampler = self.start_sampling(processes, writers, sampling_rate)
         elapsed_time = 0.0
-        last_profile_time = 0.0
         while nb_events < total_events:
             previous_elapsed_time = elapsed_time
             begin_time = time.time()
@@ -540,31 +3423,60 @@ class LoadBench:
             nb_events += eps
             diff_time = round(time.time() - begin_time, 1)
             response_times.append(diff_time)
-
             elapsed_time += (time.time() - begin_time)
-            if self.do_profiling:
-                begin_time = time.time()
-                if (elapsed_time - last_profile_time) >= sampling_rate:
-                    processes = self.clear_dead_process(processes)
-                    processes = find_children_processes(processes)
-                    processes, profiler = profile(processes, profiler)
-                    last_profile_time = elapsed_time
-                profile_diff_time = time.time() - begin_time
-                elapsed_time += profile_diff_time
 
             # sleep the rest of the time to complete 1 second
-            sleep_time = 1 - diff_time - profile_diff_time - 0.05
+            sleep_time = 1 - diff_time - 0.05
             if sleep_time > 0.05:
                 begin_time = time.time()
                 time.sleep(sleep_time)
                 elapsed_time += (time.time() - begin_time)
 
             if round(elapsed_time - previous_elapsed_time, 2) > 1:
-                print('%s: Took more than 1s for %d EPS: total_time=%.3f s, resp_time=%.2f s, profile_time=%.2f s, '
-                      'sleep_time=%.2f s' % (datetime.now().time(), eps, elapsed_time - previous_elapsed_time,
-                                             diff_time, profile_diff_time, sleep_time))
+                print('%s: Took more than 1s for %d EPS: total_time=%.3f s, resp_time=%.2f s, sleep_time=%.2f s' %
+                      (datetime.now().time(), eps, elapsed_time - previous_elapsed_time, diff_time, sleep_time))
 
+        profiler, processes = self.stop_sampling(sampler, processes)
         self.save_test_status('done', elapsed_time, profiler)
+        self.flush_processes(processes)
+        return profiler, response_times, nb_events, elapsed_time
+
+    def run_paced_load_for_duration(self, eps, processes, writers, run_time, sampling_rate):
+        total_events = run_time * eps
+        response_times = [0]
+        nb_events = 0
+
+        sampler = self.start_sampling(processes, writers, sampling_rate)
+        pacer = TokenBucketPacer(eps, self.pacing['burst_size'], self.pacing['tick'])
+        begin_time = time.time()
+        pacer.start()
+        while nb_events < total_events:
+            batch = pacer.next_batch(total_events - nb_events)
+            batch_begin = time.time()
+            for writer in writers:
+                writer.write(eps=batch)
+            nb_events += batch
+            response_times.append(time.time() - batch_begin)
+
+        elapsed_time = time.time() - begin_time
+        self.schedule_lag = pacer.get_lag_stats()
+        profiler, processes = self.stop_sampling(sampler, processes)
+        self.save_test_status('done', elapsed_time, profiler)
+        self.flush_processes(processes)
+        return profiler, response_times, nb_events, elapsed_time
+
+    def get_send_stats(self, writers):
+        if not any(self.workers_results):
+            return dict((w.get_name(), w.get_send_stats()) for w in writers)
+        send_stats = {}
+        for r in self.workers_results:
+            for name, stats in r['send_stats'].items():
+                merged = send_stats.setdefault(name, {})
+                for key, value in stats.items():
+                    merged[key] = merged.get(key, 0) + value
+        return send_stats
+
+    def flush_processes(self, processes):
         # wait more times for collecting more data
         # force flushing
         processes = self.clear_dead_process(processes)
@@ -572,52 +3484,582 @@ class LoadBench:
             if proc.is_running():
                 proc.send_signal(psutil.signal.SIGUSR1)
 
-        return profiler, response_times, nb_events
+    def get_shards(self, eps, writers):
+        # with a mix, every writer has its own workers and EPS, otherwise all the workers run all the writers
+        if any(self.writer_eps):
+            return [([writer.get_name()], worker_eps) for writer in writers
+                    for worker_eps in split_eps(self.writer_eps[writer.get_name()], self.nb_workers)]
+        plugins = [writer.get_name() for writer in writers]
+        return [(plugins, worker_eps) for worker_eps in split_eps(eps, self.nb_workers)]
+
+    def get_ingested_events(self, nb_events, writers):
+        # a mix counts the events of all its writers, otherwise each writer sent nb_events
+        return nb_events if any(self.writer_eps) else nb_events * len(writers)
+
+    def run_sharded_load(self, eps, processes, writers, run_time, sampling_rate):
+        queue = multiprocessing.Queue()
+        workers = []
+        for worker_id, (plugins, worker_eps) in enumerate(self.get_shards(eps, writers)):
+            if worker_eps == 0:
+                continue
+            worker = multiprocessing.Process(target=run_load_worker,
+                                             args=(worker_id, self.config_mgr.constants, plugins, worker_eps,
+                                                   run_time, self.pacing, queue))
+            worker.daemon = True
+            workers.append(worker)
+
+        sampler = self.start_sampling(processes, writers, sampling_rate)
+        begin_time = time.time()
+        for worker in workers:
+            worker.start()
+
+        # the load is generated by the workers, the observation by the sampler
+        self.workers_results = []
+        while len(self.workers_results) < len(workers):
+            try:
+                self.workers_results.append(queue.get(timeout=1))
+            except Queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    break
+
+        for worker in workers:
+            worker.join()
+        elapsed_time = time.time() - begin_time
+
+        nb_events = sum(r['nb_events'] for r in self.workers_results)
+        response_times = [r['elapsed_time'] for r in self.workers_results] or [0]
+        for r in sorted(self.workers_results, key=lambda r: r['worker']):
+            print("Worker %d: %d events at %d EPS in %.2f s" % (r['worker'], r['nb_events'], r['eps'],
+                                                                 r['elapsed_time']))
+        paced_results = [r for r in self.workers_results if 'lag_samples' in r]
+        if any(paced_results):
+            self.schedule_lag = summarize_lags(sum([r['lag_samples'] for r in paced_results], []),
+                                               max(r['max_lag'] for r in paced_results),
+                                               sum(r['nb_batches'] for r in paced_results))
+        if len(self.workers_results) < len(workers):
+            print("Warning: only %d/%d workers reported their results" % (len(self.workers_results), len(workers)))
+
+        profiler, processes = self.stop_sampling(sampler, processes)
+        self.save_test_status('done', elapsed_time, profiler)
+        self.flush_processes(processes)
+        return profiler, response_times, nb_events, elapsed_time
 
     def save_results(self, results, write_header=True):
         path = self.config_mgr.constants['result_path']
-        header_list = ['res', 'proc', 'plugins', 'eps', 'run_time', 'avg_cpu', 'max_cpu', 'avg_mem', 'max_mem',
-        'last_mem', 'minor_flt', 'major_flt', 'nb_events', 'drops']
+        header_list = ['res', 'proc', 'plugins', 'eps', 'achieved_eps', 'delivered_eps', 'e2e_p99_ms', 'lost_events',
+        'workers', 'lag_p99_ms', 'run_time', 'avg_cpu', 'max_cpu', 'avg_mem', 'max_mem', 'last_mem', 'minor_flt',
+        'major_flt', 'nb_events', 'drops']
+        stats_header = ['p50_cpu', 'p95_cpu', 'p99_cpu', 'std_cpu', 'p50_mem', 'p95_mem', 'p99_mem', 'std_mem',
+                        'cpu_by_category']
 
         with open(path, "a") as csvfile, open(path + '.json', 'a') as jsonfile:
             # json
-            jsonfile.write(json.dumps(results, ensure_ascii=True))
+            jsonfile.write(json.dumps(results, ensure_ascii=True) + '\n')
             # csv
             lines = []
-            stats_header = []
-            # compute stats
-            stats_entries = []
-            for procname, sampling in results['profiling'].iteritems():
-                max_cpu = max(sampling['cpu']) if any(sampling['cpu']) else 0
-                avg_cpu = np.mean(sampling['cpu']) if any(sampling['mem']) else 0
-                last_mem = sampling['mem'][-1] if any(sampling['mem']) else 0
-                max_mem = max(sampling['mem']) if any(sampling['mem']) else 0
-                avg_mem = np.mean(sampling['mem']) if any(sampling['mem']) else 0
-                minor_flt = max(sampling['minor_flt']) - min(sampling['minor_flt']) if any(sampling['minor_flt']) else 0
-                major_flt = max(sampling['major_flt']) - min(sampling['major_flt']) if any(sampling['major_flt']) else 0
+            for procname, sampling in results['profiling'].items():
+                cpu, mem = sampling['cpu'], sampling['mem']
+                max_cpu, avg_cpu = cpu['max'], cpu['mean']
+                last_mem, max_mem, avg_mem = sampling['last_mem'], mem['max'], mem['mean']
+                minor_flt, major_flt = sampling['minor_flt'], sampling['major_flt']
+                stats_entries = ['%.2f' % v for v in (cpu['p50'], cpu['p95'], cpu['p99'], cpu['std'],
+                                                      mem['p50'], mem['p95'], mem['p99'], mem['std'])]
                 stats_line = ",".join(map(str, stats_entries))
+                cpu_by_category = '|'.join('%s:%.2f' % (category, value) for category, value in
+                                           sorted(sampling.get('cpu_by_category', {}).items())) or 0
                 drops = '|'.join(results['drops']) if len(results['drops']) > 0 else 0
                 print("%s cpu=%.2f %%, mem=%d MB" % (procname, avg_cpu, avg_mem))
-                line = ('"%s" ,"%s", "%s", %d, %s, %.2f, %.2f, %d, %d, %d, %d, %d, %d, %s, %s\n' %
-                        (get_resources(), procname, results['plugins'], results['eps'], results['run_time'],
+                if 'stacks' in sampling:
+                    print("%s ruby stacks: %s (%d samples in %s)" %
+                          (procname, cpu_by_category.replace('|', ' %, ').replace(':', '=') + ' %',
+                           sampling['stacks']['samples'], sampling['stacks']['folded']))
+                lag_p99 = results['schedule_lag']['p99_ms'] if any(results['schedule_lag']) else 0
+                delivered_eps = results['ods']['delivered_eps'] if any(results['ods']) else 0
+                pipeline = results['pipeline'].values()
+                e2e_p99 = max([p['p99_latency_ms'] for p in pipeline] or [0])
+                lost_events = sum([p['lost'] for p in pipeline])
+                line = ('"%s" ,"%s", "%s", %d, %.2f, %.2f, %.1f, %d, %d, %.3f, %s, %.2f, %.2f, %d, %d, %d, %d, %d, %d, %s, %s, %s\n' %
+                        (get_resources(), procname, results['plugins'], results['eps'], results['achieved_eps'],
+                        delivered_eps, e2e_p99, lost_events, results['workers'], lag_p99, results['run_time'],
                         avg_cpu, max_cpu, avg_mem, max_mem, last_mem,
-                        minor_flt, major_flt, results['nb_events'], drops, stats_line))
+                        minor_flt, major_flt, results['nb_events'], drops, stats_line, cpu_by_category))
                 lines.append(line)
 
-                for tid, thread_sampling in sampling['threads'].iteritems():
-                    lines.append('"%s", %.2f, %.2f\n' % (tid, np.mean(thread_sampling), max(thread_sampling)))
+                for tid, thread_cpu in sampling['threads'].items():
+                    lines.append('"%s", %.2f, %.2f, %.2f, %.2f, %.2f, %.2f\n' %
+                                 (tid, thread_cpu['mean'], thread_cpu['max'], thread_cpu['p50'], thread_cpu['p95'],
+                                  thread_cpu['p99'], thread_cpu['std']))
 
             if write_header:
                 header = "%s\n" % ','.join(header_list + stats_header)
                 csvfile.write(header)
             csvfile.writelines(lines)
 
+class SaturationFinder:
+    """Ramp then binary search the EPS of each plugin up to the highest rate within the limits."""
+
+    def __init__(self, loadbench, config_mgr, limits, pids, ods_sink=None):
+        self.loadbench = loadbench
+        self.config_mgr = config_mgr
+        self.limits = limits
+        self.pids = pids
+        self.ods_sink = ods_sink
+
+    def get_sent_events(self, writers):
+        """Events sent by every writer that counts them, the sharded runs report only their own run."""
+        return dict((name, stats['events']) for name, stats in self.loadbench.get_send_stats(writers).items()
+                    if 'events' in stats)
+
+    def probe(self, eps, writers):
+        processes = [psutil.Process(pid) for pid in self.pids] if self.loadbench.do_profiling else []
+        # the writers of a single process run keep counting from probe to probe
+        sent_before = {} if self.loadbench.is_sharded() else self.get_sent_events(writers)
+        drops_before = sum(w.get_number_dropped_event() for w in writers)
+        buffer_before = get_buffer_size(self.config_mgr.constants['buffer_path'])
+        if self.ods_sink is not None and self.ods_sink.tracker is not None:
+            self.ods_sink.tracker = EventStampTracker()
+
+        profiling, response_times, nb_events, elapsed_time = self.loadbench.run_load(eps, processes, writers)
+        # the buffer drains while waiting for the delivery
+        buffer_after = get_buffer_size(self.config_mgr.constants['buffer_path'])
+        sent = dict((name, events - sent_before.get(name, 0)) for name, events in self.get_sent_events(writers).items())
+        # the pacer counts what was handed to the writers, asynchronous writers may not have sent all of it
+        nb_ingested = self.loadbench.get_ingested_events(nb_events, writers)
+        sent_ratio = 1.0
+        if len(sent) == len(writers) and nb_ingested > 0:
+            sent_ratio = min(1.0, float(sum(sent.values())) / nb_ingested)
+        wait_time_after_completion = int(self.config_mgr.constants['wait_time_after_completion'])
+        if wait_time_after_completion > 0:
+            time.sleep(wait_time_after_completion)
+        # the tracker is reset for every probe, it is compared to what this probe sent
+        probe_send_stats = dict((name, {'events': events}) for name, events in sent.items())
+        if self.ods_sink is not None and self.ods_sink.tracker is not None:
+            self.wait_for_delivery(probe_send_stats)
+
+        result = {
+            'eps': eps,
+            'achieved_pct': 100.0 * nb_events * sent_ratio / (elapsed_time * eps) if elapsed_time > 0 else 0,
+            'drops_pct': 100.0 * (sum(w.get_number_dropped_event() for w in writers) - drops_before) / max(1, nb_events),
+            'buffer_growth_mb': (buffer_after - buffer_before) / 10 ** 6.0,
+            'latency_ms': None,
+            'cpu': sum(p['cpu']['mean'] for p in profiling.values()),
+        }
+        if self.ods_sink is not None and self.ods_sink.tracker is not None:
+            pipeline = self.ods_sink.tracker.get_summary(probe_send_stats)
+            result['latency_ms'] = max([p['p99_latency_ms'] for p in pipeline.values()] or [0])
+
+        failures = []
+        if result['achieved_pct'] < self.limits['min_achieved_pct']:
+            failures.append('harness')
+        if result['drops_pct'] > self.limits['drops_pct']:
+            failures.append('drops')
+        if result['buffer_growth_mb'] > self.limits['buffer_growth_mb']:
+            failures.append('buffer')
+        if result['latency_ms'] is not None and result['latency_ms'] > self.limits['latency_ms']:
+            failures.append('latency')
+        result['failures'] = failures
+        latency = '%.1f ms' % result['latency_ms'] if result['latency_ms'] is not None else 'n/a'
+        print("Probe %d EPS: achieved=%.1f%%, drops=%.3f%%, buffer growth=%.2f MB, latency=%s, cpu=%.1f%% -> %s" %
+              (eps, result['achieved_pct'], result['drops_pct'], result['buffer_growth_mb'], latency, result['cpu'],
+               ','.join(failures) or 'ok'))
+        return result
+
+    def get_flush_interval(self):
+        constants = self.config_mgr.constants
+        if constants['out_oms_flush_interval']:
+            return parse_time_value(constants['out_oms_flush_interval'])
+        settings = read_buffer_settings(constants['omsagent_config_path'])
+        return max([s['flush_interval'] for s in settings.values()] or [60])
+
+    def wait_for_delivery(self, send_stats):
+        """Wait for the events still buffered by out_oms, otherwise they count as lost and their latency is missed.
+
+        The last chunk may have just missed a flush, so the wait lasts up to two flush intervals.
+        """
+        nb_sent = sum(stats.get('events', 0) for stats in send_stats.values())
+        deadline = time.time() + 2 * self.get_flush_interval()
+        while self.ods_sink.tracker.nb_unique < nb_sent and time.time() < deadline:
+            time.sleep(0.5)
+
+    def search(self, writers, min_eps, max_eps, precision, settle_time):
+        best = None
+        failed = None
+        eps = min_eps
+        # exponential ramp until the first failure
+        while eps <= max_eps:
+            result = self.probe(eps, writers)
+            time.sleep(settle_time)
+            if any(result['failures']):
+                failed = result
+                break
+            best = result
+            eps *= 2
+
+        if failed is None:
+            return best, None
+        # binary search between the last sustainable and the first failing rate
+        low = best['eps'] if best is not None else 0
+        high = failed['eps']
+        while high - low > max(1, low * precision):
+            eps = (low + high) // 2
+            result = self.probe(eps, writers)
+            time.sleep(settle_time)
+            if any(result['failures']):
+                high, failed = eps, result
+            else:
+                low, best = eps, result
+        return best, failed
+
+    def run(self, plugins, min_eps, max_eps, precision, settle_time):
+        capacity = []
+        for plugin in plugins:
+            writers = self.config_mgr.get_writers_by_name([plugin])
+            if len(writers) == 0:
+                continue
+            print("Searching the maximum sustainable EPS of '%s'" % plugin)
+            best, failed = self.search(writers, min_eps, max_eps, precision, settle_time)
+            capacity.append({
+                'plugin': plugin,
+                'event_size': self.config_mgr.event_size,
+                'protocol': writers[0].get_protocol(),
+                'max_eps': best['eps'] if best is not None else 0,
+                'cpu': best['cpu'] if best is not None else 0,
+                'limited_by': ','.join(failed['failures']) if failed is not None else 'max_eps',
+            })
+        return capacity
+
+    def save_capacity_table(self, capacity):
+        path = self.config_mgr.constants['capacity_path']
+        write_header = not os.path.exists(path)
+        print("%-12s %-10s %-8s %-10s %-8s %s" % ('plugin', 'event_size', 'protocol', 'max_eps', 'cpu%', 'limited_by'))
+        with open(path, 'a') as csvfile:
+            if write_header:
+                csvfile.write('res,plugin,event_size,protocol,max_eps,cpu_at_max,limited_by\n')
+            for row in capacity:
+                print("%(plugin)-12s %(event_size)-10d %(protocol)-8s %(max_eps)-10d %(cpu)-8.1f %(limited_by)s" % row)
+                csvfile.write('"%s", "%s", %d, "%s", %d, %.2f, "%s"\n' %
+                              (get_resources() if self.loadbench.do_profiling else '', row['plugin'], row['event_size'], row['protocol'], row['max_eps'],
+                               row['cpu'], row['limited_by']))
+
+
+def mann_whitney_u(baseline, candidate):
+    """One sided p-value of the candidate being stochastically greater than the baseline.
+
+    Normal approximation of the U statistic with tie and continuity corrections, good enough from ~8 values.
+    """
+    n1, n2 = len(baseline), len(candidate)
+    n = n1 + n2
+    values = sorted([(v, 0) for v in baseline] + [(v, 1) for v in candidate])
+    candidate_ranks = 0.0
+    ties = 0.0
+    i = 0
+    while i < n:
+        j = i
+        while j + 1 < n and values[j + 1][0] == values[i][0]:
+            j += 1
+        rank = (i + j) / 2.0 + 1
+        candidate_ranks += rank * sum(1 for k in range(i, j + 1) if values[k][1] == 1)
+        ties += (j - i + 1) ** 3 - (j - i + 1)
+        i = j + 1
+    u = candidate_ranks - n2 * (n2 + 1) / 2.0
+    sigma = math.sqrt(n1 * n2 / 12.0 * ((n + 1) - ties / (n * (n - 1))))
+    if sigma == 0:
+        return 1.0
+    z = (u - n1 * n2 / 2.0 - 0.5) / sigma
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def load_result_set(path):
+    # older result files are concatenated JSON documents without separators
+    decoder = json.JSONDecoder()
+    with open(path) as f:
+        data = f.read()
+    results = []
+    index = 0
+    while True:
+        while index < len(data) and data[index].isspace():
+            index += 1
+        if index >= len(data):
+            break
+        result, index = decoder.raw_decode(data, index)
+        results.append(result)
+    return results
+
+
+def read_samples(result, result_path):
+    index = result.get('samples') or {}
+    if not index.get('path'):
+        return None
+    path = index['path']
+    if not os.path.exists(path):
+        path = os.path.join(os.path.dirname(result_path), os.path.basename(path))
+        if not os.path.exists(path):
+            return None
+    nb_columns = len(index['columns'])
+    values = array.array('d')
+    with open(path, 'rb') as f:
+        values.fromfile(f, index['rows'] * nb_columns)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    column = dict((name, i) for i, name in enumerate(index['columns']))
+    rows = [values[i:i + nb_columns] for i in range(0, len(values), nb_columns)]
+    return index['names'], column, rows
+
+
+class ResultComparator:
+    """Compare the metric distributions of result sets against the first one, used as the baseline.
+
+    Runs are matched by plugins, eps and event_size. A metric regresses when its median grows more than its
+    threshold and, with enough values on both sides, the Mann-Whitney test finds the growth significant.
+    Consecutive samples of one run are autocorrelated, which is why the threshold is required as well.
+    """
+    MIN_SAMPLES = 8
+    # smallest baseline used to compute a relative change, avoids dividing by an idle cpu or zero drops
+    FLOORS = {'cpu': 1.0, 'rss_mb': 1.0, 'drops': 1.0, 'latency_ms': 1.0}
+
+    def __init__(self, thresholds, significance):
+        self.thresholds = thresholds
+        self.significance = significance
+
+    @staticmethod
+    def get_run_key(result):
+        return result['plugins'], result['eps'], (result.get('config') or {}).get('event_size', '')
+
+    def get_metrics(self, result, result_path):
+        metrics = {}
+        samples = read_samples(result, result_path)
+        if samples is not None:
+            names, column, rows = samples
+            for row in rows:
+                if row[column['tid']] != 0:
+                    continue
+                procname = names[int(row[column['name']])].rsplit('-', 1)[0]
+                metrics.setdefault('cpu:%s' % procname, []).append(row[column['cpu']])
+                metrics.setdefault('rss_mb:%s' % procname, []).append(row[column['rss']] / 10 ** 6)
+        else:
+            for key, sampling in result.get('profiling', {}).items():
+                procname = key.rsplit('-', 1)[0]
+                if isinstance(sampling['cpu'], list):
+                    # raw samples of the results saved before the sample store
+                    metrics.setdefault('cpu:%s' % procname, []).extend(sampling['cpu'])
+                    metrics.setdefault('rss_mb:%s' % procname, []).extend(sampling['mem'])
+                else:
+                    metrics.setdefault('cpu:%s' % procname, []).append(sampling['cpu']['mean'])
+                    metrics.setdefault('rss_mb:%s' % procname, []).append(sampling['mem']['mean'])
+
+        drops_series = [sum(entry['drops'].values()) for entry in result.get('drops_series', [])]
+        if len(drops_series) > 1:
+            metrics['drops'] = [b - a for a, b in zip(drops_series, drops_series[1:])]
+        else:
+            metrics['drops'] = [sum(int(d.rsplit(':', 1)[1]) for d in result.get('drops', []))]
+
+        pipeline = (result.get('pipeline') or {}).values()
+        if any(pipeline):
+            metrics['latency_ms'] = [max(p['p99_latency_ms'] for p in pipeline)]
+        elif any(result.get('ods') or {}):
+            metrics['latency_ms'] = [result['ods']['p99_latency_ms']]
+        return metrics
+
+    def load(self, path):
+        runs = {}
+        for result in load_result_set(path):
+            metrics = runs.setdefault(self.get_run_key(result), {})
+            for name, values in self.get_metrics(result, path).items():
+                metrics.setdefault(name, []).extend(values)
+        return runs
+
+    def compare_metric(self, name, baseline, candidate):
+        kind = name.split(':')[0]
+        base_median = percentile(baseline, 50)
+        cand_median = percentile(candidate, 50)
+        change_pct = 100.0 * (cand_median - base_median) / max(abs(base_median), self.FLOORS[kind])
+        p_value = None
+        if len(baseline) >= self.MIN_SAMPLES and len(candidate) >= self.MIN_SAMPLES:
+            p_value = mann_whitney_u(baseline, candidate)
+        regression = change_pct > self.thresholds[kind] and (p_value is None or p_value < self.significance)
+        return {'metric': name, 'baseline': base_median, 'candidate': cand_median, 'change_pct': change_pct,
+                'p_value': p_value, 'regression': regression}
+
+    def compare(self, paths):
+        baseline_runs = self.load(paths[0])
+        nb_regressions = 0
+        for path in paths[1:]:
+            print("Comparing %s against the baseline %s" % (path, paths[0]))
+            for key, metrics in sorted(self.load(path).items()):
+                if key not in baseline_runs:
+                    print("%s eps=%s event_size=%s: no baseline run" % key)
+                    continue
+                print("%s eps=%s event_size=%s:" % key)
+                for name in sorted(set(metrics) & set(baseline_runs[key])):
+                    row = self.compare_metric(name, baseline_runs[key][name], metrics[name])
+                    nb_regressions += row['regression']
+                    print("  %-28s %12.2f -> %12.2f %+8.1f %%  p=%-8s %s" %
+                          (name, row['baseline'], row['candidate'], row['change_pct'],
+                           '%.4f' % row['p_value'] if row['p_value'] is not None else 'n/a',
+                           'REGRESSION' if row['regression'] else 'ok'))
+        print("%d regression(s) found" % nb_regressions)
+        return nb_regressions
+
+
+def load_scenario(path):
+    with open(path) as f:
+        if path.endswith('.yaml') or path.endswith('.yml'):
+            if yaml is None:
+                raise RuntimeError("PyYAML is needed to read %s, or use a JSON scenario file" % path)
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+class ScenarioRunner:
+    """Run the cross product of the matrix of a scenario file against the agent, one run after the other.
+
+    A scenario file looks like:
+        {
+            "name": "nightly",
+            "run_time": 300, "warmup": 30, "settle_time": 30, "reset_agent": true, "repeat": 1,
+            "vars": {"syslog_protocol": "udp"},
+            "matrix": {
+                "mix": [{"name": "syslog", "writers": {"syslog": 1000}},
+                        {"name": "syslog+fluent", "writers": {"syslog": 500, "msgpack": 2000}}],
+                "event_size": [200, 1000, 4000],
+                "syslog_writer": ["logger", "raw"]
+            }
+        }
+    Every matrix entry is an axis: mix, run_time, warmup and settle_time are run settings, the other names are
+    DEFAULT_VARS overrides. Each writer of a mix sends its own EPS from its own worker processes. All the runs
+    are saved in the same result set, tagged with their scenario values. out_oms_flush_interval and
+    out_oms_num_threads rewrite the original omsagent.conf and restart the agent whenever a run changes them, so
+    that every run gets the out_oms settings of its own values. The original is restored at the end.
+    """
+    RUN_SETTINGS = ['mix', 'run_time', 'warmup', 'settle_time']
+
+    def __init__(self, scenario, template, pgrep, pids, ods_sink=None):
+        self.scenario = scenario
+        self.template = template  # LoadBench holding the profiling, pacing and workers settings
+        self.pgrep = pgrep
+        self.pids = pids
+        self.ods_sink = ods_sink
+        self.omsagent_conf = None  # original omsagent.conf, read before tuning it the first time
+        self.out_oms_tuning = ('', '')  # flush_interval and num_threads currently applied
+
+    def get_runs(self):
+        matrix = self.scenario.get('matrix', {})
+        axes = sorted(matrix)
+        for values in itertools.product(*[matrix[axis] for axis in axes]):
+            run = {
+                'run_time': self.scenario.get('run_time', 60),
+                'warmup': self.scenario.get('warmup', 0),
+                'settle_time': self.scenario.get('settle_time', 10),
+                'mix': self.scenario.get('mix', {'name': 'default', 'writers': {'syslog': 100}}),
+                'vars': dict(self.scenario.get('vars', {})),
+            }
+            for axis, value in zip(axes, values):
+                if axis in self.RUN_SETTINGS:
+                    run[axis] = value
+                elif axis in DEFAULT_VARS:
+                    run['vars'][axis] = str(value)
+                else:
+                    raise ValueError("unknown matrix axis '%s'" % axis)
+            run['axes'] = dict((axis, value['name'] if axis == 'mix' else value) for axis, value in zip(axes, values))
+            for repeat in range(self.scenario.get('repeat', 1)):
+                yield dict(run, repeat=repeat)
+
+    def get_processes(self):
+        if not self.template.do_profiling:
+            return []
+        pids = list(self.pids)
+        if self.pgrep != '':
+            # the agent may have been restarted since the last run
+            pids += [int(p) for p in subprocess.Popen(['pgrep', self.pgrep], stdout=subprocess.PIPE).stdout.read().split()]
+        return [psutil.Process(pid) for pid in pids]
+
+    def make_loadbench(self, run, run_time):
+        constants = dict(DEFAULT_VARS)
+        constants.update(dict((name, str(value)) for name, value in run['vars'].items()))
+        config_mgr = ConfigManager(constants)
+        loadbench = LoadBench(run_time, self.template.sampling_rate, config_mgr)
+        loadbench.do_profiling = self.template.do_profiling
+        loadbench.nb_workers = self.template.nb_workers
+        loadbench.sampler = self.template.sampler
+        loadbench.pacing = self.template.pacing
+        loadbench.soak = self.template.soak
+        loadbench.stack_profiler = self.template.stack_profiler
+        loadbench.writer_eps = dict((name, int(eps)) for name, eps in run['mix']['writers'].items())
+        return loadbench
+
+    def apply_out_oms_tuning(self, omsagent_config_path, tuning):
+        """Apply (flush_interval, num_threads) to the original omsagent.conf, return True when it changed."""
+        if tuning == self.out_oms_tuning:
+            return False
+        if self.omsagent_conf is None:
+            with open(omsagent_config_path) as f:
+                self.omsagent_conf = f.read()
+        restore_omsagent_conf(omsagent_config_path, self.omsagent_conf)
+        if any(tuning):
+            tune_out_oms(omsagent_config_path, *tuning)
+        self.out_oms_tuning = tuning
+        return True
+
+    def run(self):
+        omsagent_config_path = dict(DEFAULT_VARS, **self.scenario.get('vars', {}))['omsagent_config_path']
+        try:
+            self.run_all(omsagent_config_path)
+        finally:
+            if self.apply_out_oms_tuning(omsagent_config_path, ('', '')):
+                run_cmds(restart_oms_cmds)
+
+    def run_all(self, omsagent_config_path):
+        runs = list(self.get_runs())
+        write_header = True
+        for index, run in enumerate(runs):
+            print("Scenario '%s' run %d/%d: %s" % (self.scenario.get('name', ''), index + 1, len(runs),
+                                                   ', '.join('%s=%s' % item for item in sorted(run['axes'].items()))))
+            loadbench = self.make_loadbench(run, run['run_time'])
+            writers = loadbench.config_mgr.get_writers_by_name(list(loadbench.writer_eps))
+            eps = sum(loadbench.writer_eps.values())
+            constants = loadbench.config_mgr.constants
+            tuned = self.apply_out_oms_tuning(omsagent_config_path, (constants['out_oms_flush_interval'],
+                                                                     constants['out_oms_num_threads']))
+            if self.scenario.get('reset_agent', True) or tuned:
+                run_cmds(restart_oms_cmds)
+                time.sleep(run['settle_time'])
+
+            if run['warmup'] > 0:
+                warmup = self.make_loadbench(run, run['warmup'])
+                warmup.do_profiling = False
+                warmup.run_load(eps, [], warmup.config_mgr.get_writers_by_name(list(warmup.writer_eps)))
+
+            if self.ods_sink is not None:
+                self.ods_sink.stats = OdsSinkStats()
+                if self.ods_sink.tracker is not None:
+                    self.ods_sink.tracker = EventStampTracker()
+                # the outage windows start with the load
+                self.ods_sink.faults = OdsFaultProfile.parse(loadbench.config_mgr.constants['ods_faults'])
+            processes = self.get_processes()
+            if self.ods_sink is not None:
+                pids = [p.pid for p in processes] or self.pids
+                self.ods_sink.connections = OdsConnectionStats(AgentThreadClock(pids) if any(pids) else None)
+            load_begin_time = time.time()
+            profiling, response_times, nb_events, elapsed_time = loadbench.run_load(eps, processes, writers)
+            wait_time_after_completion = int(loadbench.config_mgr.constants['wait_time_after_completion'])
+            if wait_time_after_completion > 0:
+                time.sleep(wait_time_after_completion)
+            result = report_run(loadbench, writers, eps, profiling, response_times, nb_events, elapsed_time,
+                                self.ods_sink, load_begin_time)
+            result['scenario'] = {'name': self.scenario.get('name', ''), 'run': index, 'repeat': run['repeat'],
+                                  'axes': run['axes'], 'writer_eps': loadbench.writer_eps, 'warmup': run['warmup']}
+            loadbench.save_results(result, write_header)
+            write_header = False
+
+
 WORKSPACE_DIR = './workspace'
 TEST_DIR = os.path.join(WORKSPACE_DIR, 'test_dir')
 RUBY_PATH_OMS = "/opt/microsoft/omsagent/ruby/bin/ruby"
 RUBY_PATH_DEFAULT = "/usr/bin/ruby"
 RUBY_PATH_LOCAL = "/usr/local/bin/ruby"
 RUBY_PROF_PATH = "/usr/local/bin/ruby-prof"
+RBSPY_PATH = "/usr/local/bin/rbspy"
+REPO_PLUGINS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'source', 'code', 'plugins')
 DEFAULT_VARS = {
     'tag': 'oms.tag.perf',
     'syslog_port': '25224',
@@ -625,8 +4067,12 @@ DEFAULT_VARS = {
     'syslog_path': '%s/in_syslog.socket' % TEST_DIR,
     'syslog_host': '0.0.0.0',
     'syslog_protocol': 'udp',
+    'syslog_writer': 'logger',
+    'syslog_batch_size': '1',
     'fluent_port': '24224',
     'fluent_host': '0.0.0.0',
+    'fluent_mode': 'message',
+    'fluent_entries': '100',
     'tail_path': '%s/in_tail.log' % TEST_DIR,
     'test_dir': TEST_DIR,
     'omsadmin_conf_path': '/etc/opt/microsoft/omsagent/conf/omsadmin.conf',
@@ -634,10 +4080,46 @@ DEFAULT_VARS = {
     'key_path': '/etc/opt/microsoft/omsagent/certs/oms.key',
     'omsagent_config_path': '/etc/opt/microsoft/omsagent/conf/omsagent.conf',
     'omsagent_path': '/opt/microsoft/omsagent/bin/omsagent',
+    'omsagent_log_path': '/var/opt/microsoft/omsagent/log/omsagent.log',
+    'security_events_config_path': '/etc/opt/microsoft/omsagent/conf/omsagent.d/security_events.conf',
+    'security_mix': 'Palo Alto Networks|PAN-OS=2,Fortinet|Fortigate=1,Check Point|VPN-1 & FireWall-1=1,Cisco|ASA=2',
+    'security_extension_fields': '20',
+    'statsd_host': '127.0.0.1',
+    'statsd_port': '8125',
+    'statsd_mix': 'counter=4,timer=4,gauge=1,set=1',
+    'statsd_keys': '100',
+    'statsd_metrics_per_datagram': '1',
+    'statsd_flush_interval': '10',
+    'statsd_threshold_percentile': '90',
+    'statsd_timer_keys_sweep': '10,100,1000,10000',
+    'statsd_lib_path': '/opt/microsoft/omsagent/plugin/statsd_lib.rb',
     'result_path': '%s/results.csv' % WORKSPACE_DIR,
+    'capacity_path': '%s/capacity.csv' % WORKSPACE_DIR,
+    'buffer_path': '/var/opt/microsoft/omsagent/*/state/out_oms_*.buffer',
+    'ods_sink_host': '127.0.0.1',
+    'ods_sink_port': '8443',
+    'ods_sink_cert_path': '%s/ods_sink.crt' % WORKSPACE_DIR,
+    'ods_sink_key_path': '%s/ods_sink.key' % WORKSPACE_DIR,
+    'ods_faults': '',
+    'tcp_connections': '1000',
+    'tcp_framing': 'newline',
+    'tcp_connect_concurrency': '100',
+    'out_oms_flush_interval': '',
+    'out_oms_num_threads': '',
     'wait_time_after_completion': '0',
     'perf_tuning': 'none',
     'event_size': '1000',
+    'event_stamps': 'false',
+    'corpus_path': '',
+    'event_size_distribution': 'fixed',
+    'hostname_cardinality': '1',
+    'ident_cardinality': '1',
+    'facility_cardinality': '1',
+    'severity_cardinality': '1',
+    'cardinality_skew': '0',
+    'pool_size': '4096',
+    'random_seed': '0',
+    'corpus_rewrite': 'timestamp,hostname',
     'network_queue': '21299',
 }
 
@@ -648,11 +4130,184 @@ disable_oms_dsc_cmds = [
     'sudo rm /etc/opt/omi/conf/omsconfig/configuration/Current.mof*',
     'sudo rm /etc/opt/omi/conf/omsconfig/configuration/Pending.mof*',
 ]
+restart_oms_cmds = [
+    'sudo /opt/microsoft/omsagent/bin/service_control restart',
+]
 network_setups_cmds = [
     'sysctl -w net.core.rmem_max=%(network_queue)s',
     'sysctl -w net.core.rmem_default=%(network_queue)s',
 ]
 
+def print_fault_report(faults, ods_stats, buffer_summary):
+    failures = ', '.join('%s=%d' % item for item in sorted(ods_stats['failures'].items())) or 'none'
+    recovery = '%.1f s' % ods_stats['recovery_s'] if ods_stats['recovery_s'] is not None else 'n/a'
+    print("ODS faults '%s': failures %s (%d records), %d retries, %d chunks never delivered, recovery %s" %
+          (faults.name, failures, ods_stats['failed_records'], ods_stats['retries'], ods_stats['undelivered_chunks'],
+           recovery))
+    for name, buf in sorted(buffer_summary.items()):
+        print("ODS faults '%s': %s buffer max %.1f MB, max %d/%d queued, ~%d chunks dropped by drop_oldest_chunk" %
+              (faults.name, name, buf['max_bytes'] / 10 ** 6.0, buf['max_queued'], buf['queue_limit'],
+               buf['dropped_chunks']))
+
+
+def print_soak_report(soak_report):
+    for name, process in sorted(soak_report.get('processes', {}).items()):
+        for memory in ('rss', 'pss'):
+            trend = process[memory]
+            if trend:
+                print("%s %s: %+.2f MB/hour [%+.2f, %+.2f] over %.1f hours after warmup, %+.2f MB/hour in the "
+                      "second half, %.1f -> %.1f MB: %s" %
+                      (name, memory, trend['mb_per_hour'], trend['ci_low'], trend['ci_high'], process['hours'],
+                       trend['second_half_mb_per_hour'], trend['start_mb'], trend['end_mb'], trend['verdict']))
+        if process['cpu_spikes'] > 0:
+            print("%s: %d cpu spikes up to %.1f%%, %d at a fork (run_garbage_collection)%s" %
+                  (name, process['cpu_spikes'], process['max_spike_cpu'], process['fork_spikes'],
+                   ', the others every %.1f s (periodic GC?)' % process['spike_period_s']
+                   if process['spike_period_s'] is not None else ''))
+
+
+def report_run(loadbench, writers, eps, profiling, response_times, nb_events, elapsed_time, ods_sink,
+               load_begin_time):
+    config_mgr = loadbench.config_mgr
+    achieved_eps = nb_events / elapsed_time if elapsed_time > 0 else 0
+
+    ods_stats = {}
+    if ods_sink is not None:
+        ods_stats = ods_sink.stats.get_summary(load_begin_time)
+        print("ODS stand-in: %(records)d records in %(requests)d requests, %(wire_bytes)d bytes on the wire, "
+              "delivered %(delivered_eps).2f EPS, request latency p50=%(p50_latency_ms).2f ms "
+              "p99=%(p99_latency_ms).2f ms" % ods_stats)
+        if ods_sink.faults.is_active():
+            print_fault_report(ods_sink.faults, ods_stats, loadbench.buffer_summary)
+        ods_stats['connections'] = ods_sink.connections.get_summary()
+        print("ODS stand-in: %(connections)d connections, %(handshakes)d TLS handshakes (%(handshake_failures)d "
+              "failed, %(reused_sessions)d resumed, p50=%(p50_handshake_ms).2f ms), %(requests_per_connection).2f "
+              "requests per connection, %(single_request_connections_pct).1f%% with a single request" %
+              ods_stats['connections'])
+        if 'agent_handshake_cpu_s' in ods_stats['connections']:
+            print("omsagent: %(agent_handshake_cpu_s).3f s CPU in TLS handshakes, %(agent_cpu_per_handshake_ms).2f ms "
+                  "per handshake, %(agent_handshake_cpu_pct).2f%% of its CPU" % ods_stats['connections'])
+
+    print("Response times: avg=%.2f s, max=%.2fs" % (average(response_times), max(response_times)))
+    print("Target: %d EPS, achieved: %.2f EPS with %d worker(s)" % (eps, achieved_eps, loadbench.nb_workers))
+    send_stats = loadbench.get_send_stats(writers)
+    syscalls_per_event = {}
+    for name, stats in send_stats.items():
+        if stats.get('events', 0) > 0:
+            syscalls_per_event[name] = float(stats['syscalls']) / stats['events']
+            print("%s: %d events, %d syscalls (%.4f per event), %d send errors" %
+                  (name, stats['events'], stats['syscalls'], syscalls_per_event[name], stats['errors']))
+            if stats.get('bytes', 0) > 0:
+                print("%s: %d bytes sent (%.1f bytes per event)" % (name, stats['bytes'],
+                                                                    float(stats['bytes']) / stats['events']))
+    pipeline_stats = {}
+    if ods_sink is not None and ods_sink.tracker is not None:
+        pipeline_stats = ods_sink.tracker.get_summary(send_stats)
+        for name, stats in sorted(pipeline_stats.items()):
+            print("%s: latency p50=%.1f ms, p90=%.1f ms, p99=%.1f ms, max=%.1f ms, lost=%d, gaps=%d, duplicates=%d, "
+                  "reordered=%d" % (name, stats['p50_latency_ms'], stats['p90_latency_ms'], stats['p99_latency_ms'],
+                                    stats['max_latency_ms'], stats['lost'], stats['gaps'], stats['duplicates'],
+                                    stats['reordered']))
+    if any(loadbench.schedule_lag):
+        print("Schedule lag: p50=%(p50_ms).3f ms, p99=%(p99_ms).3f ms, max=%(max_ms).3f ms "
+              "over %(batches)d batches" % loadbench.schedule_lag)
+    for name, buf in sorted(loadbench.buffer_summary.items()):
+        print("%s buffer: enqueued %d chunks (%.2f/s), flushed %d (%.2f/s), ~%d dropped by drop_oldest_chunk, "
+              "max %d/%d queued, max %.1f MB%s" %
+              (name, buf['enqueued_chunks'], buf['enqueue_rate'], buf['flushed_chunks'], buf['flush_rate'],
+               buf['dropped_chunks'], buf['max_queued'], buf['queue_limit'], buf['max_bytes'] / 10 ** 6.0,
+               ', queue full after %.1f s' % buf['queue_full_after_s'] if buf['queue_full_after_s'] is not None
+               else ''))
+    io_per_event = get_io_per_event(profiling, float(loadbench.get_ingested_events(nb_events, writers)),
+                                    sum(stats.get('bytes', 0) for stats in send_stats.values()))
+    for procname, io in sorted(io_per_event.items()):
+        print("%s: %.1f bytes written per event (amplification %.2fx, %.1f bytes through write()), "
+              "%.3f read + %.3f write syscalls per event, %.3f minor + %.4f major faults per event, "
+              "%.0f voluntary + %.0f involuntary context switches/s" %
+              (procname, io['write_bytes_per_event'], io['write_amplification'], io['wchar_per_event'],
+               io['read_syscalls_per_event'], io['write_syscalls_per_event'], io['minor_flt_per_event'],
+               io['major_flt_per_event'], io['voluntary_ctxt_per_s'], io['nonvoluntary_ctxt_per_s']))
+    drop_rate_curve = get_drop_rate_curve(loadbench.drops_series)
+    for name, curve in sorted(drop_rate_curve.items()):
+        print("%s drop rate: %s" % (name, ' '.join('%.1fs=%.1f/s(q=%d)' % (p['time'], p['drops_per_s'], p['max_rx_queue'])
+                                                   for p in curve)))
+    for writer in writers:
+        if isinstance(writer, TcpFanInWriter) and writer.get_fanin_summary():
+            fanin = writer.get_fanin_summary()
+            send_stats[writer.get_name()]['fanin'] = fanin
+            print("%s: %d connections (%s framing), blocked in drain p50=%.2f%% p99=%.2f%% max=%.2f%% of the time, "
+                  "%d blocked drains, longest %.1f ms, %d events unsent at the end, %d lost" %
+                  (writer.get_name(), fanin['connections'], fanin['framing'], fanin['p50_blocked_pct'],
+                   fanin['p99_blocked_pct'], fanin['max_blocked_pct'], fanin['blocked_drains'], fanin['max_drain_ms'],
+                   fanin['unsent'], fanin['lost']))
+    security_parse = {}
+    for writer in writers:
+        if isinstance(writer, SecurityEventsWriter):
+            pattern = read_security_events_format(config_mgr.constants['security_events_config_path'])
+            for kind, lines in sorted(writer.get_sample_lines().items()):
+                security_parse[kind] = measure_regex_cost(pattern, lines)
+                print("security_events %s: format regex %.2f us per event (%.0f bytes, %d/%d matched, %s)" %
+                      (kind, security_parse[kind]['us_per_event'], security_parse[kind]['avg_len'],
+                       security_parse[kind]['matched'], security_parse[kind]['events'],
+                       security_parse[kind]['engine']))
+            security_eps = SecurityEpsLog.get_summary(loadbench.security_eps_series)
+            if security_eps:
+                print("SyslogSecurityEventsFilter: mean %(mean_eps).1f EPS, max %(max_eps)d EPS over %(ticks)d ticks, "
+                      "%(late_ticks)d ticks late, longest interval %(max_interval_s).2f s" % security_eps)
+            else:
+                print("No 'Security Syslog EPS' lines in %s, enable check_eps() in filter_syslog_security.rb to "
+                      "follow the filter" % config_mgr.constants['omsagent_log_path'])
+            security_parse['filter_eps'] = security_eps
+    statsd_flush = []
+    for writer in writers:
+        if isinstance(writer, StatsDWriter):
+            constants = config_mgr.constants
+            flush_interval = float(constants['statsd_flush_interval'])
+            writer_eps = loadbench.writer_eps.get(writer.get_name(), eps)
+            nb_values = int(writer_eps * writer.get_fraction('timer') * flush_interval)
+            timer_keys = sorted(set([writer.nb_keys] + [int(k) for k in constants['statsd_timer_keys_sweep'].split(',')
+                                                        if k]))
+            statsd_flush = measure_statsd_flush_cost(constants['statsd_lib_path'],
+                                                     int(constants['statsd_threshold_percentile']), nb_values,
+                                                     timer_keys)
+            if not statsd_flush:
+                print("statsd: no ruby found, the flush cost of the aggregator is not measured")
+            for flush in statsd_flush:
+                print("statsd flush of %(values)d timer values over %(timer_keys)d keys: %(flush_ms).2f ms for "
+                      "%(records)d records, receive %(receive_us_per_value).2f us per value" % flush)
+    print_soak_report(loadbench.soak_report)
+    dropped_events = ['%s:%d' % (w.get_protocol(), w.get_number_dropped_event()) for w in writers]
+    return {
+        "eps": eps,
+        "achieved_eps": achieved_eps,
+        "workers": loadbench.nb_workers,
+        "pacing": loadbench.pacing['mode'],
+        "schedule_lag": loadbench.schedule_lag,
+        "send_stats": send_stats,
+        "config": config_mgr.constants,
+        "ods": ods_stats,
+        "pipeline": pipeline_stats,
+        "syscalls_per_event": syscalls_per_event,
+        "io_per_event": io_per_event,
+        "sampling_rate": loadbench.sampling_rate,
+        "run_time": loadbench.run_time,
+        'profiling': profiling,
+        'response_times': response_times,
+        'plugins': '|'.join(w.get_name() for w in writers),
+        'nb_events': nb_events,
+        'drops': dropped_events,
+        'drops_series': loadbench.drops_series,
+        'drop_rate_curve': drop_rate_curve,
+        'buffers': loadbench.buffer_summary,
+        'buffer_series': loadbench.buffer_series,
+        'samples': loadbench.samples_index,
+        'security_parse': security_parse,
+        'security_eps_series': loadbench.security_eps_series,
+        'statsd_flush': statsd_flush,
+        'soak': loadbench.soak_report,
+    }
+
+
 def run_cmds(cmds):
     for cmd in cmds:
         cmd = cmd % DEFAULT_VARS
@@ -662,7 +4317,20 @@ def run_cmds(cmds):
 def main(argv):
     parser = argparse.ArgumentParser()
     parser.add_argument("--list-default-val", required=False, action='count', default=0, help="list default values")
-    for name, value in DEFAULT_VARS.iteritems():
+    parser.add_argument("--compare", required=False, nargs='+', metavar='RESULTS_JSON',
+                        help="compare result sets (results.csv.json) against the first one and exit non-zero "
+                             "on a regression")
+    parser.add_argument("--cpu-threshold-pct", required=False, type=float, default=10,
+                        help="highest growth of the median cpu before a regression")
+    parser.add_argument("--rss-threshold-pct", required=False, type=float, default=10,
+                        help="highest growth of the median rss before a regression")
+    parser.add_argument("--drops-threshold-pct", required=False, type=float, default=10,
+                        help="highest growth of the median drops per sample before a regression")
+    parser.add_argument("--latency-threshold-pct", required=False, type=float, default=20,
+                        help="highest growth of the p99 ingest latency before a regression")
+    parser.add_argument("--significance", required=False, type=float, default=0.05,
+                        help="highest p-value of the Mann-Whitney test for a significant regression")
+    for name, value in DEFAULT_VARS.items():
         parser.add_argument("--%s" % name.replace('_', '-'), required=False, help="%s" % name.replace('_', ' '),
                             default=value)
 
@@ -670,16 +4338,63 @@ def main(argv):
     args = vars(args)
     if args['list_default_val'] > 0:
         print("\t Available plugins: %s" % (', '.join(get_all_plugins_name())))
-        for name, value in DEFAULT_VARS.iteritems():
+        for name, value in DEFAULT_VARS.items():
             print("\t %s='%s'" % (name, value))
         return
-
-    parser.add_argument("--run-time", required=True, type=int, help="duration of the load in seconds")
+    if args['compare']:
+        if len(args['compare']) < 2:
+            parser.error("--compare needs a baseline and at least one result set")
+        comparator = ResultComparator({'cpu': args['cpu_threshold_pct'], 'rss_mb': args['rss_threshold_pct'],
+                                       'drops': args['drops_threshold_pct'],
+                                       'latency_ms': args['latency_threshold_pct']}, args['significance'])
+        sys.exit(1 if comparator.compare(args['compare']) > 0 else 0)
+
+    parser.add_argument("--run-time", required=False, type=int, help="duration of the load in seconds")
     parser.add_argument("--eps", required=False, type=int, help="EPS in seconds", default=1)
     parser.add_argument("--sample-rate", required=False, type=float, help="sampling rate in seconds", default=0.5)
+    parser.add_argument("--soak", required=False, action='store_true',
+                        help="long run reporting the memory growth trend and the cpu spikes of every process, "
+                             "needs --do-profiling")
+    parser.add_argument("--soak-warmup", required=False, type=float, default=600,
+                        help="seconds of the soak left out of the memory trend")
+    parser.add_argument("--leak-threshold", required=False, type=float, default=1.0,
+                        help="lowest memory growth in MB/hour reported as a leak")
+    parser.add_argument("--ruby-stacks", required=False, action='store_true',
+                        help="sample the ruby stacks of the profiled processes with rbspy, write a folded file per "
+                             "run and split their cpu by plugin, needs --do-profiling")
+    parser.add_argument("--ruby-stacks-rate", required=False, type=int, default=100,
+                        help="stack samples per second")
     parser.add_argument("--pids", required=False, help="pids of processes to collect metrics", default='')
     parser.add_argument("--pgrep", required=False, help="process name to collect metrics", default='omsagent')
     parser.add_argument("--do-profiling", required=False, help="", action='store_true')
+    parser.add_argument("--sampler", required=False, choices=['proc', 'psutil'], default='proc',
+                        help="proc: read the /proc counters directly, psutil: the original psutil based profiling")
+    parser.add_argument("--pacing", required=False, choices=['token', 'burst'], default='token',
+                        help="token: spread the events over the second, burst: send all the events then sleep")
+    parser.add_argument("--burst-size", required=False, type=int, default=10,
+                        help="maximum number of events sent per batch with token pacing")
+    parser.add_argument("--pacing-tick", required=False, type=float, default=0.0005,
+                        help="busy wait window in seconds before each batch with token pacing")
+    parser.add_argument("--ods-sink", required=False, action='store_true',
+                        help="redirect out_oms to a local ODS stand-in and report the delivered EPS")
+    parser.add_argument("--find-max-eps", required=False, action='store_true',
+                        help="search the highest sustainable EPS of each plugin and write a capacity table")
+    parser.add_argument("--min-eps", required=False, type=int, default=100, help="first EPS of the search")
+    parser.add_argument("--max-eps", required=False, type=int, default=200000, help="highest EPS of the search")
+    parser.add_argument("--search-precision", required=False, type=float, default=0.05,
+                        help="stop the search when the interval is within this fraction of the EPS")
+    parser.add_argument("--settle-time", required=False, type=int, default=10,
+                        help="seconds to wait between two probes for the agent to drain")
+    parser.add_argument("--max-drops-pct", required=False, type=float, default=0.1,
+                        help="highest percentage of dropped events of a sustainable EPS")
+    parser.add_argument("--max-latency-ms", required=False, type=float, default=30000,
+                        help="highest p99 ingest latency of a sustainable EPS, needs --ods-sink --event-stamps true")
+    parser.add_argument("--max-buffer-growth-mb", required=False, type=float, default=10,
+                        help="highest growth of the out_oms buffer files of a sustainable EPS")
+    parser.add_argument("--workers", required=False, type=int, default=1,
+                        help="number of processes sharing the EPS, each one with its own writers")
+    parser.add_argument("--scenario", required=False,
+                        help="JSON or YAML scenario file, runs its whole matrix into one result set")
     parser.add_argument("--plugins", required=False,
                         help="choose which plugins to enable, available plugins: %s" % ','.join(get_all_plugins_name()),
                         default='')
@@ -688,6 +4403,8 @@ def main(argv):
     if len(unknown) > 0:
         print("unknown args:", unknown)
     args = vars(args)
+    if args['run_time'] is None and not args['scenario']:
+        parser.error("--run-time is required")
 
     do_profiling = args['do_profiling']
     for name in DEFAULT_VARS.keys():
@@ -696,47 +4413,95 @@ def main(argv):
 
     eps = args['eps']
     run_time = args['run_time']
-    plugins = filter(None, args['plugins'].split(','))
+    plugins = [name for name in args['plugins'].split(',') if name]
     rate = args['sample_rate']
-    pids = map(int, filter(None, args['pids'].split(',')))
+    pids = [int(pid) for pid in args['pids'].split(',') if pid]
 
-    if do_profiling and args['pgrep'] is not '':
+    if do_profiling and args['pgrep'] != '':
         list_pids = subprocess.Popen(('pgrep %s' % args['pgrep']).split(' '), stdout=subprocess.PIPE,
                                      stderr=subprocess.STDOUT).stdout.readlines()
-        pids += [int(p.strip('\n')) for p in list_pids]
+        pids += [int(p.strip()) for p in list_pids]
 
     config_mgr = ConfigManager(DEFAULT_VARS)
     loadbench = LoadBench(run_time, rate, config_mgr)
     loadbench.do_profiling = do_profiling
+    if args['soak']:
+        if not do_profiling:
+            parser.error("--soak needs --do-profiling")
+        loadbench.soak = {'warmup': args['soak_warmup'], 'leak_threshold': args['leak_threshold']}
+    if args['ruby_stacks']:
+        if not do_profiling:
+            parser.error("--ruby-stacks needs --do-profiling")
+        rbspy_path = RubyStackProfiler.find()
+        if rbspy_path is None:
+            if find_executable(RUBY_PROF_PATH) is not None:
+                parser.error("ruby-prof cannot attach to a running omsagent, --ruby-stacks needs rbspy")
+            parser.error("--ruby-stacks needs rbspy, not found at %s or in PATH" % RBSPY_PATH)
+        ruby_path = get_ruby_path()
+        print("Sampling the ruby %s stacks with %s" % (get_ruby_version(ruby_path) if ruby_path else '(unknown)',
+                                                      rbspy_path))
+        loadbench.stack_profiler = RubyStackProfiler(rbspy_path, args['ruby_stacks_rate'])
+    loadbench.nb_workers = max(1, args['workers'])
+    if args['sampler'] == 'proc':
+        loadbench.sampler = ProcSampler()
+    loadbench.pacing = {'mode': args['pacing'], 'burst_size': args['burst_size'], 'tick': args['pacing_tick']}
 
     plugin_names = '|'.join(plugins)
     processes = []
     writers = config_mgr.get_writers_by_name(plugins)
 
     print("Run load, plugins '%s', %d EPS" % (plugin_names, eps))
+    if config_mgr.event_pool is not None:
+        print(config_mgr.event_pool.describe())
     if do_profiling:
-        processes = map(psutil.Process, pids)
+        processes = [psutil.Process(pid) for pid in pids]
         print("Monitoring process : %s" % ', '.join(['%s-%d' % (p.name(), p.pid) for p in processes]))
 
-    profiling, response_times, nb_events = loadbench.run_load(eps, processes, writers)
-    wait_time_after_completion = int(config_mgr.constants['wait_time_after_completion'])
-    if wait_time_after_completion > 0:
-        print("Waiting %d seconds after completion" % wait_time_after_completion)
-        time.sleep(wait_time_after_completion)
+    ods_sink = start_ods_sink(config_mgr.constants) if args['ods_sink'] else None
 
-    print("Response times: avg=%.2f s, max=%.2fs" % (average(response_times), max(response_times)))
-    if do_profiling:
-        dropped_events = ['%s:%d' % (w.get_protocol(), w.get_number_dropped_event()) for w in writers]
-        result = {
-            "eps": eps,
-            "sampling_rate": rate,
-            "run_time": run_time,
-            'profiling': profiling,
-            'response_times': response_times,
-            'plugins': plugin_names,
-            'nb_events': nb_events,
-            'drops': dropped_events
+    if args['scenario']:
+        runner = ScenarioRunner(load_scenario(args['scenario']), loadbench, args['pgrep'] if do_profiling else '',
+                                [int(pid) for pid in args['pids'].split(',') if pid], ods_sink)
+        try:
+            runner.run()
+        finally:
+            if ods_sink is not None:
+                stop_ods_sink(ods_sink, config_mgr.constants)
+        return
+
+    if args['find_max_eps']:
+        limits = {
+            'drops_pct': args['max_drops_pct'],
+            'latency_ms': args['max_latency_ms'],
+            'buffer_growth_mb': args['max_buffer_growth_mb'],
+            'min_achieved_pct': 95.0,
         }
+        finder = SaturationFinder(loadbench, config_mgr, limits, pids, ods_sink)
+        try:
+            capacity = finder.run(plugins or [w.get_name() for w in config_mgr.available_writers], args['min_eps'],
+                                  args['max_eps'], args['search_precision'], args['settle_time'])
+        finally:
+            if ods_sink is not None:
+                stop_ods_sink(ods_sink, config_mgr.constants)
+        finder.save_capacity_table(capacity)
+        return
+
+    if ods_sink is not None:
+        ods_sink.faults.start()
+        ods_sink.connections = OdsConnectionStats(AgentThreadClock(pids) if any(pids) else None)
+    load_begin_time = time.time()
+    try:
+        profiling, response_times, nb_events, elapsed_time = loadbench.run_load(eps, processes, writers)
+        wait_time_after_completion = int(config_mgr.constants['wait_time_after_completion'])
+        if wait_time_after_completion > 0:
+            print("Waiting %d seconds after completion" % wait_time_after_completion)
+            time.sleep(wait_time_after_completion)
+    finally:
+        if ods_sink is not None:
+            stop_ods_sink(ods_sink, config_mgr.constants)
+    result = report_run(loadbench, writers, eps, profiling, response_times, nb_events, elapsed_time, ods_sink,
+                        load_begin_time)
+    if do_profiling:
         loadbench.save_results(result)
 
 
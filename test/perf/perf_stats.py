@@ -0,0 +1,8 @@
+"""Statistics helpers shared by omsagent-loadtest.py and tcp_fanin.py, runs under python 2 and 3."""
+
+
+def percentile(lst, pct):
+    if len(lst) == 0:
+        return 0
+    values = sorted(lst)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
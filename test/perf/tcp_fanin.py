@@ -0,0 +1,231 @@
+"""Many persistent TCP syslog connections driven by one asyncio event loop.
+
+Used by the syslog_tcp_fanin writer of omsagent-loadtest.py to reproduce relays fanning in thousands of senders to
+the tcp mode of in_syslog. Python 3 only, omsagent-loadtest.py runs without it under python 2.
+"""
+import asyncio
+import math
+import threading
+import time
+
+from perf_stats import percentile
+
+FRAMINGS = ['newline', 'octet_counting']
+
+
+def frame(message, framing):
+    """RFC 6587 framing of a message given without its trailing new line."""
+    if framing == 'octet_counting':
+        return b'%d ' % len(message) + message
+    return message + b'\n'
+
+
+class Connection:
+    def __init__(self, index):
+        self.index = index
+        self.writer = None
+        self.wakeup = None
+        self.pending = 0
+        self.in_flight = 0
+        self.max_pending = 0
+        self.connect_latency = None
+        self.nb_events = 0
+        self.nb_bytes = 0
+        self.nb_writes = 0
+        self.nb_errors = 0
+        self.nb_lost = 0
+        self.nb_unsent = 0
+        self.nb_blocked = 0
+        self.drain_time = 0.0
+        self.max_drain_time = 0.0
+
+
+class TcpFanIn:
+    """Open nb_connections to host:port, then spread the submitted events over them.
+
+    submit() is called from the load thread, the events are rendered and written by the event loop thread. Every
+    connection writes its share and waits in drain() while its transport buffer is above the high-water mark: the
+    time blocked there is the backpressure of the receiver on that connection.
+    """
+    MAX_EVENTS_PER_WRITE = 1000
+    BLOCKED_DRAIN_S = 0.001
+
+    def __init__(self, host, port, nb_connections, render, framing='newline', connect_concurrency=100,
+                 connect_timeout=10.0):
+        if framing not in FRAMINGS:
+            raise ValueError("Unknown framing '%s', use %s" % (framing, ', '.join(FRAMINGS)))
+        self.host = host
+        self.port = port
+        self.render = render
+        self.framing = framing
+        self.connect_concurrency = connect_concurrency
+        self.connect_timeout = connect_timeout
+        self.connections = [Connection(i) for i in range(nb_connections)]
+        self.next_connection = 0
+        self.index = 0
+        self.loop = None
+        self.thread = None
+        self.tasks = []
+        self.begin_time = None
+        self.end_time = None
+
+    def start(self):
+        """Start the event loop thread and return once every connection has been attempted."""
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self.run_loop, args=(ready,))
+        self.thread.daemon = True
+        self.thread.start()
+        ready.wait()
+        self.begin_time = time.time()
+
+    def run_loop(self, ready):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.open_all())
+        ready.set()
+        self.loop.run_forever()
+
+    async def open_all(self):
+        semaphore = asyncio.Semaphore(self.connect_concurrency)
+        for connection in self.connections:
+            connection.wakeup = asyncio.Event()
+        await asyncio.gather(*[self.connect(connection, semaphore) for connection in self.connections])
+        self.tasks = [self.loop.create_task(self.run_connection(connection)) for connection in self.connections]
+
+    async def connect(self, connection, semaphore):
+        async with semaphore:
+            begin_time = time.time()
+            try:
+                reader, connection.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port),
+                                                                   self.connect_timeout)
+                connection.connect_latency = time.time() - begin_time
+            except (OSError, asyncio.TimeoutError):
+                connection.nb_errors += 1
+
+    async def run_connection(self, connection):
+        framing = self.framing
+        render = self.render
+        while True:
+            await connection.wakeup.wait()
+            connection.wakeup.clear()
+            while connection.pending > 0:
+                count = min(connection.pending, self.MAX_EVENTS_PER_WRITE)
+                connection.pending -= count
+                if connection.writer is None:
+                    connection.nb_lost += count
+                    continue
+                first_index = self.index
+                self.index += count
+                data = b''.join(frame(render(index), framing) for index in range(first_index, first_index + count))
+                connection.in_flight = count
+                try:
+                    connection.writer.write(data)
+                    begin_time = time.time()
+                    await connection.writer.drain()
+                except OSError:
+                    connection.nb_errors += 1
+                    connection.nb_lost += count
+                    connection.in_flight = 0
+                    connection.writer = None
+                    continue
+                connection.in_flight = 0
+                drain_time = time.time() - begin_time
+                connection.drain_time += drain_time
+                connection.max_drain_time = max(connection.max_drain_time, drain_time)
+                if drain_time > self.BLOCKED_DRAIN_S:
+                    connection.nb_blocked += 1
+                connection.nb_events += count
+                connection.nb_bytes += len(data)
+                connection.nb_writes += 1
+
+    def dispatch(self, count):
+        nb_connections = len(self.connections)
+        share, extra = divmod(count, nb_connections)
+        first = self.next_connection
+        for i in range(nb_connections if share > 0 else extra):
+            connection = self.connections[(first + i) % nb_connections]
+            connection.pending += share + (1 if i < extra else 0)
+            connection.max_pending = max(connection.max_pending, connection.pending)
+            connection.wakeup.set()
+        # the next remainder goes to the following connections
+        self.next_connection = (first + extra) % nb_connections
+
+    def submit(self, count):
+        self.loop.call_soon_threadsafe(self.dispatch, count)
+
+    def stop(self, drain_timeout=30.0):
+        """Send the queued events, for at most drain_timeout seconds, then close the connections."""
+        if self.loop is None or not self.loop.is_running():
+            return
+        asyncio.run_coroutine_threadsafe(self.close_all(drain_timeout), self.loop).result()
+        self.end_time = time.time()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    async def close_all(self, drain_timeout):
+        deadline = time.time() + drain_timeout
+        while any(c.pending > 0 or c.in_flight > 0 for c in self.connections) and time.time() < deadline:
+            await asyncio.sleep(0.01)
+        for task in self.tasks:
+            task.cancel()
+        # the events still queued when the receiver did not keep up are neither sent nor lost on a broken connection
+        closing = []
+        for connection in self.connections:
+            connection.nb_unsent += connection.pending + connection.in_flight
+            connection.pending = 0
+            connection.in_flight = 0
+            if connection.writer is not None:
+                connection.writer.close()
+                closing.append(connection)
+        # closed transports still flush their buffer, whatever remains at the deadline is unsent
+        if closing:
+            try:
+                await asyncio.wait_for(asyncio.gather(*[c.writer.wait_closed() for c in closing],
+                                                      return_exceptions=True), max(0.1, deadline - time.time()))
+            except asyncio.TimeoutError:
+                pass
+        for connection in closing:
+            transport = connection.writer.transport
+            buffered = transport.get_write_buffer_size()
+            if buffered > 0 and connection.nb_bytes > 0:
+                unsent = min(connection.nb_events,
+                             int(math.ceil(buffered * connection.nb_events / float(connection.nb_bytes))))
+                connection.nb_events -= unsent
+                connection.nb_unsent += unsent
+                transport.abort()
+            connection.writer = None
+
+    def get_stats(self):
+        """Counters that can be summed over the worker processes."""
+        connections = self.connections
+        return {
+            'events': sum(c.nb_events for c in connections),
+            'syscalls': sum(c.nb_writes for c in connections),
+            'bytes': sum(c.nb_bytes for c in connections),
+            'errors': sum(c.nb_errors for c in connections),
+            'lost': sum(c.nb_lost for c in connections),
+            'unsent': sum(c.nb_unsent for c in connections),
+            'pending': sum(c.pending for c in connections),
+            'connections': len([c for c in connections if c.connect_latency is not None]),
+            'blocked_drains': sum(c.nb_blocked for c in connections),
+            'drain_time_s': sum(c.drain_time for c in connections),
+        }
+
+    def get_summary(self):
+        duration = (self.end_time or time.time()) - self.begin_time
+        latencies = [c.connect_latency for c in self.connections if c.connect_latency is not None]
+        blocked_pct = [100.0 * c.drain_time / duration for c in self.connections] if duration > 0 else [0]
+        summary = self.get_stats()
+        summary.update({
+            'requested_connections': len(self.connections),
+            'framing': self.framing,
+            'p50_connect_ms': percentile(latencies, 50) * 1000,
+            'p99_connect_ms': percentile(latencies, 99) * 1000,
+            'max_connect_ms': max(latencies) * 1000 if latencies else 0,
+            'p50_blocked_pct': percentile(blocked_pct, 50),
+            'p99_blocked_pct': percentile(blocked_pct, 99),
+            'max_blocked_pct': max(blocked_pct),
+            'max_drain_ms': max(c.max_drain_time for c in self.connections) * 1000,
+            'max_pending': max(c.max_pending for c in self.connections),
+        })
+        return summary
@@ -0,0 +1,53 @@
+"""Checks of the syslog writers of omsagent-loadtest.py against a local UDP receiver.
+
+Run with: python3 -m unittest discover -s test/perf
+"""
+import importlib.util
+import logging
+import os
+import socket
+import unittest
+
+spec = importlib.util.spec_from_file_location('loadtest', os.path.join(os.path.dirname(__file__),
+                                                                       'omsagent-loadtest.py'))
+loadtest = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(loadtest)
+
+
+class LoggerModeTest(unittest.TestCase):
+    def setUp(self):
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiver.bind(('127.0.0.1', 0))
+        self.receiver.settimeout(2)
+        self.path = '127.0.0.1:%d' % self.receiver.getsockname()[1]
+
+    def tearDown(self):
+        logger = logging.getLogger('omstest')
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+        self.receiver.close()
+
+    def receive(self, count):
+        return [self.receiver.recv(65536) for _ in range(count)]
+
+    def test_syslog(self):
+        writer = loadtest.SyslogWriter('tag', self.path, 100, 'udp')
+        writer.write(eps=3)
+        datagrams = self.receive(3)
+        for index, datagram in enumerate(datagrams):
+            self.assertTrue(datagram.startswith(b'<14>'), datagram)
+            self.assertNotIn(b"b'", datagram)
+            self.assertIn(('idx=%d syslog %s' % (index, writer.msg)).encode('ASCII'), datagram)
+
+    def test_syslog_cef(self):
+        writer = loadtest.CEFWriter('tag', self.path, 100, 'udp')
+        writer.write(eps=2)
+        for datagram in self.receive(2):
+            self.assertTrue(datagram.startswith(b'<14>'), datagram)
+            self.assertIn(b' CEF: idx=', datagram)
+            self.assertNotIn(b"b'", datagram)
+
+
+if __name__ == '__main__':
+    unittest.main()